@@ -22,6 +22,10 @@ TIME_OF_DAY_PROPS ={
 # TARGET_HORIZONS = ['study_day', 'study_week', 'study_month']
 TARGET_HORIZONS = ['study_day', 'study_week']
 
+# Length of each horizon, in days. Every target horizon must have one. Months are average
+# Gregorian months (as numpy's 'M' unit), not DAYS_IN_MONTH
+HORIZON_DAYS = {'study_day': 1, 'study_week': DAYS_IN_WEEK, 'study_month': 365.2425 / 12}
+
 # Threshold under which participants are considered to be nonadherent
 ADHERENCE_THRESHOLD = 0.8
 
@@ -1 +1,3 @@
-from .dataset import *
\ No newline at end of file
+from .cache import *
+from .dataset import *
+from .synthetic import *
\ No newline at end of file
@@ -0,0 +1,83 @@
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from ..consts import DATA_PATH
+
+CACHE_PATH = Path.joinpath(DATA_PATH, 'cache/')
+
+# Bump when the cleaning or the cache format changes, so older caches aren't read back
+CACHE_VERSION = 1
+
+def file_hash(path, chunk_size=2**20):
+    ''' SHA-1 of a file's contents '''
+    h = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def dataset_key(path, *args):
+    ''' Cache key of a dataset - a hash of its source file's contents, and of the (JSON-able or string-able)
+        arguments it's read and cleaned with. Dictionaries and sets are keyed regardless of their order. '''
+    h = hashlib.sha1()
+    h.update(file_hash(path).encode('utf-8'))
+    h.update(repr((CACHE_VERSION, _canonical(args))).encode('utf-8'))
+    return h.hexdigest()
+
+def write_frame(df, path):
+    '''
+    Write df to an uncompressed Feather (Arrow IPC) file, with its dtypes (categoricals included) and index,
+    so read_frame can memory-map it. The file is written next to path and then moved into place,
+    so an interrupted write never leaves a partial cache behind.
+    '''
+    import pyarrow as pa
+    from pyarrow import feather
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    try:
+        feather.write_feather(pa.Table.from_pandas(df), tmp_path, compression='uncompressed')
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+def read_frame(path, memory_map=False):
+    '''
+    Read a frame written by write_frame - every column is a (writable) copy. If memory_map, numeric columns
+    without missing values are views of the file instead - they're read-only, so whole columns can be
+    assigned, but not values set in place (e.g., with .loc or inplace=True).
+    '''
+    import pyarrow as pa
+    from pyarrow import feather
+
+    table = feather.read_table(path, memory_map=memory_map)
+    df = table.to_pandas(split_blocks=memory_map)
+
+    # Arrow gives missing strings as None - restore the NaNs pandas reads them as, where Arrow has them as null.
+    # The frame is rebuilt from its columns, rather than written through their arrays (which Copy-on-Write
+    # would drop) or assigned column by column (which is slow for thousands of columns)
+    fixed = {}
+    for name in table.column_names:
+        col = table.column(name)
+        if name in df.columns and col.null_count and (pa.types.is_string(col.type) or pa.types.is_large_string(col.type)):
+            fixed[name] = np.where(col.is_null().to_numpy(zero_copy_only=False), np.nan, df[name].to_numpy())
+    if fixed:
+        df = pd.DataFrame({name: fixed[name] if name in fixed else df[name] for name in df.columns},
+                          index=df.index, columns=df.columns, copy=False)
+    return df
+
+def _canonical(obj):
+    if isinstance(obj, dict):
+        return sorted((str(k), _canonical(v)) for k, v in obj.items())
+    if isinstance(obj, (set, frozenset)):
+        return sorted(_canonical(v) for v in obj)
+    if isinstance(obj, (list, tuple)):
+        return [_canonical(v) for v in obj]
+    if isinstance(obj, Path):
+        return str(obj)
+    return obj
@@ -1,7 +1,16 @@
+import re
+from pathlib import Path
+
 import pandas as pd
 import numpy as np
 import itertools
 
+from .cache import CACHE_PATH, dataset_key, read_frame, write_frame
+
+# Formats of the MEMS date and time columns - their combined datetime is only set if both match
+MEMS_DATE_FORMAT = '%m/%d/%Y'
+MEMS_TIME_FORMAT = '%H:%M:%S'
+
 class Dataset:
     def __init__(self, df, id_col, feature_categories=None):
         
@@ -14,6 +23,49 @@ class Dataset:
         # Store a dictionary of category, list of column pairs
         self.feature_categories = feature_categories
 
+    @classmethod
+    def from_csv(cls, path, id_col, clean_args=None, dtypes_dict=None, read_args=None, 
+                 cache_path=CACHE_PATH, refresh=False, memory_map=False):
+        '''
+        Read a CSV, clean it and set its dtypes - unless that's already been done for the same file
+        (by its contents) and arguments, in which case the cleaned frame is read from the cache.
+
+        Args:
+            clean_args: Keyword arguments of clean
+            dtypes_dict: Argument of set_dtypes - columns that cleaning dropped are skipped
+            read_args: Keyword arguments of pd.read_csv
+            cache_path: Directory of the cache (a Feather file per key), or None not to cache
+            refresh: Clean again, even if there's a cache
+            memory_map: Memory-map the cache (see read_frame) - its numeric columns are then read-only, unlike
+                those of a frame that was just cleaned, so only for frames that won't be modified in place
+        '''
+        clean_args, read_args = clean_args or {}, read_args or {}
+
+        # The order columns are listed in doesn't matter to set_dtypes
+        dtypes_dict = {dtype: sorted(cols) for dtype, cols in (dtypes_dict or {}).items()}
+
+        cache_file = None
+        if cache_path is not None:
+            key = dataset_key(path, id_col, clean_args, dtypes_dict, read_args)
+            cache_file = Path.joinpath(Path(cache_path), key + '.feather')
+            if cache_file.exists() and not refresh:
+                print('Reading the cleaned dataset from the cache (%s).' % cache_file)
+                return cls(read_frame(cache_file, memory_map=memory_map), id_col=id_col)
+
+        dataset = cls(pd.read_csv(path, **read_args), id_col=id_col)
+        dataset.clean(**clean_args)
+        dataset.set_dtypes({dtype: [col for col in cols if col in dataset.df.columns] 
+                            for dtype, cols in dtypes_dict.items()})
+
+        if cache_file is not None:
+            # Arrow can't store every frame (e.g., object columns of both strings and numbers)
+            try:
+                write_frame(dataset.df, cache_file)
+                print('Cached the cleaned dataset (%s).' % cache_file)
+            except (ImportError, TypeError, ValueError) as e:
+                print('Couldn\'t cache the cleaned dataset: %s' % e)
+        return dataset
+
     def set_dtypes(self, dtypes_dict):
         ''' Set dtypes on feature columns '''
         for dtype, cols in dtypes_dict.items():
@@ -89,6 +141,56 @@ class Dataset:
                 
         print('Cleaning complete.')
 
+    def to_events(self, start_date_col='DateEnroll'):
+        '''
+        Reshape the wide MEMS columns (dateNNN, MEMS_dateNNN_timeK, _numtimes, _interval and _withinrange)
+        into long-form events, as analysis.ipynb does - one row per participant and time column, ordered by
+        date column, then time column, then participant. Rows without a date, before the start date, or
+        duplicated (e.g., a day's empty time columns, after the first) are dropped.
+
+        The column schema is parsed once (see mems_schema), and each block of columns is reshaped with a
+        single take. Dates, times and intervals are parsed once for each distinct value.
+
+        Returns:
+            DataFrame of id_col, start_date_col, date, num_times_used_today, MEMS_day, time, interval,
+            withinrange and datetime (of the date and time, if both are set)
+        '''
+        return _reshape_mems(self.df, mems_schema(self.df.columns), self.id_col, start_date_col)
+
+    def iter_events(self, chunksize=1000, start_date_col='DateEnroll'):
+        ''' Events of to_events, for chunksize participants at a time (each in the order of to_events), 
+            so the long form of a large cohort never has to be held at once '''
+        schema = mems_schema(self.df.columns)
+        codes, _ = pd.factorize(self.df[self.id_col])
+        for start in range(0, codes.max() + 1 if len(codes) else 0, chunksize):
+            rows = (codes >= start) & (codes < start + chunksize)
+            yield _reshape_mems(self.df[rows], schema, self.id_col, start_date_col)
+
+def mems_schema(columns):
+    '''
+    Index of the wide MEMS columns - one row per time column (MEMS_dateNNN_timeK), in the order
+    analysis.ipynb reshapes them, with its date column, MEMS day and that date's numtimes, interval
+    and withinrange columns (None where there isn't one - the first date never has an interval or withinrange)
+    '''
+    columns = list(columns)
+    present = set(columns)
+    time_cols = {}
+    for col in columns:
+        match = re.search(r'MEMS_(.+)_time\d$', col)
+        if match:
+            time_cols.setdefault(match.group(1), []).append(col)
+
+    rows = []
+    date_cols = [col for col in columns if re.search(r'date\d{3}$', col)]
+    for i, date_col in enumerate(date_cols):
+        related = {suffix: 'MEMS_%s_%s' % (date_col, suffix) for suffix in ['numtimes', 'interval', 'withinrange']}
+        related = {suffix: col if col in present and (i > 0 or suffix == 'numtimes') else None 
+                   for suffix, col in related.items()}
+        for time_col in time_cols.get(date_col, []):
+            day = int(re.sub(r'_time\d*$', '', time_col.split('MEMS_date')[1]))
+            rows.append({'date': date_col, 'time': time_col, 'MEMS_day': day, **related})
+    return pd.DataFrame(rows, columns=['date', 'time', 'MEMS_day', 'numtimes', 'interval', 'withinrange'])
+
 def build_df_from_feature_categories(df, feat_categories, id_col):
     # Note - will fail if col(s) not in df
     return df[[id_col] + list(itertools.chain(*[v for k,v in feat_categories.items()]))]
@@ -103,6 +205,60 @@ def __repr__(self):
         f'Number of candidate features: { n_cand_feats }'
     ])
 
+def _reshape_mems(df, schema, id_col, start_date_col):
+    ''' Long-form events of df's MEMS columns (see Dataset.to_events) '''
+    n = len(df)
+
+    def block(cols, pos=None):
+        ''' Values of a column for each schema row (NaN where there's none), stacked column by column -
+            only at positions pos of the stack, if given '''
+        names = list(dict.fromkeys(col for col in cols if col is not None))
+        values = np.column_stack([df[names].to_numpy(object), np.full(n, np.nan, dtype=object)])
+        idx = np.array([names.index(col) if col is not None else len(names) for col in cols], dtype=np.int64)
+        if pos is None:
+            return values.T[idx].ravel()
+        return values[pos % max(n, 1), idx[pos // max(n, 1)]]
+
+    # Only rows with a date after the start date are kept, so parse the dates first
+    dates = block(schema['date'])
+    date = _parse_unique(dates, lambda values: pd.to_datetime(values, errors='coerce'))
+    start = np.tile(pd.to_datetime(df[start_date_col], errors='coerce').to_numpy(), len(schema))
+    pos = np.flatnonzero(~np.isnat(date) & (start < date))
+    dates, date, start = dates[pos], date[pos], start[pos]
+
+    times = block(schema['time'], pos)
+    time = _parse_unique(times, lambda values: pd.to_datetime(values, format=MEMS_TIME_FORMAT, errors='coerce'),
+                         strict=True)
+    strict_date = _parse_unique(dates, lambda values: pd.to_datetime(values, format=MEMS_DATE_FORMAT, 
+                                                                      errors='coerce'), strict=True)
+
+    events = pd.DataFrame({
+        id_col: df[id_col].to_numpy()[pos % max(n, 1)],
+        start_date_col: start,
+        'date': date,
+        'num_times_used_today': pd.Series(block(schema['numtimes'], pos)).fillna(0).astype(int),
+        'MEMS_day': schema['MEMS_day'].to_numpy()[pos // max(n, 1)],
+        'time': times,
+        'interval': _parse_unique(block(schema['interval'], pos), pd.to_timedelta),
+        'withinrange': pd.Series(block(schema['withinrange'], pos)).fillna(0).astype(int),
+        # Times are parsed as on 1900-01-01, as strptime does
+        'datetime': strict_date + (time - np.datetime64('1900-01-01')),
+    })
+    return events.drop_duplicates().reset_index(drop=True)
+
+def _parse_unique(values, parse, strict=False):
+    ''' parse (to datetimes or timedeltas) applied to each distinct value once, NaT for missing values 
+        (and, if strict, for any that aren't strings) '''
+    codes, uniques = pd.factorize(values)
+    if strict:
+        uniques = np.array([value if isinstance(value, str) else np.nan for value in uniques], dtype=object)
+    parsed = np.asarray(parse(pd.Index(uniques, dtype=object)))
+    if parsed.dtype.kind not in 'mM':
+        parsed = parsed.astype('datetime64[ns]')
+    res = parsed[codes]
+    res[codes < 0] = np.datetime64('NaT') if res.dtype.kind == 'M' else np.timedelta64('NaT')
+    return res
+
 def binarize_col(x):
     try:
         ''' try casting to int - if the column has mixed strings and numbers, this will fail for both
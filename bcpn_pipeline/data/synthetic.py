@@ -0,0 +1,234 @@
+import numpy as np
+import pandas as pd
+
+from ..consts import RENAMINGS, CODEBOOK, SCORES, SCORE_PREFIXES
+
+DATE_FORMAT = '%m/%d/%Y'
+TIME_FORMAT = '%H:%M:%S'
+SECONDS_IN_DAY = 86400
+
+class SyntheticCohort:
+    '''
+    A seeded, simulated cohort of MEMS (smart pill bottle cap) users, for exercising and benchmarking
+    the pipeline at any scale without the study data.
+
+    Each participant has a habitual dosing hour and an adherence propensity that drifts over the study,
+    and may drop out early. Every day, they open the cap up to max_times times - usually once,
+    near their habitual hour. The same simulation can be rendered as:
+
+        to_wide() - a wide export in the same layout as the study CSV (final_merged_set_v6.csv): one row
+            per participant, with dateNNN, MEMS_dateNNN_timeK, MEMS_dateNNN_numtimes, MEMS_dateNNN_interval
+            and MEMS_dateNNN_withinrange columns for every study day, plus demographic, medical record
+            and score columns named as in consts (so Dataset.clean runs as in analysis.ipynb)
+
+        to_events() - the long-form MEMS events that analysis.ipynb reshapes the wide export into
+            (one row per cap opening, plus one row without a time for each day with fewer than
+            max_times openings), without going through the wide export
+
+    Args:
+        n_participants: Number of participants
+        n_days: Number of study days (at most 999, as in the dateNNN columns)
+        max_times: Maximum number of cap openings recorded per day (the K in MEMS_dateNNN_timeK)
+        seed: Seed for everything simulated - the same arguments always give the same cohort
+    '''
+    def __init__(self, n_participants=100, n_days=240, max_times=4, seed=0,
+                 start_date='2015-01-05', enroll_span_days=365, dropout_rate=0.2):
+        if not 1 < n_days <= 999:
+            raise ValueError('n_days must be between 2 and 999.')
+
+        self.n_participants = n_participants
+        self.n_days = n_days
+        self.max_times = max_times
+        self.seed = seed
+        self.start_date = pd.Timestamp(start_date)
+
+        rng = np.random.default_rng(seed)
+        n, d, k = n_participants, n_days, max_times
+
+        self.ids = np.arange(1, n + 1)
+        self.enroll_offset = rng.integers(0, enroll_span_days, size=n)
+
+        # Last study day of each participant - most finish, some drop out part way through
+        dropped = rng.random(n) < dropout_rate
+        self.last_day = np.where(dropped, rng.integers(d // 4, d, size=n), d)
+
+        # Daily probability of using the cap, drifting down (or up) over the study
+        propensity = rng.beta(5, 1.5, size=n)
+        drift = rng.normal(-0.15, 0.1, size=n)
+        days = np.arange(1, d + 1)
+        p_use = np.clip(propensity[:, None] + drift[:, None] * days[None, :] / d
+                        + rng.normal(0, 0.05, size=(n, d)), 0, 1)
+
+        active = days[None, :] <= self.last_day[:, None]
+        used = (rng.random((n, d)) < p_use) & active
+        extra = rng.binomial(k - 1, 0.08, size=(n, d))
+        self.num_times = np.where(used, 1 + extra, 0).astype(np.int8)
+        self.active = active
+
+        # Opening times (seconds since midnight), near each participant's habitual hour, in order within a day
+        habit = np.clip(rng.normal(13, 4, size=n), 0.5, 23.5) * 3600
+        spread = rng.uniform(0.25, 2, size=n) * 3600
+        times = habit[:, None, None] + spread[:, None, None] * rng.standard_normal((n, d, k))
+        times = np.sort(np.clip(times, 0, SECONDS_IN_DAY - 1).astype(np.int32), axis=2)
+        slot = np.arange(k)[None, None, :]
+        self.times = np.where(slot < self.num_times[:, :, None], times, -1) # -1 where there was no opening
+
+        # Within range - the first opening was within 2 hours of the habitual hour
+        self.within_range = (used & (np.abs(times[:, :, 0] - habit[:, None]) <= 2 * 3600)).astype(np.int8)
+
+        # Interval - time since the previous opening (on an earlier day), for days with an opening
+        first = np.arange(d)[None, :] * SECONDS_IN_DAY + np.where(used, self.times[:, :, 0], 0)
+        last = np.arange(d)[None, :] * SECONDS_IN_DAY + self.times.max(axis=2)
+        last = np.where(used, last, -1)
+        prev_last = np.maximum.accumulate(np.concatenate([np.full((n, 1), -1), last[:, :-1]], axis=1), axis=1)
+        self.interval = np.where(used & (prev_last >= 0), first - prev_last, -1) # Seconds, -1 for none
+
+        self._static = _simulate_static(rng, n)
+
+    def enroll_dates(self):
+        return self.start_date + pd.to_timedelta(self.enroll_offset, unit='D')
+
+    def to_wide(self):
+        ''' The cohort as a wide export, laid out like the study CSV (all MEMS values as strings, as read_csv
+            gives them - dates as %m/%d/%Y and times as %H:%M:%S) '''
+        n, d = self.n_participants, self.n_days
+        enroll = self.enroll_offset
+
+        # Every distinct date, time and interval is formatted once, and shared by every cell that has it
+        date_codes = np.arange(enroll.max() + d + 1)
+        date_strs = _lookup(self.start_date + pd.to_timedelta(date_codes, unit='D'), DATE_FORMAT)
+        time_strs = _lookup(pd.Timestamp(0) + pd.to_timedelta(np.arange(SECONDS_IN_DAY), unit='s'), TIME_FORMAT)
+
+        intervals, interval_codes = np.unique(self.interval, return_inverse=True)
+        interval_codes = interval_codes.reshape(self.interval.shape)
+        interval_strs = np.array([str(pd.Timedelta(seconds=int(s))) if s >= 0 else np.nan for s in intervals],
+                                 dtype=object)
+
+        cols = {'PtID': self.ids, 'DateEnroll': date_strs[enroll]}
+        for day in range(d):
+            active = self.active[:, day]
+            name = f'date{day + 1:03d}'
+            cols[name] = np.where(active, date_strs[enroll + day + 1], np.nan)
+
+            for t in range(self.max_times):
+                times = self.times[:, day, t]
+                cols[f'MEMS_{name}_time{t + 1}'] = np.where(times >= 0, time_strs[np.maximum(times, 0)], np.nan)
+
+            cols[f'MEMS_{name}_numtimes'] = np.where(active, self.num_times[:, day], np.nan)
+
+            # The first day doesn't have an interval or within range column
+            if day > 0:
+                cols[f'MEMS_{name}_interval'] = interval_strs[interval_codes[:, day]]
+                cols[f'MEMS_{name}_withinrange'] = np.where(active, self.within_range[:, day], np.nan)
+
+        wide = pd.DataFrame(cols)
+        return pd.concat([wide, self._static], axis=1)
+
+    def to_events(self):
+        '''
+        The cohort as long-form MEMS events, as analysis.ipynb gets them from the wide export: one row
+        per opening, plus one row without a time for each day with fewer than max_times openings
+        (the empty time columns), ordered by day, then time column, then participant. As there, repeated
+        rows (openings in the same second) are dropped.
+        '''
+        n, d, k = self.n_participants, self.n_days, self.max_times
+
+        # Row for each (participant, day, slot) that's kept - an opening, or the first empty slot of a day.
+        # Openings in the same second as the one before are dropped, as the rows would be duplicates
+        slot = np.arange(k)[None, None, :]
+        num_times = self.num_times[:, :, None]
+        repeated = np.zeros_like(self.times, dtype=bool)
+        repeated[:, :, 1:] = (self.times[:, :, 1:] == self.times[:, :, :-1]) & (self.times[:, :, 1:] >= 0)
+        keep = ((slot < num_times) | (slot == num_times)) & self.active[:, :, None] & ~repeated
+        pt, day, t = np.nonzero(keep)
+        order = np.lexsort((pt, t, day))
+        pt, day, t = pt[order], day[order], t[order]
+
+        enroll = self.enroll_dates().to_numpy()
+        date = enroll[pt] + (day + 1).astype('timedelta64[D]')
+        seconds = self.times[pt, day, t]
+        has_time = seconds >= 0
+
+        time_strs = _lookup(pd.Timestamp(0) + pd.to_timedelta(np.arange(SECONDS_IN_DAY), unit='s'), TIME_FORMAT)
+        interval = self.interval[pt, day]
+
+        events = pd.DataFrame({
+            'PtID': self.ids[pt],
+            'DateEnroll': enroll[pt],
+            'date': date,
+            'num_times_used_today': self.num_times[pt, day].astype(int),
+            'MEMS_day': day + 1,
+            'time': np.where(has_time, time_strs[np.maximum(seconds, 0)], np.nan),
+            'interval': _seconds_or_nat(interval),
+            'withinrange': np.where(day > 0, self.within_range[pt, day], 0).astype(int),
+            'datetime': date.astype('datetime64[ns]') + _seconds_or_nat(seconds),
+        })
+        return events
+
+    def __repr__(self):
+        return '\n'.join([
+            f'Synthetic cohort: {self.n_participants} participants, {self.n_days} days, seed {self.seed}',
+            f'MEMS openings: {int(self.num_times.sum())}'
+        ])
+
+def _lookup(values, fmt):
+    ''' Formatted strings of values, as an object array to index into '''
+    return np.asarray(pd.Index(values).strftime(fmt), dtype=object)
+
+def _seconds_or_nat(seconds):
+    ''' Seconds as timedelta64[ns], NaT where negative (none) '''
+    res = seconds.astype('timedelta64[s]').astype('timedelta64[ns]')
+    res[seconds < 0] = np.timedelta64('NaT')
+    return res
+
+def _simulate_static(rng, n):
+    ''' Demographic, medical record and score columns, named as in the study CSV '''
+    cols = {}
+
+    codes = {'EDU_RECODE': 'education', 'Country': 'birth_country', 'A_DEMO5': 'marital_status',
+             'A_DEMO6': 'employment', 'A_DEMO8': 'income', 'A_DEMO11': 'primary_language',
+             'stage_recoded': 'stage'}
+    for col, category in codes.items():
+        cols[col] = rng.choice(list(CODEBOOK[category].keys()), size=n)
+
+    cols['A_DEMO1'] = rng.integers(30, 80, size=n) # Age
+    cols['A_DEMO10'] = rng.integers(0, 50, size=n)
+    cols['A_DEMO_12'] = rng.integers(1, 8, size=n)
+    for col in ['A_DEMO2', 'A_DEMO13YN', 'A_MR1']:
+        cols[col] = rng.integers(0, 2, size=n)
+
+    # Race is one-hot encoded, with a freetext "other"
+    race_cols = ['A_DEMO31', 'A_DEMO32', 'A_DEMO33', 'A_DEMO34', 'A_DEMO35', 'A_DEMO37', 'A_DEMO38']
+    race = rng.choice(len(race_cols) + 1, size=n, p=[0.5, 0.2, 0.1, 0.02, 0.03, 0.02, 0.03, 0.1])
+    for i, col in enumerate(race_cols):
+        cols[col] = (race == i).astype(int)
+    cols['A_DEMO36'] = np.where(race == len(race_cols), 'Other race', np.nan)
+
+    for i in range(1, 4):
+        cols[f'A_DEMO13DRUG{i}'] = np.where(rng.random(n) < 0.5 / i, f'Drug {i}', np.nan)
+
+    medical = [col for col in RENAMINGS['medical'] if col not in cols and col != 'A_MR3']
+    for col in medical:
+        cols[col] = (rng.random(n) < 0.15).astype(int)
+    cols['A_MR3'] = np.full(n, '01/01/2014', dtype=object) # Diagnosis date, dropped on cleaning
+    cols['early_late'] = rng.integers(0, 2, size=n)
+    cols['diagtoenroll'] = rng.integers(10, 2000, size=n)
+
+    # Scores at each time point - item responses, or precalculated totals
+    for score in SCORES.values():
+        n_items = max(1, score['max_val'] // 5)
+        for prefix in SCORE_PREFIXES:
+            if score['precalculated']:
+                cols[prefix + score['suffix']] = rng.integers(0, score['max_val'] + 1, size=n)
+            else:
+                for item in range(1, n_items + 1):
+                    cols[f'{prefix}{score["suffix"]}{item}'] = rng.integers(0, 6, size=n)
+
+    # Columns dropped on cleaning
+    cols['A_BCPT1YN'] = rng.integers(0, 2, size=n)
+    cols['A_BCPT1O'] = np.where(rng.random(n) < 0.1, 'Other symptom', np.nan)
+    cols['Staff_Name'] = rng.choice(['Staff A', 'Staff B', 'Staff C'], size=n)
+    cols['MemsNum'] = rng.integers(1000, 9999, size=n)
+    cols['Monitor'] = rng.integers(0, 3, size=n)
+
+    return pd.DataFrame(cols)
@@ -1,3 +1,6 @@
+from .aggregate import *
 from .common import *
 from .extract import *
 from .featureset import *
+from .online import *
+from .shared import *
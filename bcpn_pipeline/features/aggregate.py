@@ -0,0 +1,233 @@
+import numpy as np
+import pandas as pd
+
+from ..consts import SECONDS_IN_HOUR, TARGET_HORIZONS
+
+NS_IN_HOUR = 3600 * 10**9
+NS_IN_DAY = 24 * NS_IN_HOUR
+_NAT = np.iinfo(np.int64).min # A missing datetime, as int64 nanoseconds
+
+class Moments:
+    '''
+    Count, sum and sum of squared deviations (from the mean) of the values in each of a set of groups.
+
+    Mergeable - the moments of groups of groups follow from theirs alone (see merge), without
+    revisiting the values, so daily moments can be rolled up into weeks, months, etc.
+    '''
+    def __init__(self, count, total, m2):
+        self.count = count
+        self.total = total
+        self.m2 = m2
+
+    @classmethod
+    def of(cls, values, groups, n_groups):
+        ''' Moments of values in each group (0 to n_groups - 1) '''
+        count = np.bincount(groups, minlength=n_groups).astype(np.float64)
+        total = np.bincount(groups, values, minlength=n_groups)
+        mean = _divide(total, count)
+        m2 = np.bincount(groups, (values - mean[groups]) ** 2, minlength=n_groups)
+        return cls(count, total, m2)
+
+    @classmethod
+    def concat(cls, moments):
+        return cls(*[np.concatenate([getattr(m, attr) for m in moments]) for attr in ['count', 'total', 'm2']])
+
+    def merge(self, groups, n_groups):
+        ''' Merge these moments into groups of them - the i-th into group groups[i] '''
+        count = np.bincount(groups, self.count, minlength=n_groups)
+        total = np.bincount(groups, self.total, minlength=n_groups)
+        shift = np.where(self.count > 0, _divide(self.total, self.count) - _divide(total, count)[groups], 0)
+        m2 = np.bincount(groups, self.m2 + self.count * shift ** 2, minlength=n_groups)
+        return Moments(count, total, m2)
+
+    def mean(self):
+        return _divide(self.total, self.count)
+
+    def std(self):
+        ''' Sample standard deviation, as pandas (NaN for fewer than 2 values) '''
+        return np.sqrt(_divide(self.m2, self.count - 1, self.count > 1))
+
+class EventStats:
+    '''
+    Sufficient statistics of the events in each segment (e.g., participant and day) - the moments
+    of their hours and of the time between consecutive events, and the first and last events' times,
+    to bridge segments when they're merged.
+    '''
+    def __init__(self, hours, between, first, last):
+        self.hours = hours
+        self.between = between
+        self.first = first
+        self.last = last
+
+    @classmethod
+    def of(cls, ns, segments, starts):
+        '''
+        Args:
+            ns: Datetimes as int64 nanoseconds (_NAT for missing), with each segment's events contiguous,
+                in order
+            segments: Segment of each event
+            starts: Index of the first event of each segment
+        '''
+        n_segments = len(starts)
+        valid = ns != _NAT
+
+        hours = ((ns[valid] % NS_IN_DAY) // NS_IN_HOUR).astype(np.float64)
+        hours = Moments.of(hours, segments[valid], n_segments)
+
+        # Time between each event and the one before it - missing if either time is
+        pairs = (segments[1:] == segments[:-1]) & valid[1:] & valid[:-1]
+        between = (ns[1:] - ns[:-1])[pairs].astype(np.float64)
+        between = Moments.of(between, segments[1:][pairs], n_segments)
+
+        return cls(hours, between, ns[starts], ns[_ends(starts, len(ns))])
+
+    def merge(self, groups, n_groups):
+        '''
+        Merge consecutive segments into groups (e.g., days into weeks) - the i-th into group groups[i].
+        Segments must be in event order, each group's contiguous, as must their events.
+        '''
+        # Bridge each segment to the one before it in the same group - the time between the last event of one
+        # and the first of the next, unless either is missing
+        bridged = (groups[1:] == groups[:-1]) & (self.last[:-1] != _NAT) & (self.first[1:] != _NAT)
+        bridges = (self.first[1:] - self.last[:-1])[bridged].astype(np.float64)
+        bridges = Moments(np.ones(len(bridges)), bridges, np.zeros(len(bridges)))
+        between = Moments.concat([self.between, bridges]).merge(
+            np.concatenate([groups, groups[1:][bridged]]), n_groups)
+
+        starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]]) if len(groups) else groups
+        return EventStats(self.hours.merge(groups, n_groups), between, self.first[starts],
+                          self.last[_ends(starts, len(groups))])
+
+    def metrics(self):
+        ''' The standard temporal metrics (see calc_standard_temporal_metrics) of each segment, as columns '''
+        return {
+            'event_time_mean': np.floor(self.hours.mean()),
+            'event_time_std': np.floor(self.hours.std()),
+            'between_event_time_mean': np.floor(np.abs(_hours(self.between.mean()))),
+            'between_event_time_std': np.floor(_hours(self.between.std()))
+        }
+
+def calc_horizon_metrics(df, id_col, datetime_col, horizons=None, day_col='study_day', sums=None, daily_max_sums=None):
+    '''
+    Standard temporal metrics (see calc_standard_temporal_metrics) by participant and each horizon at once.
+
+    Events are sorted by participant and day once, and summarized for each day with vectorized segment
+    reductions. Coarser horizons (e.g., study_week, study_month) are rolled up from the days, rather than from
+    the events again. Each participant's events are taken in day order, and within a day, in the order of df
+    (the same as calc_standard_temporal_metrics for a df in day order, as it is after reshaping).
+
+    Args:
+        df: Events, with the participant id, datetime, day and horizon columns (see get_temporal_feats)
+        horizons: Columns to summarize by (with the participant id) - each must have a single value per day.
+            Defaults to the target horizons.
+        day_col: Column of each event's study day
+        sums: Columns to total within each horizon (e.g., num_times_used_today, for n_events)
+        daily_max_sums: Columns to take each day's maximum of, then total within each horizon
+            (e.g., withinrange, for the number of days on schedule)
+
+    Returns:
+        Dictionary of horizon -> DataFrame of the participant id, horizon, metrics and totals, in the same
+        order as groupby
+    '''
+    horizons = list(TARGET_HORIZONS if horizons is None else horizons)
+    sums, daily_max_sums = list(sums or []), list(daily_max_sums or [])
+
+    # Sort once, by participant and day - each day's events are a contiguous segment
+    keys = [id_col, day_col] + [horizon for horizon in horizons if horizon != day_col]
+    order, segments, starts = _segment(df, [id_col, day_col], dropna=keys)
+    days = df[keys].iloc[order[starts]].reset_index(drop=True)
+    ids = days[id_col].to_numpy()
+    new_participant = ids[1:] != ids[:-1]
+
+    stats = EventStats.of(_to_ns(df[datetime_col])[order], segments, starts)
+    day_totals = {col: _segment_sum(_to_float(df[col])[order], segments, len(starts)) for col in sums}
+    day_totals.update({col: _segment_max(_to_float(df[col])[order], starts) for col in daily_max_sums})
+
+    res = {}
+    for horizon in horizons:
+        if horizon == day_col:
+            groups, n_groups, horizon_stats = np.arange(len(starts)), len(starts), stats
+        else:
+            # Days are in order within each participant, so each of their horizons starts where it changes
+            values = _to_float(days[horizon])
+            changed = np.diff(values) != 0
+            if np.any((np.diff(values) < 0) & ~new_participant):
+                raise ValueError(f'{horizon} must not decrease with {day_col}.')
+            groups = np.cumsum(np.r_[False, changed | new_participant])[:len(days)]
+            n_groups = groups[-1] + 1 if len(groups) else 0
+            horizon_stats = stats.merge(groups, n_groups)
+
+        first = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]]) if len(groups) else groups
+        out = days.loc[first, [id_col, horizon]].reset_index(drop=True)
+        for col, values in horizon_stats.metrics().items():
+            out[col] = values
+        for col, values in day_totals.items():
+            out[col] = np.bincount(groups, values, minlength=n_groups) if horizon != day_col else values
+            if col in sums and df[col].dtype.kind in 'iub':
+                out[col] = out[col].astype(np.int64)
+        res[horizon] = out.fillna(0)
+    return res
+
+def calc_segment_metrics(df, groupby_cols, datetime_col):
+    ''' Standard temporal metrics of each group of events (see calc_standard_temporal_metrics), with one
+        stable sort and vectorized segment reductions '''
+    order, segments, starts = _segment(df, groupby_cols)
+    stats = EventStats.of(_to_ns(df[datetime_col])[order], segments, starts)
+    res = df.iloc[order[starts]][groupby_cols].reset_index(drop=True)
+    for col, values in stats.metrics().items():
+        res[col] = values
+    return res.fillna(0)
+
+def _segment(df, cols, dropna=None):
+    '''
+    Stably sort df by cols, dropping rows where any of cols (or dropna, if given) is missing, as groupby does.
+
+    Returns:
+        Order of the (kept) rows, segment of each in that order, and the start of each segment
+    '''
+    keep = df[dropna or cols].notna().all(axis=1).to_numpy()
+    codes = _group_codes([df[col][keep] for col in cols])
+    order = np.flatnonzero(keep)[np.argsort(codes, kind='stable')]
+    codes = np.sort(codes, kind='stable')
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else codes
+    segments = np.cumsum(np.r_[False, codes[1:] != codes[:-1]]) if len(codes) else codes
+    return order, segments, starts
+
+def _group_codes(cols):
+    ''' Code of each row's group (the combination of its values in cols), in sorted order of the values '''
+    codes = np.zeros(len(cols[0]), dtype=np.int64)
+    for col in cols:
+        col_codes, uniques = pd.factorize(col, sort=True)
+        codes = codes * len(uniques) + col_codes
+    return codes
+
+def _ends(starts, n):
+    ''' Index of the last row of each segment, given where each starts '''
+    return np.append(starts[1:], n)[:len(starts)] - 1
+
+def _to_ns(col):
+    ''' A datetime column as int64 nanoseconds (in local time) - _NAT where it's missing '''
+    col = pd.to_datetime(col)
+    if col.dt.tz is not None:
+        col = col.dt.tz_localize(None)
+    return col.to_numpy('datetime64[ns]').view(np.int64)
+
+def _to_float(col):
+    return col.to_numpy(np.float64, na_value=np.nan)
+
+def _segment_sum(values, segments, n_segments):
+    return np.bincount(segments, np.nan_to_num(values), minlength=n_segments)
+
+def _segment_max(values, starts):
+    return np.fmax.reduceat(values, starts) if len(starts) else values[:0]
+
+def _divide(a, b, where=None):
+    where = b > 0 if where is None else where
+    return np.divide(a, b, out=np.full(np.shape(a), np.nan), where=where)
+
+def _hours(ns):
+    ''' Nanoseconds (truncated to whole nanoseconds, as Timedeltas) in hours, via Timedelta.total_seconds '''
+    missing = np.isnan(ns)
+    us = np.where(missing, 0, np.trunc(ns)).astype(np.int64) // 1000
+    seconds = (us // 10**6).astype(np.float64) + (us % 10**6) / 1e6
+    return np.where(missing, np.nan, seconds / SECONDS_IN_HOUR)
@@ -1,8 +1,9 @@
 import pandas as pd
-from sklearn.experimental import enable_iterative_imputer
-from sklearn.impute import IterativeImputer
 
 def impute(df, id_col, numerics, categoricals=None):
+    from sklearn.experimental import enable_iterative_imputer
+    from sklearn.impute import IterativeImputer
+
     if categoricals:
         numerics = list(set(numerics) - set(categoricals))
         for col in categoricals:
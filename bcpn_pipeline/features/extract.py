@@ -7,7 +7,11 @@ import numpy as np
 import pandas as pd
 import datetime
 
-from ..consts import DAYS_IN_WEEK
+from ..consts import TARGET_HORIZONS, HORIZON_DAYS, TIME_OF_DAY_PROPS
+from .aggregate import NS_IN_HOUR, NS_IN_DAY, _NAT, _to_ns, calc_segment_metrics
+
+DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+_DAY_NAME_CODES = np.array([sorted(DAY_NAMES).index(day) for day in DAY_NAMES])
     
 def reset_index(df):
     """
@@ -72,7 +76,7 @@ def mean_days_between_dates(x):
     else:
         return np.NaN
 
-def get_temporal_feats(df, start_date_col, id_col, time_of_day_props):
+def get_temporal_feats(df, start_date_col, id_col, time_of_day_props=TIME_OF_DAY_PROPS, horizons=None):
     '''
         Extracts common temporal features of interest (day, week, month, time of day, etc)
         
@@ -88,31 +92,61 @@ def get_temporal_feats(df, start_date_col, id_col, time_of_day_props):
                 Example: An array [-1, 5, 23] creates two time divisions, where `datetime`s with hour between 0 (12am) and 5 (5am) are in one "time of day" bin, and `datetime`s with hour between 5 (5:01am) and 23 (11:59pm) are in another "time of day" bin.
                                         
             time_of_day_props (optional):
-    
+
+            horizons (optional): Study time horizons to add - each the number of whole horizons (see consts.HORIZON_DAYS)
+                between the start date and the date. Defaults to the target horizons and every other horizon
+                with a length (e.g. study_month, for the washout period).
+
+        Every feature is computed in a single pass over the dates and datetimes as int64 nanoseconds, and stored
+        compactly - as int8/int16 (float64, with NaNs, where there's a missing date or time) or categoricals.
     '''
-    df['hour'] = df['datetime'].dt.hour
+    if horizons is None:
+        horizons = list(dict.fromkeys(TARGET_HORIZONS + list(HORIZON_DAYS)))
+    unknown = [horizon for horizon in horizons if horizon not in HORIZON_DAYS]
+    if unknown:
+        raise ValueError(f'No length in consts.HORIZON_DAYS for horizons {unknown}.')
+
+    datetimes, dates, start = _to_ns(df['datetime']), _to_ns(df['date']), _to_ns(df[start_date_col])
+    has_time, has_date, has_start = datetimes != _NAT, dates != _NAT, start != _NAT
+
+    hour = (datetimes % NS_IN_DAY) // NS_IN_HOUR
+    df['hour'] = _compact(hour, has_time, np.int8)
 
     if time_of_day_props:
-        df['time_of_day'] = pd.cut(df['datetime'].dt.hour, time_of_day_props['bins'], labels=time_of_day_props['labels'])
-
-    df['is_weekday'] = df['datetime'].apply(
-        lambda x: 1 if x.day_name() != "Saturday" and x.day_name() != "Sunday" else 0
-    )
-                                      
-    df['study_day'] = (df['date'] - df[start_date_col]).dt.days
-    df['day_of_week'] = df['date'].dt.day_name()
-    df['study_week'] = np.floor((df['date']- df[start_date_col]).dt.days / DAYS_IN_WEEK)
-    
-    # Estimate of month
-    df['study_month'] = np.floor((df['date']- df[start_date_col]) / np.timedelta64(1, 'M'))
-    
-    for col in ['time_of_day', 'day_of_week']:
-        
-        # Explicitly set dtype
-        df[col] = df[col].astype('category') 
+        # Bins are right-inclusive, as in pd.cut - (-1, 6] is the first
+        bins, labels = time_of_day_props['bins'], time_of_day_props['labels']
+        codes = np.searchsorted(bins, hour, side='left') - 1
+        codes[~has_time | (codes >= len(labels))] = -1
+        df['time_of_day'] = pd.Categorical.from_codes(codes, categories=labels, ordered=True)
+
+    # Events without a time count as on a weekday, as they always have
+    df['is_weekday'] = ((_weekday(datetimes) < 5) | ~has_time).astype(np.int8)
+
+    # Day names, in the (alphabetical) order astype('category') gives them
+    codes = _DAY_NAME_CODES[_weekday(dates)]
+    codes[~has_date] = -1
+    df['day_of_week'] = pd.Categorical.from_codes(codes, categories=sorted(DAY_NAMES)).remove_unused_categories()
+
+    # Study time, in whole horizons since the start date
+    elapsed = dates - start
+    has_elapsed = has_date & has_start
+    for horizon in horizons:
+        length = round(HORIZON_DAYS[horizon] * NS_IN_DAY)
+        df[horizon] = _compact(np.floor_divide(elapsed, length), has_elapsed, np.int16)
 
     return df
 
+def _weekday(ns):
+    ''' Day of the week (Monday is 0) of int64 nanoseconds - 1970-01-01 was a Thursday '''
+    return (ns // NS_IN_DAY + 3) % 7
+
+def _compact(values, valid, dtype):
+    ''' values as dtype, or as float64 (NaN where not valid) if any aren't - not a nullable integer
+        dtype, since downstream code (e.g., LagCube) converts these columns to float arrays '''
+    if valid.all():
+        return values.astype(dtype)
+    return np.where(valid, values, np.nan)
+
 def calc_standard_static_metrics(df, cols, col_prefix):
     
     df[col_prefix + 'mean'] = df[cols].mean(axis=1)
@@ -124,34 +158,7 @@ def calc_standard_static_metrics(df, cols, col_prefix):
     return df, newcols
 
 def calc_standard_temporal_metrics(df, groupby_cols, datetime_col):
-    # TODO: Move to consts
-    SECONDS_IN_HOUR = 3600.0
-    
-    res = df.groupby(groupby_cols).agg(
-        event_time_mean=(
-            datetime_col, 
-            lambda x: np.floor(
-                x.dt.hour.mean()
-            )
-        ),
-        event_time_std=(
-            datetime_col, 
-            lambda x: np.floor(
-                x.dt.hour.std()
-            )
-        ),
-        between_event_time_mean=(
-            datetime_col, 
-            lambda x: np.floor(
-                abs(x.diff().mean().total_seconds() / SECONDS_IN_HOUR)
-            )
-        ),
-        between_event_time_std= (
-            datetime_col, 
-            lambda x: np.floor(
-                x.diff().std().total_seconds() / SECONDS_IN_HOUR
-            )
-        )
-    ).reset_index().fillna(0)
-    return res
-    
\ No newline at end of file
+    ''' Mean and standard deviation of the hour of each group's events, and of the time between consecutive
+        events (in hours), each floored - see calc_segment_metrics, and calc_horizon_metrics for several
+        horizons at once '''
+    return calc_segment_metrics(df, groupby_cols, datetime_col)
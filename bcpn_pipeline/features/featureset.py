@@ -1,9 +1,11 @@
+import hashlib
 import numpy as np
 import pandas as pd
 from itertools import compress
 
-from ..models.predict import predict
 from ..consts import TARGET_HORIZONS
+from .shared import SharedFeatures
+from .. import profiling
 
 class Featureset:
     def __init__(self, df, name, id_col, nominal_cols=None, target_col=None, horizon=None, n_lags=None):
@@ -19,6 +21,9 @@ class Featureset:
         self.nominal_cols = []
         if nominal_cols:
             self.nominal_cols += nominal_cols
+
+        # Optional cache of precomputed lags (see build_lag_cube)
+        self.lag_cube = None
         
     def prune_nominals(self):
         print('Pruning the nominal columns.')
@@ -48,32 +53,11 @@ class Featureset:
     def get_lagged_featureset(self, n_lags):
         print('Getting lagged features.')
         '''Generate lagged observations for temporal data, for each subject '''
-        rows = []
-
-        for unique_id in self.df[self.id_col].unique(): 
-
-            # Filter by subject
-            subset = self.df[self.df[self.id_col] == unique_id]
-
-            # Sort by horizon
-            subset.sort_values(by=self.horizon, ascending=True)
-
-            # Get features as supervised learning df
-            # Temporal features will be lagged by a window of size 3
-            agg = series_to_supervised(subset.iloc[:, 1:], time_col = self.horizon, target_col = self.target_col, 
-                                       n_in=n_lags, n_out=1) 
-
-            # Be sure to add the unique id column back in, at the very beginning
-            agg.insert(0, self.id_col, unique_id)
-
-            # Add to list of dfs to concatenate together
-            rows.append(agg)
-
-        # Get all subjects' lagged features together
-        res = pd.concat(rows, axis=0)
-        
-        # Be sure to reset the index!
-        res = res.reset_index(drop=True)
+        if self.lag_cube is not None and n_lags <= self.lag_cube.max_lags:
+            res = self.lag_cube.get(n_lags)
+        else:
+            res = grouped_series_to_supervised(self.df, id_col=self.id_col, time_col=self.horizon, 
+                                               target_col=self.target_col, n_in=n_lags)
         
         # Finally, get a new list of nominal feats that mirrors the lagged structure
         mask = [any(col_og in col for col_og in self.nominal_cols) for col in res.columns]
@@ -82,6 +66,22 @@ class Featureset:
 
         return Featureset(df=res, name=self.name, nominal_cols=nominal_cols, 
                           id_col=self.id_col, target_col=self.target_col, n_lags=n_lags)
+
+    @profiling.timed()
+    def build_lag_cube(self, max_lags, reduce_collinearity=False):
+        '''Encode the featureset and materialize lags 1..max_lags once, so that 
+        prep_for_modeling can slice out any n_lags <= max_lags without rebuilding them '''
+        print('Building lag cube for up to %i lags.' % max_lags)
+        self.one_hot_encode()
+
+        if reduce_collinearity:
+            self.handle_multicollinearity()
+
+        self.lag_cube = LagCube(self.df, id_col=self.id_col, time_col=self.horizon, 
+                                target_col=self.target_col, max_lags=max_lags)
+
+    def drop_lag_cube(self):
+        self.lag_cube = None
     
     def handle_multicollinearity(self):
         print('Handling multicollinearity...')
@@ -105,14 +105,18 @@ class Featureset:
 
         self.prune_nominals()
 
+    @profiling.timed()
     def prep_for_modeling(self, n_lags=None, reduce_collinearity=False):
         print('Preparing feature set for modeling.')
+
+        # Lags will be sliced from an already encoded lag cube - no need to redo any of this
+        if not (n_lags and self.lag_cube is not None and n_lags <= self.lag_cube.max_lags):
     
-        # One hot encode categoricals
-        self.one_hot_encode()
-        
-        if reduce_collinearity:
-            self.handle_multicollinearity()
+            # One hot encode categoricals
+            self.one_hot_encode()
+            
+            if reduce_collinearity:
+                self.handle_multicollinearity()
 
         # If this is a temporal fs
         if n_lags:
@@ -132,6 +136,21 @@ class Featureset:
 
         return fs
 
+    def to_shared(self, dtype=np.float64, path=None):
+        '''Export the numeric columns as one contiguous block in shared memory (or a memory-mapped
+        .npy at path), so parallel workers can read them without their own copy of the df.
+        The caller owns the block - use the result as a context manager, or call unlink() '''
+        return SharedFeatures.create(self.df, id_col=self.id_col, target_col=self.target_col, 
+                                     nominal_cols=self.nominal_cols, dtype=dtype, path=path)
+
+    def fingerprint(self):
+        '''Hash of the featureset's contents, used to key cached per-fold artifacts and results'''
+        h = hashlib.sha1()
+        h.update(pd.util.hash_pandas_object(self.df, index=True).to_numpy().tobytes())
+        h.update(repr((list(self.df.columns), sorted(self.nominal_cols), self.id_col, 
+                       self.target_col, self.n_lags)).encode('utf-8'))
+        return h.hexdigest()
+
     def __repr__(self):    
         rep = '\n'.join([
             f'Name: { self.name }',
@@ -204,5 +223,114 @@ def series_to_supervised(df, time_col, target_col, n_in=1, n_out=1, dropnan=True
     return agg
 
 
-             
-             
+def grouped_series_to_supervised(df, id_col, time_col, target_col, n_in=1):
+    """
+    Vectorized, per-subject equivalent of calling series_to_supervised (with n_out=1 and
+    dropnan=True) on each subject's rows and concatenating the results.
+
+    Rows are sorted once by (subject, time_col), keeping subjects in order of first appearance.
+    Since a row survives the dropna only if the n_in rows before it belong to the same subject 
+    and contain no NaNs, each lag k is then just a take of the kept row positions minus k.
+    Only the columns series_to_supervised would keep are materialized.
+
+    Arguments:
+        df: A pandas DataFrame object, containing id_col and time_col.
+        id_col: Name of the subject id column.
+        time_col: Name of the horizon column (e.g. 'study_week'); used for sorting, then dropped.
+        target_col: Name of target var we want to predict later
+        n_in: Number of lag observations as input (X).
+    Returns:
+        Pandas DataFrame with the id column first, the (t-n) ... (t-1) columns, then the target.
+    """
+    df, pos, bad = _sort_by_subject(df, id_col, time_col)
+    idx = _kept_rows(pos, bad, n_in)
+    lag_cols, current_cols = _supervised_cols(df, id_col, time_col, target_col)
+
+    cols = {}
+    for i in range(n_in, 0, -1):
+        for col in lag_cols:
+            lagged = df[col].iloc[idx - i]
+            
+            # Shifting introduces NaNs, so these would have been upcast to float
+            if lagged.dtype.kind in 'biu':
+                lagged = lagged.astype(float)
+            cols['%s (t-%d)' % (col, i)] = lagged.to_numpy()
+
+    for col, name in current_cols.items():
+        cols[name] = df[col].iloc[idx].to_numpy()
+
+    res = pd.DataFrame(cols)
+    res.insert(0, id_col, df[id_col].iloc[idx].to_numpy())
+    return res
+
+class LagCube:
+    ''' Lags 1..max_lags of every feature, held compactly as the (rows, column) float64 array of the features
+    once - lag k of a kept row is just the row k before it, as in grouped_series_to_supervised - along with
+    the kept rows for each number of lags. The lag blocks for any n_lags <= max_lags are then gathered
+    with a single take into a new array. '''
+    def __init__(self, df, id_col, time_col, target_col, max_lags):
+        self.id_col = id_col
+        self.target_col = target_col
+        self.max_lags = max_lags
+
+        self.df, pos, bad = _sort_by_subject(df, id_col, time_col)
+        self.lag_cols, self.current_cols = _supervised_cols(self.df, id_col, time_col, target_col)
+        # Row-major, since lags are gathered by row (nullable integer columns included)
+        self.values = np.ascontiguousarray(self.df[self.lag_cols].to_numpy(dtype=float, na_value=np.nan))
+        self.kept = {n_lags: _kept_rows(pos, bad, n_lags) for n_lags in range(1, max_lags + 1)}
+
+    def get(self, n_lags):
+        ''' Get the supervised learning df for n_lags, matching grouped_series_to_supervised '''
+        if n_lags > self.max_lags:
+            raise ValueError('Lag cube only holds %d lags, but %d were requested.' % (self.max_lags, n_lags))
+
+        idx = self.kept[n_lags]
+
+        # Rows (t-n_lags) ... (t-1) of each kept row, flattened to (rows, n_lags * columns)
+        block = np.empty((idx.shape[0], n_lags, self.values.shape[1]))
+        np.take(self.values, idx[:, None] - np.arange(n_lags, 0, -1), axis=0, out=block, mode='clip') # In range, so no need to buffer for bounds errors
+        names = ['%s (t-%d)' % (col, i) for i in range(n_lags, 0, -1) for col in self.lag_cols]
+        res = pd.DataFrame(block.reshape(idx.shape[0], -1), columns=names)
+
+        for col, name in self.current_cols.items():
+            res[name] = self.df[col].iloc[idx].to_numpy()
+
+        res.insert(0, self.id_col, self.df[self.id_col].iloc[idx].to_numpy())
+        return res
+
+def _sort_by_subject(df, id_col, time_col):
+    ''' Sort once by subject (in order of first appearance), then by horizon.
+    Also returns each row's position within its subject's series and a prefix count
+    of rows containing NaNs, used to apply the dropna for any number of lags. '''
+    codes, _ = pd.factorize(df[id_col])
+    order = np.lexsort((df[time_col].to_numpy(), codes))
+    df = df.iloc[order]
+    codes = codes[order]
+
+    n_rows = df.shape[0]
+    starts = np.r_[0, np.flatnonzero(np.diff(codes)) + 1]
+    pos = np.arange(n_rows) - np.repeat(starts, np.diff(np.r_[starts, n_rows]))
+
+    feat_cols = [col for col in df.columns if col != id_col]
+    bad = np.r_[0, np.cumsum(df[feat_cols].isna().any(axis=1).to_numpy())]
+    return df, pos, bad
+
+def _kept_rows(pos, bad, n_in):
+    ''' Rows that are NaN-free, along with their n_in predecessors from the same subject '''
+    idx = np.arange(n_in, pos.shape[0])
+    idx = idx[pos[idx] >= n_in]
+    return idx[bad[idx + 1] == bad[idx - n_in]]
+
+def _supervised_cols(df, id_col, time_col, target_col):
+    ''' Mirror the column filtering in series_to_supervised: time columns are dropped, and
+    only target columns are retained at time t (with the (t) suffix dropped for the target) '''
+    feat_cols = [col for col in df.columns if col != id_col]
+    lag_cols = [col for col in feat_cols if time_col not in col]
+
+    current_cols = {}
+    for col in feat_cols:
+        name = '%s (t)' % col
+        if time_col in name or target_col not in name:
+            continue
+        current_cols[col] = target_col if col == target_col else name
+    return lag_cols, current_cols
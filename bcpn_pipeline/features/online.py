@@ -0,0 +1,245 @@
+from collections import deque
+from fractions import Fraction
+
+import numpy as np
+import pandas as pd
+
+from ..consts import DAYS_IN_WEEK, DAYS_IN_MONTH, TIME_OF_DAY_PROPS, ADHERENCE_THRESHOLD
+from .aggregate import EventStats, Moments, NS_IN_HOUR, NS_IN_DAY
+
+# Days each horizon's totals are averaged over, as in the temporal featuresets of analysis.ipynb
+HORIZON_DENOMS = {'study_week': DAYS_IN_WEEK, 'study_month': DAYS_IN_MONTH}
+
+class OnlineFeatures:
+    '''
+    Live temporal features of each participant, updated one MEMS event at a time.
+
+    Keeps the running totals of the participant's current horizon (e.g., study week), and the feature rows
+    of their last n_lags completed horizons in a ring buffer, so the lagged feature vector for the next
+    horizon is always at hand - the same vector (for the same events) as the row of
+    Featureset.prep_for_modeling(n_lags) for the temporal featuresets of analysis.ipynb. See check_online_parity.
+
+    Adding an event is O(1), as is closing a horizon - its statistics are kept as running sums (see _Horizon).
+
+    Events must arrive in the order of the batch frame (get_temporal_feats output) - by day, and within a day,
+    in time column order - for each participant, but participants may be interleaved.
+
+    Args:
+        n_lags: Number of completed horizons in each vector
+        horizon: Horizon column - study_week or study_month (the study_day featureset has different features)
+        cols: Names of the event fields, if they differ from the get_temporal_feats output (see update)
+    '''
+    def __init__(self, n_lags, horizon='study_week', id_col='PtID', time_of_day_labels=None,
+                 threshold=ADHERENCE_THRESHOLD, cols=None):
+        if horizon not in HORIZON_DENOMS:
+            raise ValueError(f'Online features are only kept for {list(HORIZON_DENOMS)}, not {horizon}.')
+
+        self.n_lags = n_lags
+        self.horizon = horizon
+        self.id_col = id_col
+        self.denom = HORIZON_DENOMS[horizon]
+        self.threshold = threshold
+        self.labels = list(time_of_day_labels or TIME_OF_DAY_PROPS['labels'])
+        self.cols = {'horizon': horizon, 'day': 'study_day', 'datetime': 'datetime',
+                     'n_used': 'num_times_used_today', 'withinrange': 'withinrange', 'time_of_day': 'time_of_day'}
+        self.cols.update(cols or {})
+
+        self.feature_names = [
+            'n_events', 'event_time_mean', 'event_time_std', 'between_event_time_mean', 'between_event_time_std',
+            'num_daily_events_mean', 'adherent'] + ['event_time_of_day_mode_' + label for label in self.labels]
+        self.participants = {}
+
+    def update(self, event):
+        '''
+        Add an event - a mapping (e.g., a dict, or a row of the get_temporal_feats output) with the participant
+        id, horizon, day, datetime (NaT for a day's empty time column), num_times_used_today, withinrange and
+        time_of_day.
+
+        Returns:
+            The feature row of the participant's horizon this event closed (if it's the first of the next one),
+            else None
+        '''
+        pid, horizon = event[self.id_col], event[self.cols['horizon']]
+        day = event[self.cols['day']]
+        if pd.isna(pid) or pd.isna(horizon) or pd.isna(day):
+            return None # As groupby drops them
+
+        state = self.participants.get(pid)
+        if state is None:
+            state = self.participants[pid] = _Participant(self.n_lags)
+
+        closed = None
+        if state.current is None or horizon != state.current.horizon:
+            if state.current is not None:
+                if horizon < state.current.horizon:
+                    raise ValueError(f'{self.cols["horizon"]} of participant {pid} went from '
+                                     f'{state.current.horizon} to {horizon}.')
+                closed = self._row(state.current)
+                state.rows.append(closed)
+            state.current = _Horizon(horizon, len(self.labels))
+
+        datetime = event[self.cols['datetime']]
+        time_of_day = event[self.cols['time_of_day']]
+        state.current.add(day, None if pd.isna(datetime) else pd.Timestamp(datetime).value,
+                          event[self.cols['n_used']], event[self.cols['withinrange']],
+                          None if pd.isna(time_of_day) else self.labels.index(time_of_day))
+        return closed
+
+    def update_frame(self, df):
+        ''' Add every event in df, in order '''
+        for event in df.to_dict('records'):
+            self.update(event)
+
+    def ready(self, pid):
+        ''' Whether the participant has n_lags completed horizons '''
+        state = self.participants.get(pid)
+        return state is not None and len(state.rows) == self.n_lags
+
+    def vector(self, pid, columns=None, include_current=False):
+        '''
+        Lagged feature vector of a participant, for predicting their next horizon - named as in
+        prep_for_modeling, from (t-n_lags) to (t-1).
+
+        Args:
+            columns: Columns to return, in order (e.g., those the model was trained on) - features the
+                featureset doesn't have (e.g., an unused time of day) are left out
+            include_current: Treat the horizon in progress as complete (its row is (t-1)), to score the one after it
+
+        Returns:
+            Series of the features, or None if the participant doesn't have n_lags horizons yet
+        '''
+        state = self.participants.get(pid)
+        if state is None:
+            return None
+        rows = list(state.rows)
+        if include_current and state.current is not None:
+            rows = (rows + [self._row(state.current)])[-self.n_lags:]
+        if len(rows) < self.n_lags:
+            return None
+
+        vector = {}
+        for i, row in zip(range(self.n_lags, 0, -1), rows):
+            for name, value in zip(self.feature_names, row):
+                vector['%s (t-%d)' % (name, i)] = value
+        vector = pd.Series(vector, dtype=float, name=pid)
+        return vector if columns is None else vector.reindex(columns)
+
+    def _row(self, current):
+        ''' Feature row of a horizon, as a tuple in the order of feature_names '''
+        mode = np.zeros(len(self.labels))
+        if any(current.tod_counts):
+            mode[current.tod_counts.index(max(current.tod_counts))] = 1 # Ties go to the earliest time of day
+
+        metrics = current.stats().metrics()
+        return (current.n_events,
+                *[0 if np.isnan(metrics[col][0]) else metrics[col][0] for col in self.feature_names[1:5]],
+                current.n_events / self.denom,
+                int(current.days_within() / self.denom > self.threshold),
+                *mode)
+
+class _Participant:
+    def __init__(self, n_lags):
+        self.rows = deque(maxlen=n_lags) # Feature rows of the last n_lags completed horizons
+        self.current = None
+
+class _Horizon:
+    '''
+    Running totals of the events of a participant's horizon so far. The hours and nanoseconds between events
+    are integers, so their count, sum and sum of squares are kept exactly (as Python ints), and the moments
+    follow from them correctly rounded - a per-event floating-point update (e.g., Welford's) can land a
+    standard deviation that's exactly an integer just under it, and flip the floored metric.
+    '''
+    def __init__(self, horizon, n_labels):
+        self.horizon = horizon
+        self.n_events = 0
+        self.hours = [0, 0, 0] # Count, sum and sum of squares
+        self.between = [0, 0, 0] # Of the nanoseconds between consecutive events
+        self.prev = None # Nanoseconds of the previous event, None if it had no time
+        self.tod_counts = [0] * n_labels
+        self.day = None
+        self.day_max = np.nan # Of withinrange, over the current day
+        self.within = 0 # Total of withinrange's daily max, over the days before the current one
+
+    def add(self, day, ns, n_used, withinrange, time_of_day):
+        if not pd.isna(n_used):
+            self.n_events += int(n_used)
+
+        if day != self.day:
+            self.within += 0 if np.isnan(self.day_max) else self.day_max
+            self.day, self.day_max = day, np.nan
+        if not pd.isna(withinrange):
+            self.day_max = np.fmax(self.day_max, withinrange)
+
+        if time_of_day is not None:
+            self.tod_counts[time_of_day] += 1
+
+        # Consecutive events are only paired if both have a time, as in calc_standard_temporal_metrics
+        if ns is not None:
+            _add(self.hours, (ns % NS_IN_DAY) // NS_IN_HOUR)
+            if self.prev is not None:
+                _add(self.between, ns - self.prev)
+        self.prev = ns
+
+    def stats(self):
+        return EventStats(_moments(*self.hours), _moments(*self.between), None, None)
+
+    def days_within(self):
+        return self.within + (0 if np.isnan(self.day_max) else self.day_max)
+
+def _add(sums, value):
+    value = int(value)
+    sums[0] += 1
+    sums[1] += value
+    sums[2] += value * value
+
+def _moments(count, total, total_sq):
+    ''' Moments (of a single group) from an exact count, sum and sum of squares '''
+    m2 = Fraction(count * total_sq - total * total, count) if count else 0
+    return Moments(np.array([count], dtype=np.float64), np.array([total], dtype=np.float64),
+                   np.array([m2], dtype=np.float64))
+
+def check_online_parity(horizons_df, fs, n_lags, rtol=1e-9, **kwargs):
+    '''
+    Replay the events of horizons_df through OnlineFeatures, and compare the vector it has at the start of each
+    horizon to the row of fs.prep_for_modeling(n_lags) for it.
+
+    Args:
+        horizons_df: The events fs was built from (get_temporal_feats output), in order
+        fs: The temporal Featureset built from them, as in analysis.ipynb (prepared in place)
+        kwargs: Passed to OnlineFeatures
+
+        rtol: Relative tolerance the values must match within (as np.isclose) - the online moments are
+            computed from running sums rather than two passes, so they may differ in the last bits
+
+    Returns:
+        DataFrame of the values that differ (participant, their row, column, batch and online values) -
+        empty if every vector matches
+    '''
+    store = OnlineFeatures(n_lags, horizon=fs.horizon, id_col=fs.id_col, **kwargs)
+    batch = fs.prep_for_modeling(n_lags).df
+    columns = [col for col in batch.columns if col not in [fs.id_col, fs.target_col]]
+
+    ids, online = [], []
+    for event in horizons_df.to_dict('records'):
+        pid = event[fs.id_col]
+        if store.update(event) is not None and store.ready(pid):
+            ids.append(pid)
+            online.append(store.vector(pid, columns=columns))
+
+    # Each participant's rows are in horizon order in both, so match them up by position
+    online = pd.DataFrame(online, columns=columns).assign(**{fs.id_col: ids})
+    keys = [fs.id_col, 'row']
+    batch = batch.assign(row=batch.groupby(fs.id_col).cumcount()).set_index(keys)[columns]
+    online = online.assign(row=online.groupby(fs.id_col).cumcount()).set_index(keys)[columns]
+    batch, online = batch.align(online, join='outer')
+
+    same = np.isclose(batch.to_numpy(float), online.to_numpy(float), rtol=rtol, atol=0, equal_nan=True)
+    rows, cols = np.nonzero(~same)
+    res = pd.DataFrame({fs.id_col: batch.index.get_level_values(0)[rows],
+                        'row': batch.index.get_level_values(1)[rows],
+                        'column': batch.columns[cols],
+                        'batch': batch.to_numpy(float)[rows, cols],
+                        'online': online.to_numpy(float)[rows, cols]})
+    print('Online features match the batch featureset.' if res.empty else
+          '%i of %i online feature values differ from the batch featureset.' % (len(res), same.size))
+    return res
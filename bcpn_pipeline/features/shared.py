@@ -0,0 +1,198 @@
+import uuid
+from multiprocessing import shared_memory
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Blocks attached by this process, keyed by shared memory name or .npy path,
+# so worker processes only attach once no matter how many tasks they run
+_ATTACHED = {}
+
+class SharedFeatures:
+    '''
+    Picklable handle to a featureset's numeric block, stored once as a single contiguous array
+    in shared memory (or in a memory-mapped .npy file, if a path is given).
+
+    Only the handle is sent to worker processes. Workers attach a zero-copy view of the block,
+    and materialize only the rows they need (e.g., a fold's training rows).
+
+    Column dtypes are recorded, so frames read back with a float64 block match the original
+    exactly. A float32 block halves memory but rounds non-integer values.
+    '''
+    def __init__(self, shape, dtype, columns, dtypes, id_col, target_col=None,
+                 nominal_cols=None, index=None, name=None, path=None):
+        self.shape = shape
+        self.dtype = dtype
+        self.columns = columns
+        self.dtypes = dtypes
+        self.id_col = id_col
+        self.target_col = target_col
+        self.nominal_cols = nominal_cols or []
+        self.index = index
+        self.name = name
+        self.path = path
+
+    @classmethod
+    def create(cls, df, id_col, target_col=None, nominal_cols=None, dtype=np.float64, path=None):
+        ''' Copy the numeric columns of df into a new shared block '''
+        df = df.select_dtypes(['number', 'bool'])
+        shape = df.shape
+        dtype = np.dtype(dtype).str
+
+        # Only store the index if it can't be rebuilt from row positions
+        index = None
+        if not df.index.equals(pd.RangeIndex(shape[0])):
+            index = df.index.to_numpy()
+
+        handle = cls(shape=shape, dtype=dtype, columns=list(df.columns),
+                     dtypes=[str(t) for t in df.dtypes], id_col=id_col, target_col=target_col,
+                     nominal_cols=[col for col in nominal_cols or [] if col in df.columns], index=index)
+
+        if path:
+            handle.path = str(path)
+            block = np.lib.format.open_memmap(handle.path, mode='w+', dtype=dtype, shape=shape)
+            block[:] = df.to_numpy(dtype=dtype)
+            block.flush()
+            del block
+        else:
+            nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+            shm = shared_memory.SharedMemory(name=f'bcpn_{uuid.uuid4().hex[:16]}', create=True, size=nbytes)
+            handle.name = shm.name
+            block = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            block[:] = df.to_numpy(dtype=dtype)
+            _ATTACHED[shm.name] = (shm, block)
+
+        return handle
+
+    def attach(self):
+        ''' Get a read-only, zero-copy view of the block '''
+        key = self.name or self.path
+        if key not in _ATTACHED:
+            if self.name:
+                shm = shared_memory.SharedMemory(name=self.name)
+                block = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+            else:
+                shm = None
+                block = np.load(self.path, mmap_mode='r')
+            _ATTACHED[key] = (shm, block)
+
+        block = _ATTACHED[key][1].view()
+        block.flags.writeable = False
+        return block
+
+    def get_frame(self, rows=None):
+        ''' Get a DataFrame of the given row positions (or all rows), with the original dtypes '''
+        block = self.attach()
+        values = block if rows is None else block[rows]
+
+        if self.index is not None:
+            index = self.index if rows is None else self.index[rows]
+        else:
+            index = pd.RangeIndex(self.shape[0]) if rows is None else rows
+
+        df = pd.DataFrame(values, index=index, columns=self.columns, copy=False)
+        return df.astype(dict(zip(self.columns, self.dtypes)))
+
+    def get_xy(self, rows=None):
+        ''' Get inputs and labels for the given row positions (or all rows) '''
+        X = self.get_frame(rows)
+        y = X.pop(self.target_col)
+        return X, y
+
+    def close(self):
+        ''' Detach this process from the block '''
+        key = self.name or self.path
+        shm, block = _ATTACHED.pop(key, (None, None))
+        del block
+        if shm is not None:
+            try:
+                shm.close()
+            except BufferError:
+                # Views are still alive somewhere - the mapping is released once they're gone
+                pass
+
+    def unlink(self):
+        ''' Free the block. Only the process that created it should call this. '''
+        self.close()
+        if self.name:
+            try:
+                shm = shared_memory.SharedMemory(name=self.name)
+                shm.close()
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+        elif self.path:
+            Path(self.path).unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.unlink()
+
+    def __repr__(self):
+        return '\n'.join([
+            f'Shared block: {self.name or self.path}',
+            f'Shape: {self.shape}',
+            f'Dtype: {np.dtype(self.dtype).name}'
+        ])
+
+class SharedFold:
+    '''
+    Picklable handle to a fold's imputed and upsampled data (as returned by models.impute_and_upsample),
+    stored as two SharedFeatures blocks - the training rows, with their labels, and the test rows, with theirs.
+
+    Workers each read the fold from shared memory, rather than getting a pickled copy of it with every
+    unit of work, and the process that created it doesn't need to keep the frames around.
+    '''
+    def __init__(self, train, test, id_col):
+        self.train = train
+        self.test = test
+        self.id_col = id_col
+
+    @classmethod
+    def create(cls, artifacts, id_col, path=None):
+        ''' Copy a fold's artifacts into new shared blocks (or memory-mapped .npy files, if path is a directory) '''
+        X_train, y_train, X_test, y_test = (artifacts[name] for name in ['X_train', 'y_train', 'X_test', 'y_test'])
+        target_col = y_test.name if y_test.name is not None and y_test.name not in X_test.columns else '__target__'
+        prefix = Path(path, uuid.uuid4().hex[:16]) if path else None
+
+        train = SharedFeatures.create(X_train.assign(**{target_col: np.asarray(y_train)}), id_col=id_col,
+                                      target_col=target_col, path=prefix and f'{prefix}_train.npy')
+        try:
+            test = SharedFeatures.create(X_test.assign(**{target_col: np.asarray(y_test)}), id_col=id_col,
+                                         target_col=target_col, path=prefix and f'{prefix}_test.npy')
+        except BaseException:
+            train.unlink()
+            raise
+        return cls(train, test, id_col)
+
+    @staticmethod
+    def can_share(artifacts):
+        ''' Whether every column of a fold's artifacts can be stored in a shared block (which only holds numbers) '''
+        return all(len(artifacts[name].select_dtypes(['number', 'bool']).columns) == artifacts[name].shape[1]
+                   for name in ['X_train', 'X_test'])
+
+    def get(self):
+        ''' Read the fold back as the dictionary of artifacts it was created from, then detach from it '''
+        X_train, y_train = self.train.get_xy()
+        X_test, y_test = self.test.get_xy()
+        self.train.close()
+        self.test.close()
+
+        y_test.name = None if y_test.name == '__target__' else y_test.name
+        return {'X_train': X_train, 'y_train': y_train.to_numpy(), 'upsampled_groups': X_train[self.id_col],
+                'X_test': X_test, 'y_test': y_test}
+
+    def unlink(self):
+        ''' Free the blocks. Only the process that created them should call this. '''
+        self.train.unlink()
+        self.test.unlink()
+
+    def __repr__(self):
+        return '\n'.join([
+            f'Shared fold: {self.train.name or self.train.path}, {self.test.name or self.test.path}',
+            f'Training shape: {self.train.shape}',
+            f'Test shape: {self.test.shape}'
+        ])
@@ -1 +1,33 @@
-from .experiment import *
\ No newline at end of file
+import importlib
+import sys
+import types
+
+from .store import *
+from .shap_store import *
+from .oof import *
+from .writer import *
+
+''' The modeling modules import the ML libraries (scikit-learn, xgboost, imblearn, statsmodels, ...),
+    which take seconds and hundreds of MB to import. Their names are only imported the first time
+    they're used, so e.g. feature extraction or reading results doesn't pay for them. '''
+_LAZY = {'tune_lags': 'experiment', 'predict_from_mems': 'experiment', 'gen_mixed_lm': 'experiment',
+         'predict': 'predict'}
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    module = importlib.import_module(f'.{_LAZY[name]}', __name__)
+    globals()[name] = getattr(module, name)
+    return globals()[name]
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
+
+class _Package(types.ModuleType):
+    def __setattr__(self, name, value):
+        # Importing the predict module binds it to the package under its own name - keep the function
+        if name in _LAZY and isinstance(value, types.ModuleType):
+            value = getattr(value, name)
+        super().__setattr__(name, value)
+
+sys.modules[__name__].__class__ = _Package
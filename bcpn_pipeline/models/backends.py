@@ -0,0 +1,241 @@
+import importlib.util
+import os
+from contextlib import contextmanager
+
+import numpy as np
+from sklearn.base import clone
+from sklearn.model_selection import GridSearchCV, ParameterGrid, cross_val_score
+
+# Names accepted wherever a tuning `backend` argument is taken
+BACKENDS = ['joblib', 'ray']
+
+def available_cores():
+    ''' Number of cores this process may run on (which can be fewer than the machine has) '''
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+class JoblibBackend:
+    '''
+    Runs hyperparameter searches in the local process, parallelized over n_jobs
+    joblib (loky) workers. Never imports Ray, so there is nothing to start or stop.
+
+    Model-based searches ('bayes', 'tpe') use Optuna's samplers (see OptunaSearchCV). 'bayes' uses
+    the Gaussian process sampler where torch is installed, and multivariate TPE otherwise.
+    '''
+    name = 'joblib'
+
+    # (module, pip package) pairs each search needs
+    SEARCH_REQUIREMENTS = {'tpe': [('optuna', 'optuna')],
+                           'bayes': [('optuna', 'optuna')]}
+
+    def __init__(self, n_jobs=None):
+        self.n_jobs = n_jobs or available_cores()
+
+    def start(self):
+        return self
+
+    def stop(self):
+        pass
+
+    def get_n_jobs(self, method):
+        return self.n_jobs
+
+    def check_search(self, search):
+        ''' Raise an ImportError naming the packages the search needs that aren't installed,
+            before any work is done, rather than partway through it '''
+        missing = [package for module, package in self.SEARCH_REQUIREMENTS.get(search, [])
+                   if importlib.util.find_spec(module) is None]
+        if missing:
+            raise ImportError(f'{search} search on the {self.name} backend needs {", ".join(missing)} - '
+                              f'install with: pip install {" ".join(missing)}')
+
+    def grid_search(self, estimator, param_grid, cv, scoring, n_jobs):
+        return GridSearchCV(estimator=estimator, param_grid=param_grid, cv=cv,
+                            scoring=scoring, n_jobs=n_jobs)
+
+    def model_search(self, estimator, param_distributions, n_trials, cv, scoring, n_jobs,
+                     search, random_state):
+        return OptunaSearchCV(estimator=estimator, param_distributions=param_distributions,
+                              n_trials=n_trials, cv=cv, scoring=scoring, n_jobs=n_jobs,
+                              sampler='gp' if search == 'bayes' else 'tpe', random_state=random_state)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def __repr__(self):
+        return f'{type(self).__name__}(n_jobs={self.n_jobs})'
+
+class RayBackend(JoblibBackend):
+    '''
+    Runs hyperparameter searches on a local Ray runtime via tune-sklearn.
+
+    The runtime is started once (on start, or on first search) and kept alive until stop,
+    so every search in a session shares it rather than paying Ray's startup each time.
+    If Ray is already running, searches attach to it, and leave it running on stop. Process pool
+    workers handed a started backend attach to its runtime by address - as long as they were
+    spawned rather than forked, since Ray can't be used from a forked copy of the driver.
+    '''
+    name = 'ray'
+
+    # Ray local mode - LogisticR doesn't play well when paralellized, for my package versions
+    SERIAL_METHODS = ['LogisticR']
+
+    # tune-sklearn's searches - 'bayes' runs on scikit-optimize, 'tpe' on Optuna
+    SEARCH_REQUIREMENTS = {'tpe': [('tune_sklearn', 'tune-sklearn'), ('optuna', 'optuna')],
+                           'bayes': [('tune_sklearn', 'tune-sklearn'), ('skopt', 'scikit-optimize')]}
+
+    def __init__(self, n_jobs=None, address=None):
+        super().__init__(n_jobs)
+        self.address = address
+        self._owner = False
+        self._pid = None
+
+    def start(self):
+        import ray
+        if ray.is_initialized() and self._pid not in (None, os.getpid()):
+            raise RuntimeError('The Ray backend can\'t be used from a forked process. Use a spawned '
+                               'process pool (e.g. ProcessPoolExecutor(mp_context=multiprocessing.get_context'
+                               '(\'spawn\'))), a thread or serial executor, or the joblib backend.')
+
+        if not ray.is_initialized():
+            if self.address:
+                ray.init(address=self.address, ignore_reinit_error=True,
+                         log_to_driver=False, include_dashboard=False)
+            else:
+                context = ray.init(num_cpus=self.n_jobs, ignore_reinit_error=True,
+                                   log_to_driver=False, include_dashboard=False)
+                self.address = context.address_info['address']
+                self._owner = True
+                self._pid = os.getpid()
+        return self
+
+    def stop(self):
+        if self._owner:
+            import ray
+            ray.shutdown()
+            self._owner = False
+
+    def get_n_jobs(self, method):
+        return 1 if method in self.SERIAL_METHODS else self.n_jobs
+
+    def grid_search(self, estimator, param_grid, cv, scoring, n_jobs):
+        self.start()
+        from tune_sklearn import TuneGridSearchCV
+        return TuneGridSearchCV(estimator=estimator, param_grid=param_grid,
+                                cv=cv, scoring=scoring, n_jobs=n_jobs, verbose=2)
+
+    def model_search(self, estimator, param_distributions, n_trials, cv, scoring, n_jobs,
+                     search, random_state):
+        self.start()
+        from tune_sklearn import TuneSearchCV
+        return TuneSearchCV(estimator=estimator, param_distributions=param_distributions,
+                            n_trials=n_trials, cv=cv, scoring=scoring, n_jobs=n_jobs,
+                            search_optimization='bayesian' if search == 'bayes' else 'optuna',
+                            random_state=random_state, verbose=2)
+
+    def __getstate__(self):
+        # Only the process that started the runtime may shut it down
+        state = self.__dict__.copy()
+        state['_owner'] = False
+        return state
+
+def get_backend(backend=None, n_jobs=None):
+    '''
+    Get a tuning backend.
+
+    Args:
+        backend: One of 'joblib' (the default) or 'ray', or an existing backend,
+            which is returned as-is so it can be shared across calls.
+
+        n_jobs: Number of parallel jobs per search. Defaults to the number of available cores.
+    '''
+    if isinstance(backend, JoblibBackend):
+        return backend
+
+    backend = backend or 'joblib'
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown backend {backend}. Must be one of {BACKENDS}.')
+    return RayBackend(n_jobs) if backend == 'ray' else JoblibBackend(n_jobs)
+
+@contextmanager
+def tuning_session(backend=None, n_jobs=None):
+    '''
+    Get a tuning backend for the duration of a session (e.g., a call to predict), and stop it
+    on exit. Existing backends are left running on exit, so they can be shared across sessions.
+    '''
+    if isinstance(backend, JoblibBackend):
+        yield backend
+        return
+
+    with get_backend(backend, n_jobs) as backend:
+        yield backend
+
+class OptunaSearchCV:
+    '''
+    Model-based search with a fixed budget of n_trials distinct configurations, using an Optuna
+    sampler ('tpe', or 'gp' for Gaussian process Bayesian optimization) in the local process.
+    Lists in param_distributions are treated as categorical choices.
+
+    Optuna's GP sampler runs on torch - without it, 'gp' falls back to multivariate TPE, which
+    also models the parameters jointly.
+    '''
+    def __init__(self, estimator, param_distributions, n_trials, cv, scoring, n_jobs=None,
+                 sampler='tpe', random_state=None):
+        self.estimator = estimator
+        self.param_distributions = param_distributions
+        self.n_trials = n_trials
+        self.cv = cv
+        self.scoring = scoring
+        self.n_jobs = n_jobs
+        self.sampler = sampler
+        self.random_state = random_state
+
+    def fit(self, X, y, groups=None):
+        import optuna
+        from .optimize import _set_search_results
+
+        optuna.logging.set_verbosity(optuna.logging.WARNING)
+        if self.sampler == 'gp' and importlib.util.find_spec('torch') is not None:
+            sampler = optuna.samplers.GPSampler(seed=self.random_state)
+        elif self.sampler == 'gp':
+            print('torch is not installed - using multivariate TPE rather than the GP sampler.')
+            sampler = optuna.samplers.TPESampler(seed=self.random_state, multivariate=True)
+        else:
+            sampler = optuna.samplers.TPESampler(seed=self.random_state)
+        study = optuna.create_study(direction='maximize', sampler=sampler)
+
+        grid = list(ParameterGrid(self.param_distributions))
+        n_trials = min(self.n_trials, len(grid))
+        rng = np.random.default_rng(self.random_state)
+
+        candidates, test_scores, scored = [], [], {}
+        while len(candidates) < n_trials:
+            trial = study.ask()
+            params = {k: trial.suggest_categorical(k, v)
+                      for k, v in self.param_distributions.items()}
+
+            # Samplers can suggest a configuration again - tell it the score it already has, rather
+            # than fitting it again, and try one that hasn't been scored next
+            key = _params_key(params)
+            if key in scored:
+                study.tell(trial, scored[key])
+                unscored = [p for p in grid if _params_key(p) not in scored]
+                study.enqueue_trial(unscored[rng.integers(len(unscored))])
+                continue
+
+            scores = cross_val_score(clone(self.estimator).set_params(**params), X, y, groups=groups,
+                                     cv=self.cv, scoring=self.scoring, n_jobs=self.n_jobs)
+            scored[key] = np.mean(scores)
+            study.tell(trial, scored[key])
+
+            candidates.append(params)
+            test_scores.append(scores)
+
+        return _set_search_results(self, candidates, np.array(test_scores), X, y)
+
+def _params_key(params):
+    return tuple(sorted(params.items()))
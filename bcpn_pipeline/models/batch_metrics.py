@@ -0,0 +1,267 @@
+import numpy as np
+import pandas as pd
+
+# Metrics calculated from confusion matrix counts (see batch_performance_metrics)
+CONFUSION_METRICS = ['accuracy', 'precision', 'sensitivity', 'specificity', 'f1_score']
+
+def stack_units(oof, pad_proba=-1.0):
+    '''
+    Stack the out-of-fold predictions of every run and fold (see oof.OOFPredictions) into
+    (n_units, n_samples) arrays, padding shorter units with zero-weight samples.
+
+    Returns:
+        units: List of (run, fold), one per row
+        y_true, probas, groups: Arrays of shape (n_units, n_samples). Groups are integer codes
+            (-1 for padding), shared across units, so the same participant has the same code everywhere.
+        weights: 1 for real samples and 0 for padding
+    '''
+    cols = oof.columns
+    codes, _ = pd.factorize(cols['group'])
+    units = oof.units()
+
+    # Position of every sample within its unit, in stored order
+    unit_idx = {unit: i for i, unit in enumerate(units)}
+    rows = np.array([unit_idx[(int(r), int(f))] for r, f in zip(cols['run'], cols['fold'])], dtype=np.int64)
+    order = np.argsort(rows, kind='stable')
+    sizes = np.bincount(rows, minlength=len(units))
+    pos = np.empty(len(rows), dtype=np.int64)
+    pos[order] = np.arange(len(rows)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+
+    shape = (len(units), sizes.max(initial=0))
+    y_true = np.zeros(shape, dtype=np.int8)
+    probas = np.full(shape, pad_proba, dtype=np.float64)
+    groups = np.full(shape, -1, dtype=np.int64)
+    weights = np.zeros(shape, dtype=np.float64)
+
+    y_true[rows, pos] = cols['y_true']
+    probas[rows, pos] = cols['proba']
+    groups[rows, pos] = codes
+    weights[rows, pos] = 1.0
+    return units, y_true, probas, groups, weights
+
+def batch_confusion(y_true, y_pred, weights=None):
+    '''
+    Confusion matrix counts of many units (or bootstrap resamples) at once, along the last axis.
+    Weights count each sample that many times (0 to ignore it).
+
+    Returns:
+        Dictionary of tp, fp, tn and fn arrays, with the leading shape of the (broadcast) inputs
+    '''
+    y_true = np.asarray(y_true).astype(bool)
+    y_pred = np.asarray(y_pred).astype(bool)
+    weights = np.ones(np.broadcast(y_true, y_pred).shape) if weights is None else np.asarray(weights)
+
+    pos = np.sum(weights * y_true, axis=-1)
+    pred_pos = np.sum(weights * y_pred, axis=-1)
+    tp = np.sum(weights * (y_true & y_pred), axis=-1)
+    total = np.sum(weights * np.ones_like(y_true), axis=-1)
+    fp = pred_pos - tp
+    fn = pos - tp
+    tn = total - tp - fp - fn
+    return {'tp': tp, 'fp': fp, 'tn': tn, 'fn': fn}
+
+def confusion_to_metrics(tp, fp, tn, fn):
+    ''' Accuracy, precision, sensitivity, specificity and F1 score from confusion matrix counts.
+        Undefined ratios are 0, as in sklearn (with zero_division='warn') '''
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stats = {
+            'accuracy': (tp + tn) / (tp + fp + tn + fn),
+            'precision': tp / (tp + fp),
+            'sensitivity': tp / (tp + fn),
+            'specificity': tn / (tn + fp)
+        }
+        stats = {metric: np.nan_to_num(values, nan=0.0) for metric, values in stats.items()}
+
+        # From precision and sensitivity, in the same order as sklearn, so results match exactly
+        precision, sensitivity = stats['precision'], stats['sensitivity']
+        denom = precision + sensitivity
+        stats['f1_score'] = np.where(denom > 0, 2 * precision * sensitivity / np.where(denom > 0, denom, 1), 0.0)
+    return stats
+
+def batch_performance_metrics(y_true, y_pred, weights=None):
+    ''' Standard performance metrics (see metrics.calc_performance_metrics) of many units at once,
+        along the last axis '''
+    return confusion_to_metrics(**batch_confusion(y_true, y_pred, weights))
+
+def _sorted_cumulative(y_true, probas, weights):
+    '''
+    Sort each row by descending probability and get the cumulative (weighted) positive and
+    negative counts, taken at the end of each run of tied probabilities.
+
+    The sort order only depends on probas, so rows that share probas (e.g. bootstrap resamples,
+    which only differ in weights) are sorted once.
+    '''
+    probas = np.atleast_2d(probas)
+    shape = np.broadcast(np.atleast_2d(y_true), probas, np.atleast_2d(weights)).shape
+
+    order = np.argsort(-probas, axis=-1, kind='stable')
+    sorted_probas = np.take_along_axis(probas, order, axis=-1)
+    order = np.broadcast_to(order, shape)
+    y_sorted = np.take_along_axis(np.broadcast_to(y_true, shape), order, axis=-1).astype(bool)
+    w_sorted = np.take_along_axis(np.broadcast_to(weights, shape), order, axis=-1)
+
+    tps = np.cumsum(w_sorted * y_sorted, axis=-1)
+    fps = np.cumsum(w_sorted * ~y_sorted, axis=-1)
+
+    # Index of the last sample of each run of ties - everything tied shares a threshold
+    n = shape[-1]
+    last = np.ones(sorted_probas.shape, dtype=bool)
+    last[..., :-1] = sorted_probas[..., :-1] != sorted_probas[..., 1:]
+    end = np.where(last, np.arange(n), n)
+    end = np.minimum.accumulate(end[..., ::-1], axis=-1)[..., ::-1]
+    end = np.broadcast_to(end, shape)
+
+    tps = np.take_along_axis(tps, end, axis=-1)
+    fps = np.take_along_axis(fps, end, axis=-1)
+    return sorted_probas, tps, fps
+
+def batch_roc(y_true, probas, weights=None):
+    '''
+    ROC curves of many units (or resamples) at once, along the last axis.
+
+    Returns:
+        fpr, tpr: Arrays of shape (..., n_samples + 1), starting at (0, 0). Tied probabilities
+            share a single point (repeated for every tied sample), so the curves are the same as
+            sklearn's roc_curve without dropping intermediate points. NaN where a row has no
+            positives (tpr) or negatives (fpr).
+    '''
+    weights = np.ones(np.shape(probas)) if weights is None else weights
+    _, tps, fps = _sorted_cumulative(y_true, probas, weights)
+
+    zeros = np.zeros(tps.shape[:-1] + (1,))
+    tps = np.concatenate([zeros, tps], axis=-1)
+    fps = np.concatenate([zeros, fps], axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return fps / fps[..., -1:], tps / tps[..., -1:]
+
+def batch_roc_auc(y_true, probas, weights=None):
+    ''' ROC AUC of many units (or resamples) at once, along the last axis. Ties count as half,
+        as in sklearn's roc_auc_score. NaN where a row only has one class. '''
+    fpr, tpr = batch_roc(y_true, probas, weights)
+    return np.sum(np.diff(fpr, axis=-1) * (tpr[..., 1:] + tpr[..., :-1]) / 2, axis=-1)
+
+def batch_interp(x, xp, fp):
+    ''' np.interp of every row of xp/fp (each with increasing xp) at the same points x '''
+    xp, fp = np.atleast_2d(xp), np.atleast_2d(fp)
+    x = np.asarray(x, dtype=np.float64)
+    n = xp.shape[-1]
+
+    # Index of the last xp <= x in each row
+    idx = _rowwise_searchsorted(np.nan_to_num(xp), x, side='right') - 1
+    lo = np.clip(idx, 0, n - 1)
+    hi = np.clip(idx + 1, 0, n - 1)
+
+    x0, x1 = np.take_along_axis(xp, lo, axis=-1), np.take_along_axis(xp, hi, axis=-1)
+    y0, y1 = np.take_along_axis(fp, lo, axis=-1), np.take_along_axis(fp, hi, axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        y = np.where(x1 > x0, y0 + (x[None, :] - x0) * (y1 - y0) / (x1 - x0), y0)
+
+    # Clamp to the end values outside each row's range, as np.interp does
+    y = np.where(idx < 0, fp[:, :1], y)
+    return np.where(idx >= n - 1, fp[:, -1:], y)
+
+def batch_threshold_sweep(y_true, probas, thresholds, weights=None):
+    '''
+    Confusion matrix counts and performance metrics of many units at many thresholds, from a single
+    sort of each unit, predicting the positive class wherever probas >= threshold.
+
+    Returns:
+        Dictionary of tp, fp, tn, fn and every metric in CONFUSION_METRICS, each of shape
+        (..., n_thresholds)
+    '''
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    weights = np.ones(np.shape(probas)) if weights is None else weights
+    sorted_probas, tps, fps = _sorted_cumulative(y_true, probas, weights)
+
+    # Number of samples with probas >= threshold in each row (rows are sorted descending)
+    ascending = sorted_probas[..., ::-1]
+    n = ascending.shape[-1]
+    n_pos = n - _rowwise_searchsorted(ascending.reshape(-1, n), thresholds, side='left')
+    n_pos = np.broadcast_to(n_pos.reshape(ascending.shape[:-1] + (len(thresholds),)),
+                            tps.shape[:-1] + (len(thresholds),))
+
+    zeros = np.zeros(tps.shape[:-1] + (1,))
+    tps = np.concatenate([zeros, tps], axis=-1)
+    fps = np.concatenate([zeros, fps], axis=-1)
+    tp = np.take_along_axis(tps, n_pos, axis=-1)
+    fp = np.take_along_axis(fps, n_pos, axis=-1)
+    fn = tps[..., -1:] - tp
+    tn = fps[..., -1:] - fp
+
+    counts = {'tp': tp, 'fp': fp, 'tn': tn, 'fn': fn}
+    return {**counts, **confusion_to_metrics(**counts)}
+
+def _rowwise_searchsorted(a, v, side='left'):
+    '''
+    np.searchsorted of the same values v in every (ascending) row of a, from a single sort of
+    every row and value together - each value's position, less the values sorted before it
+    '''
+    n_rows, n = a.shape
+    v = np.asarray(v, dtype=np.float64)
+    row_keys = np.concatenate([np.repeat(np.arange(n_rows), n), np.repeat(np.arange(n_rows), len(v))])
+    values = np.concatenate([a.ravel(), np.tile(v, n_rows)])
+
+    # Ties between a and v go before (left) or after (right) the v
+    is_v = np.concatenate([np.zeros(a.size, dtype=bool), np.ones(n_rows * len(v), dtype=bool)])
+    tiebreak = is_v if side == 'right' else ~is_v
+
+    rank = np.empty(len(values), dtype=np.int64)
+    rank[np.lexsort((tiebreak, values, row_keys))] = np.arange(len(values))
+    v_rank = np.empty(len(v), dtype=np.int64)
+    v_rank[np.argsort(v, kind='stable')] = np.arange(len(v))
+
+    idx = rank[a.size:].reshape(n_rows, len(v)) - np.arange(n_rows)[:, None] * (n + len(v))
+    return idx - v_rank[None, :]
+
+def cluster_bootstrap_weights(n_groups, n_boot, random_state=None):
+    ''' Number of times each group is drawn in each of n_boot resamples of the groups with
+        replacement, of shape (n_boot, n_groups) '''
+    rng = np.random.default_rng(random_state)
+    return rng.multinomial(n_groups, np.full(n_groups, 1 / n_groups), size=n_boot).astype(np.float64)
+
+def bootstrap_ci(oof, n_boot=2000, alpha=0.05, threshold=0.5, random_state=0, block_size=500):
+    '''
+    Participant-level (cluster) bootstrap confidence intervals of the mean AUC across folds
+    and the mean specificity across runs of out-of-fold predictions (see oof.OOFPredictions).
+
+    Each resample draws participants with replacement, keeping all of a participant's samples
+    together, and is expressed as sample weights, so every resample of a fold is scored from a
+    single sort of the fold's probabilities. Resamples are scored block_size at a time, to bound memory.
+
+    Returns:
+        DataFrame with the estimate and (percentile) CI bounds of each metric
+    '''
+    print('Bootstrapping confidence intervals (%i resamples).' % n_boot)
+    units, y_true, probas, groups, weights = stack_units(oof)
+    n_groups = groups.max(initial=-1) + 1
+    counts = cluster_bootstrap_weights(n_groups, n_boot, random_state)
+    counts = np.concatenate([counts, np.zeros((n_boot, 1))], axis=1) # Padding (group -1) is never drawn
+
+    # Specificity is pooled over the folds of each run, like predict's test metrics
+    runs = np.array([run for run, _ in units])
+    pooled = [(y_true[runs == run].ravel(), probas[runs == run].ravel() >= threshold,
+               groups[runs == run].ravel(), weights[runs == run].ravel()) for run in pd.unique(runs)]
+
+    aucs = np.empty((len(units), n_boot))
+    specificities = np.empty((len(pooled), n_boot))
+    for start in range(0, n_boot, block_size):
+        block = counts[start:start + block_size]
+        stop = start + len(block)
+        for i in range(len(units)):
+            aucs[i, start:stop] = batch_roc_auc(y_true[i], probas[i], block[:, groups[i]])
+        for i, (y, y_pred, g, _) in enumerate(pooled):
+            specificities[i, start:stop] = batch_performance_metrics(y, y_pred, block[:, g])['specificity']
+
+    estimates = {
+        'auc': np.nanmean(batch_roc_auc(y_true, probas, weights)),
+        'specificity': np.mean([batch_performance_metrics(y, y_pred, w)['specificity'] for y, y_pred, _, w in pooled])
+    }
+    resamples = {'auc': np.nanmean(aucs, axis=0), 'specificity': np.mean(specificities, axis=0)}
+
+    return pd.DataFrame([
+        {'metric': metric, 'estimate': estimates[metric],
+         'ci_low': np.nanquantile(resamples[metric], alpha / 2),
+         'ci_high': np.nanquantile(resamples[metric], 1 - alpha / 2),
+         'n_boot': n_boot, 'alpha': alpha}
+        for metric in estimates
+    ])
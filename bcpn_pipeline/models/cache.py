@@ -0,0 +1,151 @@
+import hashlib
+import json
+import shutil
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+def estimator_config(estimator):
+    ''' Describe an (unfitted) estimator by its class and parameters, for use in cache keys '''
+    if estimator is None:
+        return 'None'
+    params = sorted(estimator.get_params(deep=False).items())
+    return f'{type(estimator).__name__}({params})'
+
+class FoldCache:
+    '''
+    Cache of per-fold training artifacts (e.g., CV splits, imputed and upsampled matrices),
+    so they can be shared by every method trained on the same folds.
+
+    Entries are kept in an in-memory LRU of at most max_items entries. If spill_dir is given,
+    entries evicted from memory are written to .npy files there and reloaded on demand,
+    rather than being discarded.
+
+    Each entry is a dictionary of name -> DataFrame, Series or ndarray. Copies are handed out
+    on every get, so callers are free to modify what they receive.
+    '''
+    def __init__(self, max_items=32, spill_dir=None):
+        self.max_items = max_items
+        self.spill_dir = Path(spill_dir) if spill_dir else None
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+        if self.spill_dir:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts):
+        ''' Hash any number of (string-able) key parts into a filename-safe key '''
+        return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        artifacts = self._items.get(key)
+        if artifacts is not None:
+            self._items.move_to_end(key)
+        elif self.spill_dir and Path.joinpath(self.spill_dir, key).exists():
+            artifacts = _load_artifacts(Path.joinpath(self.spill_dir, key))
+            self._store(key, artifacts)
+
+        if artifacts is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return {name: _copy(obj) for name, obj in artifacts.items()}
+
+    def put(self, key, artifacts):
+        self._store(key, {name: _copy(obj) for name, obj in artifacts.items()})
+
+    def clear(self):
+        self._items.clear()
+        if self.spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+
+    def _store(self, key, artifacts):
+        self._items[key] = artifacts
+        self._items.move_to_end(key)
+
+        while self.max_items is not None and len(self._items) > self.max_items:
+            old_key, old_artifacts = self._items.popitem(last=False)
+            if self.spill_dir and not Path.joinpath(self.spill_dir, old_key).exists():
+                _save_artifacts(Path.joinpath(self.spill_dir, old_key), old_artifacts)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return '\n'.join([
+            f'Entries in memory: {len(self._items)}',
+            f'Hits: {self.hits}',
+            f'Misses: {self.misses}'
+        ])
+
+def _copy(obj):
+    if isinstance(obj, list):
+        return [_copy(x) for x in obj]
+    if isinstance(obj, tuple):
+        return tuple(_copy(x) for x in obj)
+    return obj.copy()
+
+def _save_artifacts(path, artifacts):
+    ''' Write each artifact to its own .npy file, along with the metadata
+    needed to rebuild pandas objects. Written to a temp dir first, then renamed,
+    so a partially written entry is never picked up. '''
+    tmp = path.with_name(path.name + '.tmp')
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+
+    meta = {}
+    for name, obj in artifacts.items():
+        if isinstance(obj, pd.DataFrame):
+            meta[name] = {'kind': 'frame', 'columns': list(obj.columns),
+                          'dtypes': [str(dtype) for dtype in obj.dtypes]}
+            np.save(Path.joinpath(tmp, f'{name}.npy'), obj.to_numpy(dtype=float))
+            np.save(Path.joinpath(tmp, f'{name}_index.npy'), obj.index.to_numpy())
+        elif isinstance(obj, pd.Series):
+            meta[name] = {'kind': 'series', 'name': obj.name, 'dtype': str(obj.dtype)}
+            np.save(Path.joinpath(tmp, f'{name}.npy'), obj.to_numpy())
+            np.save(Path.joinpath(tmp, f'{name}_index.npy'), obj.index.to_numpy())
+        elif isinstance(obj, (list, tuple)):
+            # E.g. a list of (train_index, test_index) CV splits
+            meta[name] = {'kind': 'arrays', 'n': len(obj)}
+            for i, arrays in enumerate(obj):
+                for j, arr in enumerate(arrays):
+                    np.save(Path.joinpath(tmp, f'{name}_{i}_{j}.npy'), arr)
+            meta[name]['widths'] = [len(arrays) for arrays in obj]
+        else:
+            meta[name] = {'kind': 'array'}
+            np.save(Path.joinpath(tmp, f'{name}.npy'), obj)
+
+    with open(Path.joinpath(tmp, 'meta.json'), 'w') as fp:
+        json.dump(meta, fp)
+
+    tmp.rename(path)
+
+def _load_artifacts(path):
+    with open(Path.joinpath(path, 'meta.json')) as fp:
+        meta = json.load(fp)
+
+    artifacts = {}
+    for name, info in meta.items():
+        if info['kind'] == 'frame':
+            values = np.load(Path.joinpath(path, f'{name}.npy'))
+            index = np.load(Path.joinpath(path, f'{name}_index.npy'))
+            df = pd.DataFrame(values, index=index, columns=info['columns'])
+            artifacts[name] = df.astype(dict(zip(info['columns'], info['dtypes'])))
+        elif info['kind'] == 'series':
+            values = np.load(Path.joinpath(path, f'{name}.npy'), allow_pickle=True)
+            index = np.load(Path.joinpath(path, f'{name}_index.npy'))
+            artifacts[name] = pd.Series(values, index=index, name=info['name']).astype(info['dtype'])
+        elif info['kind'] == 'arrays':
+            artifacts[name] = [
+                tuple(np.load(Path.joinpath(path, f'{name}_{i}_{j}.npy')) for j in range(width))
+                for i, width in enumerate(info['widths'])
+            ]
+        else:
+            artifacts[name] = np.load(Path.joinpath(path, f'{name}.npy'))
+    return artifacts
@@ -8,11 +8,17 @@ from statsmodels.regression.mixed_linear_model import MixedLM
 
 from ..consts import OUTPUT_PATH_LAGS, OUTPUT_PATH_PRED, OUTPUT_PATH_LMM
 from .predict import predict
+from .cache import FoldCache
+from .backends import tuning_session
+from .ledger import get_ledger
+from .store import get_store
 from .transform import impute
-# from .helpers import to_csv_async
+from .writer import writing_session
+from .. import profiling
 
 
-def tune_lags(fs):
+@profiling.timed()
+def tune_lags(fs, backend=None, ledger=None, store=OUTPUT_PATH_LAGS, writer=None):
     
     output_path = OUTPUT_PATH_LAGS
     
@@ -33,24 +39,44 @@ def tune_lags(fs):
         lag_range = range(1, 8)
     
     
-    for n_lags in lag_range:
-        print('For ' + str(n_lags) + ' lags.')
-
-        #Perform final encoding, scaling, etc
-        all_feats = fs.prep_for_modeling(n_lags)
-        
-        # Also tune the tree depth - will help us with gridsearch later on
-        for max_depth in range(1, 6):
-            print('Using tree with max_depth of %i.' % (max_depth))
-            models = {
-                'RF': RandomForestClassifier(max_depth=max_depth, random_state=max_depth)
-            }
-
-            predict(fs=all_feats, output_path=output_path,
-                    select_feats=False, tune=False, 
-                    importance=False, models=models, max_depth=max_depth) # Pass in max_depth so it gets recorded...dont' ask me why I designed it this way.
-
-def predict_from_mems(fs, n_lags, **kwargs):
+    # Build every lag once, up front - each n_lags below is then just a slice
+    fs.build_lag_cube(max(lag_range))
+
+    # One tuning backend and one background writer for every predict below, rather than one per call.
+    # Checkpoint every unit of work to the ledger, if given, so an interrupted call can pick up where it left off
+    ledger = get_ledger(ledger)
+
+    # Results go to a single store under the output path (pass store=None for per-config CSVs instead)
+    store = get_store(store)
+
+    try:
+        with tuning_session(backend) as backend, writing_session(writer) as writer:
+            for n_lags in lag_range:
+                print('For ' + str(n_lags) + ' lags.')
+
+                #Perform final encoding, scaling, etc
+                all_feats = fs.prep_for_modeling(n_lags)
+
+                # Every max_depth below trains on the exact same folds, so impute and upsample them once
+                fold_cache = FoldCache()
+            
+                # Also tune the tree depth - will help us with gridsearch later on
+                for max_depth in range(1, 6):
+                    print('Using tree with max_depth of %i.' % (max_depth))
+                    models = {
+                        'RF': RandomForestClassifier(max_depth=max_depth, random_state=max_depth)
+                    }
+
+                    predict(fs=all_feats, output_path=output_path,
+                            select_feats=False, tune=False, 
+                            importance=False, fold_cache=fold_cache, backend=backend, ledger=ledger, store=store,
+                            writer=writer, models=models, max_depth=max_depth) # Pass in max_depth so it gets recorded...dont' ask me why I designed it this way.
+    finally:
+        # Don't let a stale cube leak into later experiments on this featureset
+        fs.drop_lag_cube()
+
+@profiling.timed()
+def predict_from_mems(fs, n_lags, ledger=None, store=OUTPUT_PATH_PRED, **kwargs):
 
     output_path = OUTPUT_PATH_PRED
 
@@ -59,7 +85,8 @@ def predict_from_mems(fs, n_lags, **kwargs):
     fs_lagged = fs.prep_for_modeling(n_lags)
 
     # Do a non-tuned and a tuned run, for comparison's sake
-    predict(fs_lagged, output_path=output_path, select_feats=True, tune=True, importance=True, **kwargs)
+    predict(fs_lagged, output_path=output_path, select_feats=True, tune=True, importance=True, 
+            ledger=ledger, store=store, **kwargs)
     # predict(fs_lagged, output_path=output_path, select_feats=False, tune=False, importance=False, **kwargs) 
 
 def gen_mixed_lm(fs, feats_explanatory, alpha=0.5, random_state=7):
@@ -118,5 +145,6 @@ def gen_mixed_lm(fs, feats_explanatory, alpha=0.5, random_state=7):
     pred_res['rmse'] = np.sqrt(np.sum(pred_df['diff']**2)/pred_df.shape[0])
 
     # Save outputs
-    pred_res.to_csv(Path.joinpath(OUTPUT_PATH_LMM, f'lmm.csv'))
+    with writing_session() as writer:
+        writer.write_csv(pred_res, Path.joinpath(OUTPUT_PATH_LMM, f'lmm.csv'))
     return(pred_res)
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+import pickle
+import uuid
+from pathlib import Path
+
+# Fields that identify a single unit of work in predict - one fold of one run of one method
+UNIT_FIELDS = ['fingerprint', 'n_lags', 'max_depth', 'method', 'run', 'fold', 'tuned', 'select_feats',
+               'search', 'importance', 'shap_budget', 'estimator']
+
+class Ledger:
+    '''
+    Checkpoint of completed units of work (see UNIT_FIELDS), so an interrupted experiment
+    can be re-run and only compute what's missing.
+
+    Each unit is stored in its own file under path, named by a hash of its key, holding the key
+    and the unit's full results. Files are written to a temp file and then renamed into place,
+    so a unit is either recorded completely or not at all - even if the process is killed mid-write.
+    '''
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def make_key(**fields):
+        ''' Get the key of a unit, from every field in UNIT_FIELDS '''
+        missing = [field for field in UNIT_FIELDS if field not in fields]
+        if missing:
+            raise ValueError(f'Missing fields for ledger key: {missing}')
+        return {field: fields[field] for field in UNIT_FIELDS}
+
+    def _unit_path(self, key):
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        return Path.joinpath(self.path, f'{digest}.pkl')
+
+    def done(self, key):
+        return self._unit_path(key).exists()
+
+    def get(self, key):
+        ''' Get the results of a completed unit, or None if it hasn't been recorded '''
+        path = self._unit_path(key)
+        if not path.exists():
+            return None
+        with open(path, 'rb') as fp:
+            return pickle.load(fp)['result']
+
+    def record(self, key, result):
+        path = self._unit_path(key)
+        tmp = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.tmp')
+        try:
+            with open(tmp, 'wb') as fp:
+                pickle.dump({'key': key, 'result': result}, fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp, path)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    def keys(self):
+        ''' Get the keys of every completed unit '''
+        keys = []
+        for path in sorted(self.path.glob('*.pkl')):
+            with open(path, 'rb') as fp:
+                keys.append(pickle.load(fp)['key'])
+        return keys
+
+    def clear(self):
+        for path in self.path.glob('*.pkl'):
+            path.unlink()
+
+    def __len__(self):
+        return len(list(self.path.glob('*.pkl')))
+
+    def __repr__(self):
+        return '\n'.join([
+            f'Ledger: {self.path}',
+            f'Completed units: {len(self)}'
+        ])
+
+def get_ledger(ledger):
+    ''' Get a Ledger from a path, or return an existing Ledger (or None) as-is '''
+    if ledger is None or isinstance(ledger, Ledger):
+        return ledger
+    return Ledger(ledger)
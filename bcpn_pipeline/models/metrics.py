@@ -1,7 +1,11 @@
 import numpy as np
 import pandas as pd
 from sklearn.metrics import accuracy_score, precision_recall_fscore_support, mean_absolute_error, recall_score, roc_curve, auc, confusion_matrix
-import shap
+from sklearn.metrics import precision_recall_curve, average_precision_score
+
+from .parallel import get_executor
+from . import batch_metrics
+from .. import profiling
 
 def get_mean_roc_auc(tprs, aucs, fpr_mean):
     print('Getting mean ROC AUC stats.')
@@ -25,33 +29,102 @@ def get_agg_auc(y_all, y_probas_all):
 # Check Gu et al.
 def calc_performance_metrics(y_true, y_pred):
     print('Calculating standard performance metrics.')
-    stats = {}
+    stats = batch_metrics.batch_performance_metrics(np.asarray(y_true), np.asarray(y_pred))
+    stats = {metric: stats[metric].item() for metric in batch_metrics.CONFUSION_METRICS}
+    stats['support'] = None # Not returned by sklearn for binary averages either
 
-    stats['accuracy'] = accuracy_score(y_true=y_true, y_pred=y_pred)
-    
-    precision, sensitivity, f1_score, support = precision_recall_fscore_support(
-        y_true=y_true, y_pred=y_pred, average='binary'
-    )
+    return stats
 
-    specificity = recall_score(y_true=y_true, y_pred=y_pred, pos_label=0)
-    
-    stats.update({'precision': precision, 'sensitivity': sensitivity, 
-                  'specificity': specificity, 'f1_score': f1_score, 'support': support})
+def calc_threshold_metrics(y_true, y_probas, threshold=0.5):
+    ''' Standard performance metrics (see calc_performance_metrics), predicting the positive class 
+        wherever the positive class probability is at least threshold '''
+    y_pred = (np.asarray(y_probas) >= threshold).astype(int)
+    return calc_performance_metrics(y_true=y_true, y_pred=y_pred)
 
-    return stats
+def calc_oof_metrics(oof, threshold=0.5, by='run'):
+    '''
+    Standard performance metrics of out-of-fold predictions (see oof.OOFPredictions), at any threshold.
+
+    Args:
+        by: Column(s) to calculate metrics for each of - 'run' (the default, like predict's test results),
+            ['run', 'fold'], or None for all predictions pooled together
+
+    Note that for some classifiers (e.g., SVC), predict isn't the same as thresholding predict_proba
+    at 0.5, so metrics at threshold=0.5 can differ slightly from those saved by predict.
+    '''
+    df = oof.to_frame()
+    y_pred = df['proba'].to_numpy() >= threshold
+    if by is None:
+        keys, membership = [()], np.ones((1, len(df)))
+    else:
+        by = [by] if isinstance(by, str) else list(by)
+        codes, keys = pd.factorize(pd.MultiIndex.from_frame(df[by]))
+        membership = (codes[None, :] == np.arange(len(keys))[:, None]).astype(np.float64)
+
+    # Every group at once, as weights selecting its rows
+    stats = batch_metrics.batch_performance_metrics(df['y_true'].to_numpy(), y_pred, membership)
+    res = pd.DataFrame({metric: stats[metric] for metric in batch_metrics.CONFUSION_METRICS})
+    res['support'] = None
+    if by is not None:
+        for i, col in enumerate(by):
+            res[col] = [key[i] for key in keys]
+    res['threshold'] = threshold
+    return res
+
+def calc_oof_roc_auc(oof, fpr_mean=None):
+    ''' Mean ROC curve and mean/std AUC across every run and fold of out-of-fold predictions,
+        calculated the same way as predict does (see get_mean_roc_auc) '''
+    fpr_mean = np.linspace(0, 1, 100) if fpr_mean is None else fpr_mean
+    units, y_true, probas, groups, weights = batch_metrics.stack_units(oof)
+
+    fpr, tpr = batch_metrics.batch_roc(y_true, probas, weights)
+    tprs = batch_metrics.batch_interp(fpr_mean, fpr, tpr)
+    tprs[:, 0] = 0.0
+    aucs = batch_metrics.batch_roc_auc(y_true, probas, weights)
+
+    return get_mean_roc_auc(tprs, aucs, fpr_mean)
+
+def calc_oof_ci(oof, n_boot=2000, alpha=0.05, threshold=0.5, random_state=0):
+    ''' Participant-level bootstrap confidence intervals of AUC and specificity of out-of-fold 
+        predictions (see batch_metrics.bootstrap_ci) '''
+    return batch_metrics.bootstrap_ci(oof, n_boot=n_boot, alpha=alpha, threshold=threshold,
+                                      random_state=random_state)
+
+def calc_oof_pr_curve(oof, recall_mean=None):
+    ''' Mean precision-recall curve and mean/std average precision across every run and fold 
+        of out-of-fold predictions '''
+    recall_mean = np.linspace(0, 1, 100) if recall_mean is None else recall_mean
+    precisions, aps = [], []
+    for run, fold in oof.units():
+        unit = oof.get(run, fold).columns
+        precision, recall, thresholds = precision_recall_curve(unit['y_true'], unit['proba'])
 
-def calc_shap(X_train, X_test, model, method, random_state, pos_label=1):
+        # Recall decreases along the curve, so flip it for interpolation
+        precisions.append(np.interp(recall_mean, recall[::-1], precision[::-1]))
+        aps.append(average_precision_score(unit['y_true'], unit['proba']))
+
+    return ({'precision_mean': np.mean(precisions, axis=0), 'recall_mean': recall_mean},
+            {'ap_mean': np.mean(aps), 'ap_std': np.std(aps)})
+
+def sample_shap_data(X_train, X_test, random_state, n_background=100, n_explain=100):
+    ''' Sample the background data (from the training set) and the samples to explain (from the test set) '''
+    import shap
+    if X_train.shape[0] > n_background:
+        X_train = shap.utils.sample(X_train, nsamples=n_background, random_state=random_state)
+
+    if X_test.shape[0] > n_explain:
+        X_test = shap.utils.sample(X_test, nsamples=n_explain, random_state=random_state)
+
+    return X_train, X_test
+
+def calc_shap(X_train, X_test, model, method, random_state, pos_label=1, n_background=100, n_explain=100):
+    import shap
     shap_values = None
     explainer = None
-    nsamples_max = 100
 
     print('Calculating SHAP values.')    
 
-    if X_train.shape[0] > nsamples_max:
-        X_train = shap.utils.sample(X_train, nsamples = nsamples_max, random_state=random_state)
-
-    if X_test.shape[0] > nsamples_max:
-        X_test = shap.utils.sample(X_train, nsamples = nsamples_max, random_state=random_state)
+    X_train, X_test = sample_shap_data(X_train, X_test, random_state, n_background, n_explain)
 
     if method == 'LogisticR':
         explainer = shap.explainers.Linear(model=model, masker=X_train)
@@ -64,4 +137,32 @@ def calc_shap(X_train, X_test, model, method, random_state, pos_label=1):
 
     # Return an explanation object (updated for new version of shap)
     shap_values = explainer(X_test)
-    return explainer, shap_values
\ No newline at end of file
+    return explainer, shap_values
+
+def _calc_shap_job(job, return_explainer):
+    explainer, shap_values = calc_shap(**job)
+    return (explainer if return_explainer else None), shap_values
+
+def calc_shap_batch(jobs, executor='process', n_workers=None, return_explainers=False):
+    '''
+    Calculate SHAP values for many folds at once, in parallel.
+
+    Args:
+        jobs: List of dictionaries of calc_shap's arguments (X_train, X_test, model, method, 
+            random_state, and optionally n_background and n_explain), one per fold
+
+        executor, n_workers: Where to explain the folds (see parallel.get_executor). Defaults to
+            a pool of worker processes, one per core.
+
+        return_explainers: Whether to send each explainer back from its worker. They're often 
+            large, so by default only the SHAP values are returned (with explainer None).
+
+    Returns:
+        A list of (explainer, shap_values) tuples, in the same order as jobs
+    '''
+    print('Calculating SHAP values for %i folds.' % len(jobs))
+    with get_executor(executor, n_workers) as pool:
+        futures = [pool.submit(profiling.traced(_calc_shap_job, 'shap', method=job['method'], run=job['random_state']), 
+                               job, return_explainers) 
+                   for job in jobs]
+        return [future.result() for future in futures]
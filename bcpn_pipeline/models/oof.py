@@ -0,0 +1,87 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Columns stored for every out-of-fold prediction, with their (compact) dtypes
+OOF_COLUMNS = {'run': np.int16, 'fold': np.int16, 'row_id': np.int64, 'group': None,
+               'y_true': np.int8, 'proba': np.float32}
+
+class OOFPredictions:
+    '''
+    Out-of-fold predictions of every run and fold of a config: the positive class probability,
+    true label, row id (in the featureset) and group id (participant) of every test sample.
+
+    Stored as a single uncompressed .npz of one array per column, so metrics for any threshold,
+    curve or grouping can be recomputed without retraining (see metrics.calc_oof_metrics,
+    metrics.calc_oof_roc_auc and metrics.calc_oof_pr_curve).
+    '''
+    def __init__(self, columns):
+        self.columns = columns
+
+    @classmethod
+    def from_folds(cls, folds):
+        '''
+        Args:
+            folds: List of (run, fold, oof) tuples, where oof is the dictionary of row_id, group,
+                y_true and proba arrays returned by train_test_fold
+        '''
+        columns = {col: [] for col in OOF_COLUMNS}
+        for run, fold, oof in folds:
+            n = len(oof['proba'])
+            columns['run'].append(np.full(n, run))
+            columns['fold'].append(np.full(n, fold))
+            for col in ['row_id', 'group', 'y_true', 'proba']:
+                columns[col].append(np.asarray(oof[col]))
+
+        columns = {col: np.concatenate(arrays) if arrays else np.array([]) for col, arrays in columns.items()}
+        if columns['group'].dtype == object:
+            columns['group'] = columns['group'].astype(str)
+        for col, dtype in OOF_COLUMNS.items():
+            if dtype is not None:
+                columns[col] = columns[col].astype(dtype)
+        return cls(columns)
+
+    @classmethod
+    def load(cls, path):
+        path = Path(path).with_suffix('.npz')
+        with np.load(path, allow_pickle=False) as data:
+            return cls({col: data[col] for col in data.files})
+
+    def save(self, path):
+        ''' Write to path (.npz) via a temp file, so a partially written file is never picked up '''
+        path = Path(path).with_suffix('.npz')
+        tmp = path.with_name(f'.{path.name}.tmp')
+        with open(tmp, 'wb') as fp:
+            np.savez(fp, **self.columns)
+        os.replace(tmp, path)
+
+    def get(self, run, fold):
+        ''' Get the predictions of a single run and fold '''
+        mask = (self.columns['run'] == run) & (self.columns['fold'] == fold)
+        return OOFPredictions({col: values[mask] for col, values in self.columns.items()})
+
+    def units(self):
+        ''' Get each (run, fold), in the order they were stored '''
+        pairs = np.stack([self.columns['run'], self.columns['fold']], axis=1)
+        _, first = np.unique(pairs, axis=0, return_index=True)
+        return [tuple(int(x) for x in pairs[i]) for i in sorted(first)]
+
+    def to_frame(self):
+        return pd.DataFrame(self.columns)
+
+    def __len__(self):
+        return len(self.columns['proba'])
+
+    def __repr__(self):
+        return '\n'.join([
+            f'Out-of-fold predictions: {len(self)}',
+            f'Runs/folds: {len(self.units())}'
+        ])
+
+def load_oof(output_path, pattern='*'):
+    ''' Load the out-of-fold predictions of every config in output_path whose filename matches pattern,
+        as a dictionary of config filename -> OOFPredictions '''
+    return {f.stem[len('oof_'):]: OOFPredictions.load(f)
+            for f in sorted(Path(output_path).glob(f'oof_{pattern}.npz'))}
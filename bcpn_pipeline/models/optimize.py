@@ -1,18 +1,29 @@
+import copy
+import math
+import numpy as np
+from joblib import Parallel, delayed
+from scipy.stats import rankdata
 from xgboost import XGBClassifier
-from sklearn.model_selection import StratifiedGroupKFold
+from sklearn.base import clone
+from sklearn.model_selection import StratifiedGroupKFold, ParameterGrid
+from sklearn.experimental import enable_halving_search_cv
+from sklearn.model_selection import HalvingGridSearchCV
 from sklearn.linear_model import LogisticRegression
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.svm import SVC
 from sklearn.metrics import roc_curve, auc, recall_score, make_scorer
-from tune_sklearn import TuneGridSearchCV
 
-# Thank you to Lee Cai, who bootstrapped a similar function in a diff project
-# Modifications have been made to suit this project.
-def tune_hyperparams(X, y, groups, method, random_state):
-    print('Getting tuned classifier using gridsearch.')
-    n_jobs = None
+from .backends import get_backend
+
+# Supported search strategies for tune_hyperparams
+SEARCHES = ['grid', 'halving', 'bayes', 'tpe']
+
+# Most of the grid a model-based search ('bayes', 'tpe') may try - past this, grid search costs about the same
+MAX_TRIALS_FRACTION = 0.5
+
+def get_search_space(method, random_state):
+    ''' Get the base model and parameter grid for a given method '''
     if method == 'LogisticR':
-        n_jobs = 1 # Ray local mode - LogisticR doesn't play well when paralellized, for my package versions
         C = [1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1, 10, 100]
         param_grid = [
             {
@@ -22,7 +33,7 @@ def tune_hyperparams(X, y, groups, method, random_state):
             },
             # {
             #     'C': C,
-            #     'penalty': ['elasticnet'], 
+            #     'penalty': ['elasticnet'],
             #     'solver': ['saga']
             # }
             # 'max_iter': [3000, 6000, 9000]
@@ -30,7 +41,6 @@ def tune_hyperparams(X, y, groups, method, random_state):
         model = LogisticRegression(random_state=random_state)
 
     elif method == 'RF':
-        n_jobs = 1 # Ray local mode
         param_grid = {
             'n_estimators': [50, 100, 250, 500],
             'max_depth': [1, 2, 3],
@@ -39,7 +49,6 @@ def tune_hyperparams(X, y, groups, method, random_state):
         model = RandomForestClassifier(oob_score=True, random_state=random_state)
 
     elif method == 'XGB':
-        n_jobs = 2
         param_grid = {
             'gamma': [0.5, 1, 3],
             'learning_rate': [0.01, 0.1, 0.3],
@@ -47,20 +56,291 @@ def tune_hyperparams(X, y, groups, method, random_state):
             'min_child_weight': [1, 5, 10],
             'n_estimators': [100, 250, 500],
             'objective': ['binary:logistic'],
-            'eval_metric': ['logloss'] 
+            'eval_metric': ['logloss']
         }
         model = XGBClassifier(use_label_encoder=False, random_state=random_state)
 
     elif method == 'SVM':
-        n_jobs = 2
         param_grid = {
             'C': [1, 10, 100],
             'gamma': [1, 0.1, 0.01, 0.001],
             'kernel': ['rbf'] # Robust to noise - no need to do RFE
         }
-        
+
         model = SVC(probability=True, random_state=random_state)
 
+    return model, param_grid
+
+class PrefixGridSearchCV:
+    '''
+    Exhaustive grid search for ensembles (RF, XGB) that fits only the largest n_estimators
+    for each combination of the other parameters and each fold.
+
+    A smaller ensemble is a prefix of a larger one with the same random_state (the first k trees
+    of a forest, or the first k boosting rounds), so smaller sizes are scored by truncating the
+    fitted model - estimators_ for random forests, iteration_range for XGBoost - rather than
+    refitting it. Scores, cv_results_ and the chosen parameters match GridSearchCV's.
+    '''
+    def __init__(self, estimator, param_grid, cv, scoring, n_jobs=None):
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.cv = cv
+        self.scoring = scoring
+        self.n_jobs = n_jobs
+
+    def fit(self, X, y, groups=None):
+        candidates = list(ParameterGrid(self.param_grid))
+        sizes = sorted({params['n_estimators'] for params in candidates})
+
+        # Each distinct combination of the other parameters is fit once per fold
+        others = []
+        for params in candidates:
+            other = {k: v for k, v in params.items() if k != 'n_estimators'}
+            if other not in others:
+                others.append(other)
+
+        splits = list(self.cv.split(X, y, groups))
+        scores = Parallel(n_jobs=self.n_jobs)(
+            delayed(_fit_and_score_prefixes)(clone(self.estimator), other, sizes, X, y, 
+                                             train_index, test_index, self.scoring)
+            for other in others for train_index, test_index in splits
+        )
+        
+        # Map scores back onto the candidates, in grid order: scores[other][split][size]
+        scores = np.array(scores).reshape(len(others), len(splits), len(sizes))
+        test_scores = np.array([
+            scores[others.index({k: v for k, v in params.items() if k != 'n_estimators'}), :, 
+                   sizes.index(params['n_estimators'])]
+            for params in candidates
+        ])
+
+        self.n_fits_ = len(others) * len(splits)
+        return _set_search_results(self, candidates, test_scores, X, y)
+
+def _set_search_results(search, candidates, test_scores, X, y):
+    ''' Fill in a search's cv_results_ and best_* attributes like GridSearchCV does,
+        given the (candidates, splits) array of test scores, then refit the best candidate '''
+    mean_scores = test_scores.mean(axis=1)
+    search.cv_results_ = {
+        'params': candidates,
+        'mean_test_score': mean_scores,
+        'std_test_score': test_scores.std(axis=1),
+        'rank_test_score': rankdata(-mean_scores, method='min').astype(np.int32)
+    }
+    for i in range(test_scores.shape[1]):
+        search.cv_results_[f'split{i}_test_score'] = test_scores[:, i]
+    for key in candidates[0]:
+        search.cv_results_[f'param_{key}'] = np.ma.MaskedArray([params[key] for params in candidates], dtype=object)
+
+    search.best_index_ = search.cv_results_['rank_test_score'].argmin()
+    search.best_params_ = candidates[search.best_index_]
+    search.best_score_ = mean_scores[search.best_index_]
+    search.best_estimator_ = clone(search.estimator).set_params(**search.best_params_).fit(X, y)
+    return search
+
+def _fit_and_score_prefixes(estimator, params, sizes, X, y, train_index, test_index, scorer):
+    ''' Fit the largest ensemble on one fold, then score every prefix size on its test set '''
+    estimator.set_params(n_estimators=max(sizes), **params)
+    estimator.fit(X[train_index], y[train_index])
+    return [scorer(_truncate(estimator, size), X[test_index], y[test_index]) for size in sizes]
+
+def _truncate(estimator, n_estimators):
+    ''' Get a view of a fitted ensemble that only uses its first n_estimators members '''
+    if isinstance(estimator, XGBClassifier):
+        return _XGBPrefix(estimator, n_estimators)
+
+    truncated = copy.copy(estimator)
+    truncated.estimators_ = estimator.estimators_[:n_estimators]
+    truncated.n_estimators = n_estimators
+    return truncated
+
+class _XGBPrefix:
+    ''' Predicts with only the first n_estimators boosting rounds of a fitted XGBClassifier '''
+    _estimator_type = 'classifier'
+
+    def __init__(self, estimator, n_estimators):
+        self.estimator = estimator
+        self.n_estimators = n_estimators
+        self.classes_ = estimator.classes_
+
+    def predict(self, X):
+        return self.estimator.predict(X, iteration_range=(0, self.n_estimators))
+
+    def predict_proba(self, X):
+        return self.estimator.predict_proba(X, iteration_range=(0, self.n_estimators))
+
+class PrecomputedKernelSearchCV:
+    '''
+    Exhaustive grid search for RBF SVMs that computes each fold's kernels once, instead of
+    once per fit.
+
+    The RBF kernel only depends on the squared distances between samples, so these are computed
+    once per inner fold (in blocks, to bound memory), for both the training set and the test set
+    against the training set. Each gamma's Gram and cross-kernel matrices are derived from them,
+    and every C is fit on those with kernel='precomputed'.
+
+    Distances can be cached in float32 to halve memory (dtype=np.float32), at the cost of tiny
+    differences in the kernel values. Since the scorer only needs predicted labels, and an SVC's
+    predictions don't depend on its probability calibration, inner fits skip Platt scaling unless
+    probability=True. The best estimator is refit on all data with the original (rbf) settings.
+    '''
+    def __init__(self, estimator, param_grid, cv, scoring, n_jobs=None, 
+                 dtype=np.float64, probability=False, block_size=2048):
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.cv = cv
+        self.scoring = scoring
+        self.n_jobs = n_jobs
+        self.dtype = dtype
+        self.probability = probability
+        self.block_size = block_size
+
+    def fit(self, X, y, groups=None):
+        candidates = list(ParameterGrid(self.param_grid))
+        splits = list(self.cv.split(X, y, groups))
+
+        # Every candidate is scored on each fold, from that fold's cached distances
+        scores = Parallel(n_jobs=self.n_jobs)(
+            delayed(self._score_fold)(X, y, train_index, test_index, candidates)
+            for train_index, test_index in splits
+        )
+        test_scores = np.array(scores).T # (candidates, splits)
+
+        self.n_fits_ = len(candidates) * len(splits)
+        self.n_kernels_ = len({params['gamma'] for params in candidates}) * len(splits)
+        return _set_search_results(self, candidates, test_scores, X, y)
+
+    def _score_fold(self, X, y, train_index, test_index, candidates):
+        X_train, X_test = X[train_index], X[test_index]
+        y_train, y_test = y[train_index], y[test_index]
+
+        dist_train = squared_distances(X_train, X_train, self.dtype, self.block_size)
+        dist_test = squared_distances(X_test, X_train, self.dtype, self.block_size)
+
+        # Go gamma by gamma, so only one set of kernels is held at a time
+        scores = [None] * len(candidates)
+        for gamma in dict.fromkeys(params['gamma'] for params in candidates):
+            K_train = np.exp(-gamma * dist_train, dtype=np.float64)
+            K_test = np.exp(-gamma * dist_test, dtype=np.float64)
+
+            for i, params in enumerate(candidates):
+                if params['gamma'] != gamma:
+                    continue
+                params = {**params, 'kernel': 'precomputed', 'probability': self.probability}
+                svm = clone(self.estimator).set_params(**params).fit(K_train, y_train)
+                scores[i] = self.scoring(svm, K_test, y_test)
+        return scores
+
+class LogisticPathSearchCV:
+    '''
+    Grid search for logistic regression that walks the regularization path in each fold,
+    rather than fitting every C from scratch.
+
+    For each combination of the other parameters (e.g., solver), C is swept from strongest to
+    weakest regularization, and each fit is warm-started from the previous solution (for solvers
+    that support it, like lbfgs). Each point on the path is scored with the scorer, and results
+    are reported like GridSearchCV's. Runs in-process, without Ray.
+    '''
+    WARM_START_SOLVERS = ['lbfgs', 'newton-cg', 'newton-cholesky', 'sag', 'saga']
+
+    def __init__(self, estimator, param_grid, cv, scoring, n_jobs=None):
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.cv = cv
+        self.scoring = scoring
+        self.n_jobs = n_jobs
+
+    def fit(self, X, y, groups=None):
+        candidates = list(ParameterGrid(self.param_grid))
+        splits = list(self.cv.split(X, y, groups))
+
+        scores = Parallel(n_jobs=self.n_jobs)(
+            delayed(self._score_fold)(X, y, train_index, test_index, candidates)
+            for train_index, test_index in splits
+        )
+        test_scores = np.array(scores).T # (candidates, splits)
+
+        self.n_fits_ = len(candidates) * len(splits)
+        return _set_search_results(self, candidates, test_scores, X, y)
+
+    def _score_fold(self, X, y, train_index, test_index, candidates):
+        X_train, X_test = X[train_index], X[test_index]
+        y_train, y_test = y[train_index], y[test_index]
+
+        # One path per combination of the other parameters
+        paths = {}
+        for i, params in enumerate(candidates):
+            other = tuple(sorted((k, v) for k, v in params.items() if k != 'C'))
+            paths.setdefault(other, []).append(i)
+
+        scores = [None] * len(candidates)
+        for other, path in paths.items():
+            other = dict(other)
+            solver = other.get('solver', self.estimator.get_params()['solver'])
+            clf = clone(self.estimator).set_params(warm_start=solver in self.WARM_START_SOLVERS, **other)
+
+            # From strongest (smallest C) to weakest regularization
+            for i in sorted(path, key=lambda i: candidates[i]['C']):
+                clf.set_params(C=candidates[i]['C'])
+                clf.fit(X_train, y_train)
+                scores[i] = self.scoring(clf, X_test, y_test)
+        return scores
+
+def squared_distances(A, B, dtype=np.float64, block_size=2048):
+    ''' Squared euclidean distances between the rows of A and B, computed in blocks of rows of A '''
+    out = np.empty((A.shape[0], B.shape[0]), dtype=dtype)
+    B_sq = np.einsum('ij,ij->i', B, B)
+    for start in range(0, A.shape[0], block_size):
+        block = A[start:start + block_size]
+        dist = np.einsum('ij,ij->i', block, block)[:, None] + B_sq[None, :] - 2 * block @ B.T
+        np.maximum(dist, 0, out=dist)
+        out[start:start + block_size] = dist
+    return out
+
+# Thank you to Lee Cai, who bootstrapped a similar function in a diff project
+# Modifications have been made to suit this project.
+def tune_hyperparams(X, y, groups, method, random_state, search='grid', n_trials=50, 
+                     reuse_prefixes=True, precompute_kernels=True, warm_start_path=True,
+                     backend=None):
+    '''
+    Get a tuned classifier for the given method.
+
+    Args:
+        search: How to search the parameter grid. One of
+            'grid' - exhaustive grid search (the default)
+            'halving' - successive halving over the grid. Ensembles (RF, XGB) use n_estimators
+                as the resource, other methods use the number of samples
+            'bayes' - Bayesian optimization (Gaussian process) over the grid, with a budget of n_trials.
+                On the joblib backend, this uses Optuna's GP sampler where torch is installed, and
+                multivariate TPE otherwise
+            'tpe' - Tree-structured Parzen Estimator search over the grid, with a budget of n_trials
+
+        n_trials: Number of distinct configurations to try for 'bayes' and 'tpe'. Capped at
+            MAX_TRIALS_FRACTION of the grid searched (rounded up).
+
+        reuse_prefixes: For grid search over RF and XGB, fit only the largest n_estimators and
+            score the smaller ones from it (see PrefixGridSearchCV).
+
+        precompute_kernels: For grid search over SVM, compute each inner fold's kernels once and
+            fit every C on them (see PrecomputedKernelSearchCV).
+
+        warm_start_path: For grid search over LogisticR, sweep C along a warm-started
+            regularization path in each fold (see LogisticPathSearchCV).
+
+        backend: Where to run the search - 'joblib' (the default), 'ray', or an existing
+            backend, so every search in a session shares it (see backends.get_backend).
+            The search strategies above that don't need Ray always run locally, on the
+            backend's n_jobs.
+    '''
+    if search not in SEARCHES:
+        raise ValueError(f'Unknown search {search}. Must be one of {SEARCHES}.')
+
+    backend = get_backend(backend)
+    backend.check_search(search)
+
+    print('Getting tuned classifier using %s search.' % search)
+    model, param_grid = get_search_space(method, random_state)
+    n_jobs = backend.get_n_jobs(method)
     print('n_jobs = ' + str(n_jobs))
 
     cv = StratifiedGroupKFold(n_splits=5, shuffle=True, random_state=random_state)
@@ -68,9 +348,85 @@ def tune_hyperparams(X, y, groups, method, random_state):
     # Create custom scorer for specificity
     scorer = make_scorer(recall_score, pos_label=0)
 
-    tune_search = TuneGridSearchCV(estimator=model, param_grid=param_grid,
-                                   cv=cv, scoring=scorer,  n_jobs=n_jobs,
-                                   verbose=2)
+    n_candidates = len(ParameterGrid(param_grid))
+
+    if search == 'grid' and reuse_prefixes and (method == 'RF' or method == 'XGB'):
+        tune_search = PrefixGridSearchCV(estimator=model, param_grid=param_grid,
+                                         cv=cv, scoring=scorer, n_jobs=n_jobs)
+        tune_search.fit(X.values, y.values, groups)
+        n_fits = tune_search.n_fits_
+
+    elif search == 'grid' and precompute_kernels and method == 'SVM':
+        tune_search = PrecomputedKernelSearchCV(estimator=model, param_grid=param_grid,
+                                                cv=cv, scoring=scorer, n_jobs=n_jobs)
+        tune_search.fit(X.values, y.values, groups)
+        n_fits = tune_search.n_fits_
+
+    elif search == 'grid' and warm_start_path and method == 'LogisticR':
+        tune_search = LogisticPathSearchCV(estimator=model, param_grid=param_grid,
+                                           cv=cv, scoring=scorer, n_jobs=n_jobs)
+        tune_search.fit(X.values, y.values, groups)
+        n_fits = tune_search.n_fits_
+
+    elif search == 'grid':
+        tune_search = backend.grid_search(estimator=model, param_grid=param_grid,
+                                          cv=cv, scoring=scorer, n_jobs=n_jobs)
+        tune_search.fit(X.values, y.values, groups=groups)
+        n_fits = n_candidates * cv.get_n_splits()
+
+    elif search == 'halving':
+        ''' Successive halving - every candidate gets a small budget, and only the best third
+            moves on to the next round, with 3x the budget '''
+        factor = 3
+        refit = True
+        if method == 'RF' or method == 'XGB':
+            ''' Ensembles use n_estimators as the resource. Start the rounds at max // factor**k, so
+                the last round scores (all but at most factor**k of) the largest n_estimators in the
+                grid, and refit the best configuration with it, rather than with the last round's '''
+            n_estimators = param_grid['n_estimators']
+            param_grid = {k: v for k, v in param_grid.items() if k != 'n_estimators'}
+            n_candidates_left, n_rounds = len(ParameterGrid(param_grid)), 1
+            while n_candidates_left >= factor and min(n_estimators) * factor**n_rounds <= max(n_estimators):
+                n_candidates_left //= factor
+                n_rounds += 1
+            resource = 'n_estimators'
+            max_resources = max(n_estimators)
+            min_resources = max_resources // factor**(n_rounds - 1)
+            refit = False
+        else:
+            resource = 'n_samples'
+            min_resources, max_resources = 'smallest', 'auto'
+
+        tune_search = HalvingGridSearchCV(estimator=model, param_grid=param_grid,
+                                          cv=cv, scoring=scorer, factor=factor, resource=resource,
+                                          min_resources=min_resources, max_resources=max_resources,
+                                          refit=refit, random_state=random_state, n_jobs=n_jobs, verbose=1)
+        tune_search.fit(X.values, y.values, groups=groups)
+        n_fits = sum(tune_search.n_candidates_) * cv.get_n_splits()
+
+        if not refit:
+            best_params = {**tune_search.best_params_, 'n_estimators': max_resources}
+            tune_search.best_estimator_ = clone(model).set_params(**best_params).fit(X.values, y.values)
+
+    else:
+        ''' Model-based search with a fixed budget. Lists in the grid are treated as categorical
+            choices, so the search space is the same as for grid search - only the first grid
+            of a list of grids is searched, and the budget is capped at a fraction of its size '''
+        param_distributions = param_grid[0] if isinstance(param_grid, list) else param_grid
+        grid_size = len(ParameterGrid(param_distributions))
+        max_trials = math.ceil(MAX_TRIALS_FRACTION * grid_size)
+        if n_trials > max_trials:
+            print('Capping n_trials at %i of the %i configurations in the grid.' % (max_trials, grid_size))
+            n_trials = max_trials
+        if n_trials >= grid_size:
+            print('The %s search budget covers the full grid - grid search would use as many fits.' % search)
+
+        tune_search = backend.model_search(estimator=model, param_distributions=param_distributions,
+                                           n_trials=n_trials, cv=cv, scoring=scorer, n_jobs=n_jobs,
+                                           search=search, random_state=random_state)
+        tune_search.fit(X.values, y.values, groups=groups)
+        n_fits = n_trials * cv.get_n_splits()
 
-    tune_search.fit(X.values, y.values, groups)
-    return tune_search.best_estimator_
\ No newline at end of file
+    print('%s search used %i fits (the full grid would use %i).' % (
+        search, n_fits, n_candidates * cv.get_n_splits()))
+    return tune_search.best_estimator_
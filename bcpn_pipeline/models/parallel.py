@@ -0,0 +1,60 @@
+import os
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+
+# Names accepted wherever an `executor` argument is taken
+EXECUTORS = ['serial', 'process', 'thread']
+
+class SerialExecutor(Executor):
+    ''' Runs each task as soon as it is submitted, in the calling process and thread '''
+    def submit(self, fn, /, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+def is_process_pool(executor):
+    ''' Whether tasks submitted to executor run in other processes (and so have their arguments pickled) '''
+    return isinstance(executor, ProcessPoolExecutor)
+
+def get_n_workers(executor):
+    ''' Number of tasks executor can run at once '''
+    return getattr(executor, '_max_workers', 1)
+
+@contextmanager
+def get_executor(executor=None, n_workers=None):
+    '''
+    Get an executor for independent units of work (e.g., a single method, run and fold).
+
+    Args:
+        executor: One of 'serial' (the default), 'process' (a local process pool), 'thread',
+            or an existing concurrent.futures.Executor. Existing executors are left running on exit,
+            so they can be shared across calls.
+
+        n_workers: Number of workers for process and thread pools. Defaults to the number of cores.
+
+    Yields:
+        A concurrent.futures.Executor
+    '''
+    if isinstance(executor, Executor):
+        yield executor
+        return
+
+    executor = executor or 'serial'
+    if executor not in EXECUTORS:
+        raise ValueError(f'Unknown executor {executor}. Must be one of {EXECUTORS}.')
+
+    n_workers = n_workers or os.cpu_count()
+    if executor == 'process':
+        pool = ProcessPoolExecutor(max_workers=n_workers)
+    elif executor == 'thread':
+        pool = ThreadPoolExecutor(max_workers=n_workers)
+    else:
+        pool = SerialExecutor()
+
+    try:
+        yield pool
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
@@ -4,7 +4,11 @@ import numpy as np
 import pandas as pd
 from imblearn.over_sampling import SMOTENC
 import pickle
+from concurrent.futures import Future
+from contextlib import ExitStack
+from functools import partial
 from scipy import interp
+from sklearn.base import clone
 from sklearn.experimental import enable_iterative_imputer
 from sklearn.impute import IterativeImputer
 from sklearn.preprocessing import MinMaxScaler
@@ -19,34 +23,38 @@ from xgboost import XGBClassifier
 from . import optimize
 from . import transform
 from . import metrics
-
-def train_test(X, y, id_col, clf, random_state, nominal_idx, 
-               method, select_feats, tune, importance, fpr_mean): # We care more about negative labels - those who don't adhere. Pos label is 0, for us!
-
-    tprs = [] # Array of true positive rates
-    aucs = []# Array of AUC scores
-
-    shap_tuples = []
-
-    train_res = [] # Array of dataframes of true vs pred labels
-    test_res = [] # Array of dataframes of true vs pred labels
-
-    # Set up outer CV
-    ''' Need to be splitting at the subject level
-        Thank you, Koesmahargyo et al.! ''' 
-    cv = StratifiedGroupKFold(n_splits=5, shuffle=True, random_state=random_state)
-
-    # Do prediction task
-    for train_index, test_index in cv.split(X=X, y=y, groups=X[id_col]):
+from .cache import FoldCache, estimator_config
+from .parallel import get_executor, is_process_pool, get_n_workers
+from .backends import available_cores, tuning_session
+from .ledger import get_ledger
+from .store import get_store
+from .shap_store import ShapStore
+from .oof import OOFPredictions
+from .writer import writing_session
+from ..features.shared import SharedFeatures, SharedFold
+from .. import profiling
+
+def impute_and_upsample(X, y, train_index, test_index, id_col, nominal_idx, random_state):
+    ''' Impute a single fold, then upsample its training data.
+        X may also be a SharedFeatures handle (with y=None), in which case only this fold's 
+        rows are read from shared memory. '''
+    if isinstance(X, SharedFeatures):
+        shared = X
+        X_train, y_train = shared.get_xy(train_index)
+        X_test, y_test = shared.get_xy(test_index)
+    else:
+        shared = None
         X_train, y_train = X.loc[train_index, :], y[train_index]
         X_test, y_test = X.loc[test_index, :], y[test_index]
 
-        # Do imputation
+    # Do imputation
+    with profiling.span('impute'):
         imputer = IterativeImputer(random_state=random_state)
         imputer.fit(X_train)
         X_train = transform.impute(X_train, imputer)
         X_test = transform.impute(X_test, imputer)
 
+    with profiling.span('upsample'):
         try:
             # Perform upsampling to handle class imbalance
             smote = SMOTENC(random_state=random_state, categorical_features=nominal_idx)
@@ -59,78 +67,282 @@ def train_test(X, y, id_col, clf, random_state, nominal_idx,
             print('%d neighbors for SMOTE' % k_neighbors)
             smote = SMOTENC(random_state=random_state, categorical_features=nominal_idx,
                             k_neighbors=k_neighbors)
+            if shared is not None:
+                X, y = shared.get_xy()
             X_train, y_train, upsampled_groups = transform.upsample(X, y, id_col, smote)
-  
-        # Drop the id column from the Xs - IMPORTANT!
-        X_train.drop(columns=[id_col], inplace=True)
-        X_test.drop(columns=[id_col], inplace=True)
-
-        # Format y
-        y_train = pd.Series(y_train)
-        y_test = pd.Series(y_test)
-
-        if select_feats:
-            '''Thank you @davide-nd: 
-              https://stackoverflow.com/questions/59292631/how-to-combine-gridsearchcv-and-selectfrommodel-to-reduce-the-number-of-features '''
+
+    return {'X_train': X_train, 'y_train': np.asarray(y_train), 'upsampled_groups': upsampled_groups,
+            'X_test': X_test, 'y_test': y_test}
+
+def get_splits(X, y, id_col, random_state, fold_cache=None, fingerprint=None):
+    ''' Get the outer CV splits for a run, from the cache if possible '''
+    use_cache = fold_cache is not None and fingerprint is not None
+    if use_cache:
+        splits_key = fold_cache.make_key(fingerprint, random_state, 'splits')
+        cached = fold_cache.get(splits_key)
+        if cached:
+            return cached['splits']
+
+    # Set up outer CV
+    ''' Need to be splitting at the subject level
+        Thank you, Koesmahargyo et al.! ''' 
+    cv = StratifiedGroupKFold(n_splits=5, shuffle=True, random_state=random_state)
+    splits = list(cv.split(X=X, y=y, groups=X[id_col]))
+
+    if use_cache:
+        fold_cache.put(splits_key, {'splits': splits})
+    return splits
+
+def get_fold_artifacts(pool, X, y, id_col, nominal_idx, random_state, splits, 
+                       fold_cache=None, fingerprint=None, shared=None):
+    ''' Get the imputed and upsampled data for each fold of a run. Folds missing from 
+        the cache are computed in parallel on the given executor - reading from shared, 
+        if given, rather than sending X and y to every worker. '''
+    use_cache = fold_cache is not None and fingerprint is not None
+
+    # Configs of the imputer and upsampler used in impute_and_upsample, to key the cache
+    imputer_config = estimator_config(IterativeImputer(random_state=random_state))
+    upsampler_config = estimator_config(SMOTENC(random_state=random_state, categorical_features=nominal_idx))
+
+    artifacts = [None] * len(splits)
+    futures = {}
+    for fold, (train_index, test_index) in enumerate(splits):
+        if use_cache:
+            fold_key = fold_cache.make_key(fingerprint, random_state, fold, imputer_config, upsampler_config)
+            artifacts[fold] = fold_cache.get(fold_key)
+
+        if artifacts[fold] is None:
+            prep = profiling.traced(impute_and_upsample, 'prep_fold', run=random_state, fold=fold)
+            if shared is not None:
+                futures[fold] = pool.submit(prep, shared, None, train_index, test_index, 
+                                            id_col, nominal_idx, random_state)
+            else:
+                futures[fold] = pool.submit(prep, X, y, train_index, test_index, 
+                                            id_col, nominal_idx, random_state)
+
+    for fold, future in futures.items():
+        artifacts[fold] = future.result()
+        if use_cache:
+            fold_key = fold_cache.make_key(fingerprint, random_state, fold, imputer_config, upsampler_config)
+            fold_cache.put(fold_key, artifacts[fold])
+
+    return artifacts
+
+def train_test_fold(artifacts, id_col, clf, random_state, method, select_feats, tune, importance, fpr_mean,
+                    search='grid', backend=None, n_background=100, n_explain=100):
+    ''' Train and test a single classifier on a single (imputed and upsampled) fold.
+        Doesn't modify artifacts, so the same fold can be shared by several methods. 
+        artifacts may also be a SharedFold handle, in which case the fold is read from shared memory.
+        
+        SHAP values aren't calculated here, to keep them off the critical path. If importance
+        is set, the fitted model and the samples to explain it with are returned instead,
+        to be explained later with the rest of the folds (see explain_folds). '''
+    if isinstance(artifacts, SharedFold):
+        artifacts = artifacts.get()
+
+    X_train, y_train = artifacts['X_train'], artifacts['y_train']
+    X_test, y_test = artifacts['X_test'], artifacts['y_test']
+    upsampled_groups = artifacts['upsampled_groups']
+
+    # Keep the test samples' row and group ids, to store with their out-of-fold predictions
+    test_ids = {'row_id': X_test.index.to_numpy(), 'group': X_test[id_col].to_numpy()}
+
+    # Drop the id column from the Xs - IMPORTANT!
+    X_train = X_train.drop(columns=[id_col])
+    X_test = X_test.drop(columns=[id_col])
+
+    # Format y
+    y_train = pd.Series(y_train)
+    y_test = pd.Series(y_test)
+
+    if select_feats:
+        '''Thank you @davide-nd: 
+          https://stackoverflow.com/questions/59292631/how-to-combine-gridsearchcv-and-selectfrommodel-to-reduce-the-number-of-features '''
+        with profiling.span('select'):
             selector = SelectFromModel(estimator=RandomForestClassifier(max_depth=1, random_state=random_state))
             selector.fit(X_train, y_train)
 
             X_train = X_train.iloc[:,selector.get_support()]
             X_test = X_test.iloc[:,selector.get_support()]
 
-        if method == 'LogisticR' or method == 'SVM':
-            
-            ''' Perform Scaling
-                Thank you @miriam-farber
-                https://stackoverflow.com/questions/45188319/sklearn-standardscaler-can-effect-test-matrix-result
-            '''
+    if method == 'LogisticR' or method == 'SVM':
+        
+        ''' Perform Scaling
+            Thank you @miriam-farber
+            https://stackoverflow.com/questions/45188319/sklearn-standardscaler-can-effect-test-matrix-result
+        '''
+        with profiling.span('scale'):
             scaler = MinMaxScaler(feature_range=(0, 1))
             X_train = transform.scale(X_train, scaler)
             X_test = transform.scale(X_test, scaler)
 
-        # Replace our default classifier clf with a tuned one
-        if tune:
+    # Replace our default classifier clf with a tuned one
+    if tune:
+        with profiling.span('tune', search=search):
             clf = optimize.tune_hyperparams(X=X_train, y=y_train, groups=upsampled_groups, 
-                                   method=method, random_state=random_state)
-        else:
+                                   method=method, random_state=random_state, search=search,
+                                   backend=backend)
+    else:
+        with profiling.span('fit'):
             clf.fit(X_train.values, y_train.values)
-    
-        print('Training and testing.')
 
-        # Be sure to store the training results so we can check for overfitting later
+    print('Training and testing.')
+
+    # Be sure to store the training results so we can check for overfitting later
+    with profiling.span('predict'):
         y_train_pred = clf.predict(X_train.values)
         y_test_pred = clf.predict(X_test.values)
         y_test_probas = clf.predict_proba(X_test.values)[:, 1]
 
-        # Store TPR and AUC
-        # Thank you sklearn documentation https://scikit-learn.org/stable/auto_examples/model_selection/plot_roc_crossval.html
-        # Note we do not change pos_label here. Re-read Gu et al for explanation - focus is specificity for scoring, but not for curves
-        fpr, tpr, thresholds = roc_curve(y_test, y_test_probas) 
-        tprs.append(interp(fpr_mean, fpr, tpr))
-        tprs[-1][0] = 0.0
-        roc_auc = auc(fpr, tpr)
-        aucs.append(roc_auc)
-    
-        # Store predicted and y_true target values in dataframe
-        train_res.append(pd.DataFrame({'y_pred': y_train_pred, 'y_true': y_train}))
-        test_res.append(pd.DataFrame({'y_pred': y_test_pred, 'y_true': y_test}))
+    # Store TPR and AUC
+    # Thank you sklearn documentation https://scikit-learn.org/stable/auto_examples/model_selection/plot_roc_crossval.html
+    # Note we do not change pos_label here. Re-read Gu et al for explanation - focus is specificity for scoring, but not for curves
+    fpr, tpr, thresholds = roc_curve(y_test, y_test_probas) 
+    tpr_interp = interp(fpr_mean, fpr, tpr)
+    tpr_interp[0] = 0.0
+    roc_auc = auc(fpr, tpr)
 
-        if importance:
-            feats = list(X_test.columns)
-            explainer, shap_values = metrics.calc_shap(X_train, X_test, clf, method, random_state)
-            shap_tuples.append((feats, explainer, shap_values))
+    # Store predicted and y_true target values in dataframe
+    res = {'tpr': tpr_interp, 'auc': roc_auc,
+           'train_res': pd.DataFrame({'y_pred': y_train_pred, 'y_true': y_train}),
+           'test_res': pd.DataFrame({'y_pred': y_test_pred, 'y_true': y_test}),
+           'oof': {**test_ids, 'y_true': y_test.to_numpy(), 'proba': y_test_probas}}
 
-    train_res = pd.concat(train_res, copy=True)
-    test_res = pd.concat(test_res, copy=True)
-    
-    ret = {'tprs': tprs, 'aucs': aucs, 'train_res': train_res, 'test_res': test_res}
     if importance:
-        ret.update({'shap_tuples': shap_tuples})
+        X_background, X_explain = metrics.sample_shap_data(X_train, X_test, random_state, n_background, n_explain)
+        res['shap_job'] = {'X_train': X_background, 'X_test': X_explain, 'model': clf, 'method': method,
+                           'random_state': random_state, 'n_background': n_background, 'n_explain': n_explain}
+
+    return res
+
+def merge_fold_results(fold_results, importance):
+    ''' Combine the results of each fold of a run, in fold order '''
+    train_res = pd.concat([res['train_res'] for res in fold_results], copy=True)
+    test_res = pd.concat([res['test_res'] for res in fold_results], copy=True)
+
+    ret = {'tprs': [res['tpr'] for res in fold_results], 'aucs': [res['auc'] for res in fold_results], 
+           'train_res': train_res, 'test_res': test_res, 'oofs': [res['oof'] for res in fold_results]}
+    if importance:
+        ret.update({'shap_jobs': [res['shap_job'] for res in fold_results]})
 
     return ret
 
+def explain_folds(shap_jobs, executor='process', n_workers=None, return_explainers=False):
+    ''' Calculate the SHAP values of many folds' shap jobs (from train_test_fold) at once, in parallel.
+        Returns a (feats, explainer, shap_values) tuple for each, in the same order. '''
+    explained = metrics.calc_shap_batch(shap_jobs, executor, n_workers, return_explainers)
+    return [(list(job['X_test'].columns), explainer, shap_values)
+            for job, (explainer, shap_values) in zip(shap_jobs, explained)]
+
+def train_test(X, y, id_col, clf, random_state, nominal_idx, 
+               method, select_feats, tune, importance, fpr_mean,
+               fold_cache=None, fingerprint=None, executor=None, n_workers=None, search='grid',
+               backend=None): # We care more about negative labels - those who don't adhere. Pos label is 0, for us!
+
+    ''' If given a fold cache, CV splits and imputed/upsampled folds are shared with every
+        other method trained on this featureset (identified by its fingerprint) and run.
+        Folds are trained on the given executor (see parallel.get_executor), each with its own
+        copy of clf, and merged back in fold order. Tuning runs on the given backend
+        (see backends.get_backend), which is shared by every fold. '''
+    with get_executor(executor, n_workers) as pool, \
+         tuning_session(backend, _tuning_jobs(pool)) as backend:
+        if tune:
+            backend.start()
+        splits = get_splits(X, y, id_col, random_state, fold_cache, fingerprint)
+        artifacts = get_fold_artifacts(pool, X, y, id_col, nominal_idx, random_state, splits, 
+                                       fold_cache, fingerprint)
+
+        futures = [pool.submit(profiling.traced(train_test_fold, 'train_test_fold', method=method, 
+                                                run=random_state, fold=fold), 
+                               fold_artifacts, id_col, clone(clf) if clf is not None else None, random_state, method, 
+                               select_feats, tune, importance, fpr_mean, search, backend)
+                   for fold, fold_artifacts in enumerate(artifacts)]
+        res = merge_fold_results([future.result() for future in futures], importance)
+
+        if importance:
+            res['shap_tuples'] = explain_folds(res.pop('shap_jobs'), pool, return_explainers=True)
+        return res
+
+def _tuning_jobs(pool):
+    ''' Split the available cores between the executor's workers, so searches running
+        at the same time don't oversubscribe the machine '''
+    return max(1, available_cores() // get_n_workers(pool))
+
+def init_classifier(method, max_depth, random_state):
+    ''' Get a default classifier for the given method, along with the max_depth to record for it '''
+    if method == 'RF' or method == 'XGB':
+        if method == 'RF':
+            clf = RandomForestClassifier(max_depth=max_depth, random_state=random_state)
+        else:
+            clf = XGBClassifier(
+                max_depth=max_depth, 
+                objective='binary:logistic', 
+                eval_metric='logloss',
+                use_label_encoder=False, 
+                random_state=random_state
+                )
+        return clf, max_depth
+
+    if method == 'LogisticR':
+        clf = LogisticRegression(solver='liblinear', random_state=random_state)
+
+    elif method == 'SVM':
+        clf = SVC(probability=True, random_state=random_state)
+
+    return clf, 'NA'
+
+def _completed(result):
+    ''' Wrap an already computed result, so it can stand in for a submitted unit of work '''
+    future = Future()
+    future.set_result(result)
+    return future
+
+def _share_fold(stack, artifacts, id_col):
+    ''' Move a fold's artifacts into shared memory, to be freed when stack exits - unless they
+        have columns a shared block can't hold, in which case they're sent to workers as they are '''
+    if not SharedFold.can_share(artifacts):
+        return artifacts
+    fold = SharedFold.create(artifacts, id_col)
+    stack.callback(fold.unlink)
+    return fold
+
+def _record_unit(ledger, key, future):
+    if future.exception() is None:
+        ledger.record(key, future.result())
+
 def predict(fs, output_path, n_runs=5, select_feats=False,
-            tune=False, importance=False, **kwargs):
+            tune=False, importance=False, fold_cache=None, executor=None, n_workers=None, 
+            share_memory=None, search='grid', backend=None, ledger=None, store=None, 
+            save_explainers=False, shap_executor='process', shap_samples=100, shap_background=100, 
+            writer=None, **kwargs):
+
+    ''' Imputed/upsampled folds depend only on the featureset and run, so share them
+        across all methods. By default, hold every fold of every run in memory - or, if 
+        share_memory (the default for process pools), in shared memory, where every 
+        (method, run, fold) unit reads its fold from, rather than getting a pickled copy of it.
+        
+        If given a ledger (or a path for one), every (method, run, fold) is checkpointed to it
+        as soon as it completes, and units already in it are loaded rather than recomputed. 
+        
+        If given a results store (or a path for one), each method's metrics, ROC and AUC are
+        written to it instead of to CSVs. 
+        
+        SHAP values are calculated after all training is done, for every method, run and fold at once,
+        on shap_executor (worker processes, by default). Each fold explains up to shap_samples test samples,
+        against up to shap_background training samples. Set importance='defer' to save what's needed to
+        explain them instead, and calculate them later with explain_deferred.
+
+        SHAP values of every run and fold are stored together (see ShapStore). Pickles of each
+        fold's explainer and shap values are only written if save_explainers is set. 
+        
+        Every output is written in the background by writer (see ResultWriter), or by one started 
+        for this call, and is complete on return. '''
+    default_cache = fold_cache is None
+    if default_cache:
+        fold_cache = FoldCache(max_items=n_runs * 6) # 5 folds + the splits themselves, per run
+    fingerprint = fs.fingerprint()
+    ledger = get_ledger(ledger)
+    store = get_store(store)
 
     common_fields = {'n_lags': fs.n_lags, 'featureset': fs.name, 'features_selected': select_feats, 
                      'tuned': tune, 'target': fs.target_col}
@@ -144,138 +356,238 @@ def predict(fs, output_path, n_runs=5, select_feats=False,
         if kwargs.get('models'):
             common_fields.pop('models') # This is a dictionary - don't include it
 
+    # Only record the search strategy if it's not the default, so grid search results are unchanged
+    if tune and search != 'grid':
+        common_fields.update({'search': search})
+
     models = kwargs.get('models')
     models = dict.fromkeys(['LogisticR', 'RF', 'XGB', 'SVM']) if not models else models
 
-    for method, clf in models.items():
-        tprs = [] # Array of true positive rates
-        aucs = []# Array of AUC scores
-        fpr_mean = np.linspace(0, 1, 100)
-        
-        all_res = []
+    fpr_mean = np.linspace(0, 1, 100)
 
-        # Do repeated runs
-        for run in range(0, n_runs):
-            random_state = run
+    # Split into inputs and labels
+    X = fs.df.drop(columns=[fs.target_col])
+    y = fs.df[fs.target_col]
+
+    # Get list of indices of nominal columns for SMOTE-NC upsampling, used in train_test
+    # Safeguard to ensure we're getting the right indices
+    nominal_cols = [col for col in X.columns if col in fs.nominal_cols]
+    nominal_idx = sorted([X.columns.get_loc(c) for c in nominal_cols])
 
+    # Get the classifier (and max_depth to record, if it was initialized here) for each method and run
+    plans = {}
+    for method, clf in models.items():
+        plans[method] = []
+        for run in range(0, n_runs):
+            max_depth_field = None
             if clf is None:
-                
                 # Chose to initialize methods here so that random_state could be controlled by the run number
-                if method == 'RF' or method == 'XGB':
-                    common_fields.update({'max_depth': max_depth})
-                    
-                    if method == 'RF':
-                        clf = RandomForestClassifier(max_depth=max_depth, random_state=random_state)
-                    else:
-                        clf = XGBClassifier(
-                            max_depth=max_depth, 
-                            objective='binary:logistic', 
-                            eval_metric='logloss',
-                            use_label_encoder=False, 
-                            random_state=random_state
-                            )
-                else:
-                    common_fields.update({'max_depth': 'NA'})
+                clf, max_depth_field = init_classifier(method, max_depth, random_state=run)
+            plans[method].append((run, clf, max_depth_field))
+
+    ''' Every (method, run, fold) is an independent unit of work, seeded by its run number.
+        Schedule them all up front, then merge the results back in order, so the outputs 
+        are the same regardless of executor. All tuning in this call shares one backend session,
+        started before any work is handed out, so workers attach to it rather than starting their own. '''
+    with profiling.span('predict', featureset=fs.name, n_lags=fs.n_lags, max_depth=max_depth, tuned=tune), \
+         writing_session(writer) as writer:
+        # Shared folds are freed on exit, once the pool has shut down
+        with ExitStack() as shared_folds, \
+             get_executor(executor, n_workers) as pool, \
+             tuning_session(backend, _tuning_jobs(pool)) as backend:
+            if tune:
+                backend.check_search(search)
+                backend.start()
+
+            # Process workers read the featureset, and then each fold, from shared memory, rather than each getting a copy
+            if share_memory is None:
+                share_memory = is_process_pool(pool)
+            shared = fs.to_shared() if share_memory else None
+
+            # Shared folds only need to be held once - in shared memory, not also in a cache only this call uses
+            if share_memory and default_cache:
+                fold_cache = None
+
+            try:
+                splits = {run: get_splits(X, y, fs.id_col, run, fold_cache, fingerprint) for run in range(0, n_runs)}
+
+                # Load units finished by an earlier call from the ledger
+                keys, finished = {}, {}
+                if ledger is not None:
+                    for method, plan in plans.items():
+                        for run, clf, max_depth_field in plan:
+                            for fold in range(len(splits[run])):
+                                keys[(method, run, fold)] = ledger.make_key(
+                                    fingerprint=fingerprint, n_lags=fs.n_lags, 
+                                    max_depth=max_depth if max_depth_field is None else max_depth_field,
+                                    method=method, run=run, fold=fold, tuned=tune, select_feats=select_feats,
+                                    search=search, importance=bool(importance), 
+                                    shap_budget=(shap_background, shap_samples) if importance else None,
+                                    estimator=estimator_config(clf))
+                                result = ledger.get(keys[(method, run, fold)])
+                                if result is not None:
+                                    finished[(method, run, fold)] = result
+                    print('%i of %i units already in the ledger.' % (len(finished), len(keys)))
+
+                # Only impute and upsample runs that still have work left
+                fold_artifacts = {}
+                for run in range(0, n_runs):
+                    if any((method, run, fold) not in finished
+                           for method in plans for fold in range(len(splits[run]))):
+                        fold_artifacts[run] = get_fold_artifacts(pool, X, y, fs.id_col, nominal_idx, run, splits[run],
+                                                                 fold_cache, fingerprint, shared)
+                        if share_memory:
+                            fold_artifacts[run] = [_share_fold(shared_folds, artifacts, fs.id_col)
+                                                   for artifacts in fold_artifacts[run]]
+            finally:
+                if shared is not None:
+                    shared.unlink()
+
+            futures = {}
+            pending_shap = {}
+            for method, plan in plans.items():
+                for run, clf, _ in plan:
+                    futures[(method, run)] = []
+                    for fold in range(len(splits[run])):
+                        if (method, run, fold) in finished:
+                            futures[(method, run)].append(_completed(finished[(method, run, fold)]))
+                            continue
+
+                        unit = profiling.traced(train_test_fold, 'train_test_fold', method=method, run=run, fold=fold)
+                        future = pool.submit(unit, fold_artifacts[run][fold], fs.id_col, clone(clf), 
+                                             run, method, select_feats, tune, importance, fpr_mean, search, backend,
+                                             shap_background, shap_samples)
+                        if ledger is not None:
+                            future.add_done_callback(partial(_record_unit, ledger, keys[(method, run, fold)]))
+                        futures[(method, run)].append(future)
+        
+            for method, plan in plans.items():
+                tprs = [] # Array of true positive rates
+                aucs = []# Array of AUC scores
+            
+                all_res = []
+                shap_folds = []
+                oof_folds = []
 
-                    if method == 'LogisticR':
-                        clf = LogisticRegression(solver='liblinear', random_state=random_state)
+                # Do repeated runs
+                for run, clf, max_depth_field in plan:
+                    random_state = run
 
-                    elif method == 'SVM':
-                        clf = SVC(probability=True, random_state=random_state)
+                    if max_depth_field is not None:
+                        common_fields.update({'max_depth': max_depth_field})
 
-            # Do training and testing
-            print('Run %i of %i for %s model.' % (run + 1, n_runs, method))
+                    # Do training and testing
+                    print('Run %i of %i for %s model.' % (run + 1, n_runs, method))
+                    res = merge_fold_results([future.result() for future in futures[(method, run)]], importance)
 
-            # Split into inputs and labels
-            X = fs.df.drop(columns=[fs.target_col])
-            y = fs.df[fs.target_col]
+                    # Keep every fold's out-of-fold predictions, so metrics can be recomputed without retraining
+                    oof_folds.extend((run, fold, oof) for fold, oof in enumerate(res['oofs']))
 
-            # Get list of indices of nominal columns for SMOTE-NC upsampling, used in train_test
-            # Safeguard to ensure we're getting the right indices
-            nominal_cols = [col for col in X.columns if col in fs.nominal_cols]
-            nominal_idx = sorted([X.columns.get_loc(c) for c in nominal_cols])
-            
-            # Do training and testing
-            res = train_test(X=X, y=y, id_col=fs.id_col, clf=clf, random_state=random_state, 
-                             nominal_idx=nominal_idx, method=method, select_feats=select_feats,
-                             tune=tune, importance=importance, fpr_mean=fpr_mean)
-
-            # Get and save all the shap values
-            if importance:
-                # Save shap values
-                print('Saving shap values for each fold of this run...')
-                fold = 0                
-                for (feats, explainer, shap_values) in res['shap_tuples']:
-
-                    filename = f'{fs.name}_{method}_{fs.n_lags}_lags'
-                    
-                    if max_depth:
-                        filename += f'_max_depth_{max_depth}'
-
-                    if tune:
-                        filename += '_tuned'
-                    
-                    filename = f'{filename}_run_{run}_fold_{fold}'
-
-                    with open(Path.joinpath(output_path, f'feats_{filename}.pkl'), 'wb') as fp:
-                        pickle.dump(feats, fp)
-
-                    with open(Path.joinpath(output_path, f'shap_explainer_{filename}.pkl'), 'wb') as fp:
-                        pickle.dump(explainer, fp)
-                        
-                    with open(Path.joinpath(output_path, f'shap_values_{filename}.pkl'), 'wb') as fp:
-                        pickle.dump(shap_values, fp)
-
-                    fold += 1
+                    # Collect every fold's shap job, to be explained once all training is done
+                    if importance:
+                        shap_folds.extend((run, fold, job) for fold, job in enumerate(res['shap_jobs']))
                 
-            # Save all relevant stats
-            print('Calculating predictive performance for this run.')
-
-            # Get train and test results as separate dictionaries
-            train_perf_metrics = metrics.calc_performance_metrics(
-                y_true=res['train_res']['y_true'], y_pred=res['train_res']['y_pred']
-            )
-            test_perf_metrics = metrics.calc_performance_metrics(
-                y_true=res['test_res']['y_true'], y_pred=res['test_res']['y_pred']
-            )
-
-            train_perf_metrics.update({'type': 'train'})
-            test_perf_metrics.update({'type': 'test'})
+                    # Save all relevant stats
+                    print('Calculating predictive performance for this run.')
+
+                    # Get train and test results as separate dictionaries
+                    train_perf_metrics = metrics.calc_performance_metrics(
+                        y_true=res['train_res']['y_true'], y_pred=res['train_res']['y_pred']
+                    )
+                    test_perf_metrics = metrics.calc_performance_metrics(
+                        y_true=res['test_res']['y_true'], y_pred=res['test_res']['y_pred']
+                    )
+
+                    train_perf_metrics.update({'type': 'train'})
+                    test_perf_metrics.update({'type': 'test'})
             
-            common_fields.update({'method': method, 'run': run, 'random_state': random_state,
-                                  'n_features': X.shape[1], 'n_samples': X.shape[0]})
+                    common_fields.update({'method': method, 'run': run, 'random_state': random_state,
+                                          'n_features': X.shape[1], 'n_samples': X.shape[0]})
             
-            for d in [train_perf_metrics, test_perf_metrics]:
-                d.update(common_fields)
-                all_res.append(pd.DataFrame([d]))
+                    for d in [train_perf_metrics, test_perf_metrics]:
+                        d.update(common_fields)
+                        all_res.append(pd.DataFrame([d]))
             
-            # TPR and AUC will be calculated across all runs and folds at the very end
-            tprs.extend(res['tprs'])
-            aucs.extend(res['aucs'])
+                    # TPR and AUC will be calculated across all runs and folds at the very end
+                    tprs.extend(res['tprs'])
+                    aucs.extend(res['aucs'])
 
-            print('Prediction task complete!')
+                    print('Prediction task complete!')
 
-        print('Saving performance metrics for all runs.')
+                print('Saving performance metrics for all runs.')
 
-        # Combine individual run results
-        filename = f'{fs.name}_{method}_{fs.n_lags}_lags'
+                # Combine individual run results
+                filename = f'{fs.name}_{method}_{fs.n_lags}_lags'
         
-        if max_depth:
-            filename += f'_max_depth_{max_depth}'
+                if max_depth:
+                    filename += f'_max_depth_{max_depth}'
 
-        if tune:
-            filename += '_tuned'
+                if tune:
+                    filename += '_tuned' if search == 'grid' else f'_tuned_{search}'
+
+                pred_res = pd.concat(all_res)
+                writer.submit(OOFPredictions.from_folds(oof_folds).save, Path.joinpath(output_path, f'oof_{filename}.npz'))
 
-        pd.concat(all_res).to_csv(Path.joinpath(output_path, f'{filename}_pred.csv'))
+                if importance:
+                    pending_shap[filename] = shap_folds
 
-        # Calculate aggregate AUC and ROC
-        test_roc_res, test_auc_res = metrics.get_mean_roc_auc(tprs, aucs, fpr_mean)
-        common_fields.update({'run': -1}) # Indicates these are aggregated results
+                # Calculate aggregate AUC and ROC
+                test_roc_res, test_auc_res = metrics.get_mean_roc_auc(tprs, aucs, fpr_mean)
+                common_fields.update({'run': -1}) # Indicates these are aggregated results
         
-        # Save AUC and ROC
-        test_roc_res.update(common_fields)
-        test_auc_res.update(common_fields)
+                # Save AUC and ROC
+                test_roc_res.update(common_fields)
+                test_auc_res.update(common_fields)
 
-        pd.DataFrame.from_dict(test_roc_res).to_csv(Path.joinpath(output_path, f'{filename}_roc.csv'))
-        pd.DataFrame([test_auc_res]).to_csv(Path.joinpath(output_path, f'{filename}_auc.csv'))
+                if store is not None:
+                    writer.submit(store.write, pred_res, pd.DataFrame.from_dict(test_roc_res), pd.DataFrame([test_auc_res]))
+                else:
+                    writer.write_csv(pred_res, Path.joinpath(output_path, f'{filename}_pred.csv'))
+                    writer.write_csv(pd.DataFrame.from_dict(test_roc_res), Path.joinpath(output_path, f'{filename}_roc.csv'))
+                    writer.write_csv(pd.DataFrame([test_auc_res]), Path.joinpath(output_path, f'{filename}_auc.csv'))
+
+        if importance == 'defer':
+            for filename, shap_folds in pending_shap.items():
+                print('Deferring shap values for %s.' % filename)
+                writer.write_pickle(shap_folds, Path.joinpath(output_path, f'shap_jobs_{filename}.pkl'))
+
+        elif importance:
+            store_shap(output_path, pending_shap, shap_executor, n_workers, save_explainers, writer)
+
+def store_shap(output_path, pending_shap, executor='process', n_workers=None, save_explainers=False, writer=None):
+    ''' Explain every fold of every config in pending_shap (filename -> list of (run, fold, shap job))
+        in one batch, then store each config's SHAP values (see ShapStore), written in the background
+        by writer (see ResultWriter) '''
+    jobs = [job for shap_folds in pending_shap.values() for _, _, job in shap_folds]
+    explained = iter(explain_folds(jobs, executor, n_workers, return_explainers=save_explainers))
+
+    with writing_session(writer) as writer:
+        for filename, shap_folds in pending_shap.items():
+            stored = []
+            for run, fold, _ in shap_folds:
+                feats, explainer, shap_values = next(explained)
+                stored.append((run, fold, feats, shap_values))
+
+                # Explainers are large and slow to write and reload, so only pickle them if asked
+                if save_explainers:
+                    fold_filename = f'{filename}_run_{run}_fold_{fold}'
+                    writer.write_pickle(feats, Path.joinpath(output_path, f'feats_{fold_filename}.pkl'))
+                    writer.write_pickle(explainer, Path.joinpath(output_path, f'shap_explainer_{fold_filename}.pkl'))
+                    writer.write_pickle(shap_values, Path.joinpath(output_path, f'shap_values_{fold_filename}.pkl'))
+
+            print('Saving shap values for %s.' % filename)
+            writer.submit(ShapStore.write, Path.joinpath(output_path, f'shap_{filename}'), stored)
+
+def explain_deferred(output_path, executor='process', n_workers=None, save_explainers=False, writer=None):
+    ''' Calculate and store the SHAP values deferred by predict(importance='defer') in output_path '''
+    output_path = Path(output_path)
+    pending_shap = {}
+    for f in sorted(output_path.glob('shap_jobs_*.pkl')):
+        with open(f, 'rb') as fp:
+            pending_shap[f.stem[len('shap_jobs_'):]] = pickle.load(fp)
+
+    store_shap(output_path, pending_shap, executor, n_workers, save_explainers, writer)
+
+    for filename in pending_shap:
+        Path.joinpath(output_path, f'shap_jobs_{filename}.pkl').unlink()
     
\ No newline at end of file
@@ -0,0 +1,156 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+class ShapStore:
+    '''
+    SHAP values of every run and fold of a config, stored compactly instead of as pickled
+    explainers and shap.Explanation objects.
+
+    Stored as two files:
+        {name}.npy - a single float32 array of shape (rows, n_features + 1, n_outputs), memory-mapped
+            on load. Rows are the explained samples of every run and fold, one block after another.
+            Features are the union of every fold's features (folds may select different ones),
+            with NaN where a fold doesn't have a feature. The last column holds the base values.
+        {name}.json - the feature names, number of outputs, and where each run/fold's rows are
+
+    Only the rows asked for are read from disk, so loading a single fold, or streaming through
+    every fold to get global importance, doesn't read the whole file into memory.
+    '''
+    def __init__(self, path):
+        path = Path(path)
+        self.path = path.with_suffix('') if path.suffix in ('.npy', '.json') else path
+
+        with open(self.path.with_suffix('.json')) as fp:
+            index = json.load(fp)
+
+        self.features = index['features']
+        self.n_outputs = index['n_outputs']
+        self.folds = {(fold['run'], fold['fold']): fold for fold in index['folds']}
+        self._values = None
+
+    @classmethod
+    def write(cls, path, folds):
+        '''
+        Write the SHAP values of a config.
+
+        Args:
+            path: Where to write, without a suffix (e.g. OUTPUT_PATH_PRED/shap_{filename})
+
+            folds: List of (run, fold, feats, shap_values) tuples, where shap_values is the
+                shap.Explanation of the fold's test samples, with one column per feature in feats
+        '''
+        path = Path(path)
+        if path.suffix in ('.npy', '.json'):
+            path = path.with_suffix('')
+
+        # Union of every fold's features, in order of first appearance
+        features = list(dict.fromkeys(feat for _, _, feats, _ in folds for feat in feats))
+        feature_idx = {feat: i for i, feat in enumerate(features)}
+
+        blocks = [_get_block(shap_values) for _, _, _, shap_values in folds]
+        n_outputs = max([values.shape[2] for values, _ in blocks], default=1)
+        n_rows = sum(values.shape[0] for values, _ in blocks)
+
+        tmp = path.with_name(f'.{path.name}.npy.tmp')
+        data = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32,
+                                         shape=(n_rows, len(features) + 1, n_outputs))
+        data[:] = np.nan
+
+        index = {'features': features, 'n_outputs': n_outputs, 'folds': []}
+        start = 0
+        for (run, fold, feats, _), (values, base_values) in zip(folds, blocks):
+            stop = start + values.shape[0]
+            cols = [feature_idx[feat] for feat in feats]
+            data[start:stop, cols, :values.shape[2]] = values
+            data[start:stop, -1, :base_values.shape[1]] = base_values
+            index['folds'].append({'run': int(run), 'fold': int(fold), 'start': start, 'stop': stop,
+                                   'features': cols})
+            start = stop
+
+        data.flush()
+        del data
+        os.replace(tmp, path.with_suffix('.npy'))
+
+        # The index goes last, so a config without one was never completely written
+        tmp = path.with_name(f'.{path.name}.json.tmp')
+        with open(tmp, 'w') as fp:
+            json.dump(index, fp)
+        os.replace(tmp, path.with_suffix('.json'))
+
+        return cls(path)
+
+    @property
+    def values(self):
+        ''' All stored rows, memory-mapped '''
+        if self._values is None:
+            self._values = np.load(self.path.with_suffix('.npy'), mmap_mode='r')
+        return self._values
+
+    def get(self, run, fold, output=None):
+        '''
+        Get the SHAP values, base values and feature names of a single run and fold.
+        Values have shape (samples, features, outputs), or (samples, features) if an output is given.
+        '''
+        info = self.folds[(run, fold)]
+        block = self.values[info['start']:info['stop']]
+        values = np.asarray(block[:, info['features'], :])
+        base_values = np.asarray(block[:, -1, :])
+        feats = [self.features[i] for i in info['features']]
+
+        if output is not None:
+            values, base_values = values[:, :, output], base_values[:, output]
+        return values, base_values, feats
+
+    def to_explanation(self, run, fold, output=None):
+        ''' Get a single run and fold as a shap.Explanation, for shap's plots '''
+        import shap
+        values, base_values, feats = self.get(run, fold, output)
+        return shap.Explanation(values=values, base_values=base_values, feature_names=feats)
+
+    def global_importance(self, output=-1, block_size=4096):
+        '''
+        Get the mean |SHAP value| of each feature, across every run and fold, sorted from most
+        to least important. Streams through the stored rows a block at a time.
+
+        Args:
+            output: Which model output to use. Defaults to the last one, which is the
+                positive class for models with an output per class.
+        '''
+        values = self.values
+        total = np.zeros(len(self.features))
+        count = np.zeros(len(self.features))
+
+        for start in range(0, values.shape[0], block_size):
+            block = np.abs(values[start:start + block_size, :-1, output], dtype=np.float64)
+            present = ~np.isnan(block)
+            total += np.where(present, block, 0).sum(axis=0)
+            count += present.sum(axis=0)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            importance = pd.Series(total / count, index=self.features, name='mean(|SHAP value|)')
+        return importance.sort_values(ascending=False)
+
+    def __repr__(self):
+        return '\n'.join([
+            f'SHAP values: {self.path}',
+            f'Runs/folds: {len(self.folds)}',
+            f'Features: {len(self.features)}',
+            f'Outputs: {self.n_outputs}'
+        ])
+
+def _get_block(shap_values):
+    ''' Get the values (samples, features, outputs) and base values (samples, outputs) of an Explanation '''
+    values = np.asarray(shap_values.values, dtype=np.float32)
+    if values.ndim == 2:
+        values = values[:, :, None]
+
+    base_values = np.asarray(shap_values.base_values, dtype=np.float32)
+    if base_values.ndim == 1 and base_values.shape[0] == values.shape[0] and values.shape[2] == 1:
+        base_values = base_values[:, None] # One per sample
+    elif base_values.ndim < 2:
+        base_values = np.broadcast_to(base_values.reshape(1, -1), (values.shape[0], base_values.size)) # One per output
+    return values, base_values
@@ -0,0 +1,200 @@
+import json
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Columns that describe a configuration (i.e., one call to predict for one method), with their SQL types
+CONFIG_COLUMNS = {
+    'featureset': 'TEXT', 'method': 'TEXT', 'n_lags': 'INTEGER', 'max_depth': 'INTEGER',
+    'tuned': 'INTEGER', 'features_selected': 'INTEGER', 'search': 'TEXT', 'target': 'TEXT',
+    'n_features': 'INTEGER', 'n_samples': 'INTEGER'
+}
+
+# Columns that identify a configuration - rewriting the same one supersedes the earlier results
+CONFIG_KEY = ['featureset', 'method', 'n_lags', 'max_depth', 'tuned', 'features_selected', 'search', 'target']
+
+METRICS = ['accuracy', 'precision', 'sensitivity', 'specificity', 'f1_score']
+
+# Measurement columns of each table, with their SQL types
+TABLES = {
+    'pred': {'run': 'INTEGER', 'random_state': 'INTEGER', 'type': 'TEXT',
+             **{metric: 'REAL' for metric in METRICS}, 'support': 'REAL'},
+    'roc': {'run': 'INTEGER', 'random_state': 'INTEGER', 'point': 'INTEGER',
+            'tpr_mean': 'REAL', 'fpr_mean': 'REAL'},
+    'auc': {'run': 'INTEGER', 'random_state': 'INTEGER', 'auc_mean': 'REAL', 'auc_std': 'REAL'},
+    'summary': {'type': 'TEXT', 'n_runs': 'INTEGER',
+                **{f'{metric}_{agg}': 'REAL' for metric in METRICS for agg in ['mean', 'std', 'var']}}
+}
+
+class ResultsStore:
+    '''
+    Append-only store of prediction results, in a single SQLite file, replacing the per-config
+    _pred, _roc and _auc CSVs. Each config (one method of one call to predict) is written in a
+    single transaction, so it's stored completely or not at all.
+
+    Tables:
+        configs - one row per written config (featureset, method, n_lags, tuned, etc.)
+        pred - train and test metrics for every run, as in the _pred CSVs
+        roc - mean ROC curve points, as in the _roc CSVs
+        auc - mean and std AUC, as in the _auc CSVs
+        summary - mean, std and var of every metric across runs, by type (train/test),
+            computed once on write
+
+    Loading filters on indexed config columns in SQL, so only matching rows are read.
+    '''
+    def __init__(self, path):
+        path = Path(path)
+        if path.suffix != '.sqlite':
+            path.mkdir(parents=True, exist_ok=True)
+            path = Path.joinpath(path, 'results.sqlite')
+        self.path = path
+        self._create()
+
+    @contextmanager
+    def _connect(self):
+        ''' A connection for one transaction - committed (or rolled back) and then closed on exit, so writes
+            from the writer thread don't leave connections open until they're garbage collected '''
+        with closing(sqlite3.connect(self.path, timeout=60)) as con, con:
+            yield con
+
+    def _create(self):
+        config_cols = ', '.join(f'{col} {sql_type}' for col, sql_type in CONFIG_COLUMNS.items())
+        with self._connect() as con:
+            con.execute(f'CREATE TABLE IF NOT EXISTS configs (config_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                        f'{config_cols}, extra TEXT, written_at REAL)')
+            con.execute('CREATE INDEX IF NOT EXISTS configs_lookup ON configs (featureset, method, tuned, n_lags)')
+
+            for table, columns in TABLES.items():
+                cols = ', '.join(f'{col} {sql_type}' for col, sql_type in columns.items())
+                con.execute(f'CREATE TABLE IF NOT EXISTS {table} (config_id INTEGER REFERENCES configs, {cols})')
+                con.execute(f'CREATE INDEX IF NOT EXISTS {table}_config ON {table} (config_id)')
+
+    def write(self, pred, roc, auc):
+        '''
+        Store the results of a config, given as the frames that would've been written to
+        its _pred, _roc and _auc CSVs. Returns the new config's id.
+        '''
+        # Every row shares the same config - the AUC row is the most complete
+        config = _get_config(auc.iloc[0].to_dict())
+
+        roc = roc.assign(point=np.arange(len(roc)))
+        summary = _summarize(pred)
+
+        with self._connect() as con:
+            cur = con.execute(
+                f'INSERT INTO configs ({", ".join(config)}, written_at) VALUES ({", ".join("?" * len(config))}, ?)',
+                [*config.values(), time.time()]
+            )
+            config_id = cur.lastrowid
+
+            for table, df in [('pred', pred), ('roc', roc), ('auc', auc), ('summary', summary)]:
+                cols = list(TABLES[table])
+                rows = [[config_id] + [_to_sql(row[col]) if col in row else None for col in cols]
+                        for row in df.to_dict('records')]
+                con.executemany(
+                    f'INSERT INTO {table} (config_id, {", ".join(cols)}) VALUES ({", ".join("?" * (len(cols) + 1))})',
+                    rows
+                )
+
+        return config_id
+
+    def load(self, table='pred', featureset=None, method=None, tuned=None, n_lags=None,
+             latest=True, **filters):
+        '''
+        Load one of the tables, joined with its configs, like the CSVs concatenated together.
+
+        Args:
+            featureset, method, tuned, n_lags (and any other config column in filters): Only load
+                rows of matching configs. Each may be a single value or a list of values.
+
+            latest: Only load the most recent write of each config, so re-running a config
+                replaces its results rather than duplicating them.
+        '''
+        if table not in TABLES:
+            raise ValueError(f'Unknown table {table}. Must be one of {list(TABLES)}.')
+
+        filters.update({'featureset': featureset, 'method': method, 'tuned': tuned, 'n_lags': n_lags})
+
+        where, params = [], []
+        for col, value in filters.items():
+            if value is None:
+                continue
+            if col not in CONFIG_COLUMNS:
+                raise ValueError(f'Can\'t filter on {col}. Must be one of {list(CONFIG_COLUMNS)}.')
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            where.append(f'c.{col} IN ({", ".join("?" * len(values))})')
+            params.extend(_to_sql(v) for v in values)
+
+        if latest:
+            where.append(f'c.config_id IN (SELECT MAX(config_id) FROM configs GROUP BY {", ".join(CONFIG_KEY)})')
+
+        query = (f'SELECT t.*, {", ".join(f"c.{col}" for col in CONFIG_COLUMNS)}, c.extra FROM {table} t '
+                 f'JOIN configs c ON t.config_id = c.config_id')
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY t.rowid'
+
+        with self._connect() as con:
+            df = pd.read_sql_query(query, con, params=params)
+
+        return _from_sql(df)
+
+    def load_summary(self, **kwargs):
+        ''' Load the precomputed mean/std/var of every metric across runs, with AUC, for each config '''
+        summary = self.load('summary', **kwargs)
+        auc = self.load('auc', **kwargs)[['config_id', 'auc_mean', 'auc_std']]
+        return summary.merge(auc, on='config_id', how='left')
+
+    def __repr__(self):
+        with self._connect() as con:
+            n_configs = con.execute('SELECT COUNT(*) FROM configs').fetchone()[0]
+        return '\n'.join([
+            f'Results store: {self.path}',
+            f'Configs written: {n_configs}'
+        ])
+
+def get_store(store):
+    ''' Get a ResultsStore from a path, or return an existing ResultsStore (or None) as-is '''
+    if store is None or isinstance(store, ResultsStore):
+        return store
+    return ResultsStore(store)
+
+def _get_config(fields):
+    measurements = set().union(*TABLES.values())
+    config = {col: _to_sql(fields.get(col)) for col in CONFIG_COLUMNS}
+
+    # Any other fields passed to predict are kept, untyped
+    extra = {k: _to_sql(v) for k, v in fields.items() if k not in CONFIG_COLUMNS and k not in measurements}
+    config['extra'] = json.dumps(extra) if extra else None
+    return config
+
+def _summarize(pred):
+    ''' Mean, std and var of each metric across runs, for each type (train/test) '''
+    summary = pred.groupby('type', sort=False)[METRICS].agg(['mean', 'std', 'var'])
+    summary.columns = [f'{metric}_{agg}' for metric, agg in summary.columns]
+    summary['n_runs'] = pred.groupby('type', sort=False).size()
+    return summary.reset_index()
+
+def _to_sql(value):
+    if value is None or value == 'NA' or (isinstance(value, float) and np.isnan(value)):
+        return None
+    if isinstance(value, (bool, np.bool_)):
+        return int(value)
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def _from_sql(df):
+    for col in ['tuned', 'features_selected']:
+        df[col] = df[col].astype(bool)
+    for col in ['n_lags', 'max_depth', 'n_features', 'n_samples']:
+        df[col] = df[col].astype('Int64')
+
+    extra = df.pop('extra')
+    if extra.notna().any():
+        df = df.join(pd.DataFrame([json.loads(x) if x else {} for x in extra], index=df.index))
+    return df
@@ -0,0 +1,146 @@
+import atexit
+import os
+import pickle
+import queue
+import threading
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+from .. import profiling
+
+def atomic_write(path, write, binary=False):
+    '''
+    Write a file via a temp file in the same directory, then rename it into place,
+    so readers never see a partially written file.
+
+    Args:
+        write: Function that writes to the path it's given (e.g. df.to_csv), or to the open
+            file it's given if binary is set
+    '''
+    path = Path(path)
+    tmp = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.tmp')
+    try:
+        if binary:
+            with open(tmp, 'wb') as fp:
+                write(fp)
+        else:
+            write(tmp)
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+class ResultWriter:
+    '''
+    Writes results (frames, pickles, stores) on a background thread, so training never waits on disk.
+
+    Writes are queued in the order they're submitted and run one at a time. The queue holds at most
+    max_pending writes - submitting more blocks until the writer catches up, so results can't pile up
+    in memory faster than they're written. Anything handed to the writer must not be modified afterwards.
+
+    A failed write is raised on the next submit or flush, rather than lost. Every queued write is
+    finished on flush, on close (and on leaving a `with` block, even on error), and at interpreter exit.
+    '''
+    def __init__(self, max_pending=16):
+        self.max_pending = max_pending
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._errors = []
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='ResultWriter', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+        return self
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                fn, args, kwargs = task
+                with profiling.span('write', **_describe(fn, args)):
+                    fn(*args, **kwargs)
+            except Exception as e:
+                self._errors.append(e)
+            finally:
+                self._queue.task_done()
+
+    def submit(self, fn, *args, **kwargs):
+        ''' Queue fn(*args, **kwargs) to run on the writer thread, blocking while the queue is full '''
+        self._raise_errors()
+        self.start()
+        self._queue.put((fn, args, kwargs))
+
+    def write_csv(self, df, path, **kwargs):
+        ''' Queue an (atomic) df.to_csv(path) '''
+        self.submit(atomic_write, path, lambda tmp: df.to_csv(tmp, **kwargs))
+
+    def write_pickle(self, obj, path):
+        ''' Queue an (atomic) pickle.dump of obj to path '''
+        self.submit(atomic_write, path, lambda fp: pickle.dump(obj, fp), binary=True)
+
+    def flush(self):
+        ''' Wait for every queued write to finish, raising the first that failed '''
+        if self._thread is not None:
+            self._queue.join()
+        self._raise_errors()
+
+    def close(self):
+        ''' Flush, then stop the writer thread. The writer restarts if written to again. '''
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.join()
+            self._queue.put(None)
+            self._thread.join()
+            atexit.unregister(self.close)
+        self._raise_errors()
+
+    def _raise_errors(self):
+        if self._errors:
+            errors, self._errors = self._errors, []
+            raise errors[0]
+
+    def __len__(self):
+        ''' Number of writes waiting in the queue '''
+        return self._queue.qsize()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+            return
+
+        # Still write everything queued before the error, without masking it
+        try:
+            self.close()
+        except Exception as e:
+            print('Failed to write results: %s' % e)
+
+    def __repr__(self):
+        return f'{type(self).__name__}(max_pending={self.max_pending}, queued={len(self)})'
+
+def _describe(fn, args):
+    ''' Tags of a write, for its profiling span '''
+    tags = {'task': getattr(fn, '__qualname__', type(fn).__name__)}
+    if args and isinstance(args[0], (str, os.PathLike)):
+        tags['file'] = Path(args[0]).name
+    return tags
+
+@contextmanager
+def writing_session(writer=None, max_pending=16):
+    '''
+    Get a ResultWriter for the duration of a session (e.g., a call to predict), and close it
+    on exit, once everything is written. Existing writers are only flushed on exit, so they
+    can be shared across sessions.
+    '''
+    if isinstance(writer, ResultWriter):
+        yield writer
+        writer.flush()
+        return
+
+    with ResultWriter(max_pending) as writer:
+        yield writer
@@ -0,0 +1,291 @@
+''' Stage-level timing and memory instrumentation.
+
+Wrap a stage in a span to record its wall time, CPU time and peak RSS:
+
+    with profiling.span('impute', run=run, fold=fold):
+        ...
+
+Spans nest - each records its parent, its path (e.g. 'predict/train_test_fold/fit'), and inherits
+its parent's tags (method, run, fold, ...). Finished spans are kept in memory and, if given a path,
+appended to a JSONL file, one span per line. Summarize them with summary or report.
+
+Disabled by default (see enable, session, or the BCPN_PROFILE environment variable), in which case
+span returns a shared no-op context manager and traced returns the function it's given, so
+instrumented code costs next to nothing. '''
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from itertools import count
+from pathlib import Path
+
+import pandas as pd
+
+_NULL_SPAN = nullcontext()
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+class _State:
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.sample_interval = None
+        self.records = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.open_spans = set()
+        self.sampler = None
+        self.fp = None
+        self.ids = count()
+        self.pid = os.getpid()
+
+_state = _State()
+
+def _rss():
+    ''' Current resident set size of this process, in bytes '''
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        import resource # Peak rather than current, where /proc isn't available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _sample(interval):
+    ''' Update the peak RSS of every open span, every interval seconds, while enabled '''
+    while _state.enabled and _state.sample_interval == interval:
+        rss = _rss()
+        with _state.lock:
+            for span in _state.open_spans:
+                span.peak_rss = max(span.peak_rss, rss)
+        time.sleep(interval)
+
+def _start_sampler():
+    if _state.sample_interval:
+        _state.sampler = threading.Thread(target=_sample, args=(_state.sample_interval,),
+                                          name='profiling-sampler', daemon=True)
+        _state.sampler.start()
+
+def _after_fork():
+    ''' Forked children (e.g. process pool workers) get their own lock, spans and sampler,
+        and append to the same file '''
+    _state.lock = threading.Lock()
+    _state.local = threading.local()
+    _state.open_spans = set()
+    _state.pid = os.getpid()
+    if _state.enabled:
+        _start_sampler()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+def enable(path=None, sample_interval=0.01):
+    '''
+    Start recording spans.
+
+    Args:
+        path: JSONL file to append finished spans to, if any. Spans are always kept in memory
+            (see records), but only the file collects spans from worker processes.
+
+        sample_interval: How often (in seconds) to sample RSS for the peak RSS of open spans.
+            Spans also sample it when they start and finish, so short spans are still covered.
+            None to only sample at the start and finish.
+    '''
+    disable()
+    _state.path = Path(path) if path is not None else None
+    if _state.path is not None:
+        _state.path.parent.mkdir(parents=True, exist_ok=True)
+        _state.fp = open(_state.path, 'a', buffering=1) # Line buffered - one write per span
+    _state.sample_interval = sample_interval
+    _state.enabled = True
+    _start_sampler()
+
+def disable():
+    ''' Stop recording spans. Already recorded spans are kept (see records). '''
+    _state.enabled = False
+    if _state.sampler is not None:
+        _state.sampler.join()
+        _state.sampler = None
+    if _state.fp is not None:
+        _state.fp.close()
+        _state.fp = None
+
+def is_enabled():
+    return _state.enabled
+
+@contextmanager
+def session(path=None, sample_interval=0.01):
+    ''' Record spans for the duration of a with block (see enable) '''
+    enable(path, sample_interval)
+    try:
+        yield
+    finally:
+        disable()
+
+def records():
+    ''' Spans finished in this process since it started recording, as dictionaries '''
+    return list(_state.records)
+
+def clear():
+    _state.records = []
+
+class Span:
+    ''' A single timed stage. Use span, rather than creating these directly. '''
+    def __init__(self, name, tags, parent=None):
+        self.name = name
+        self.tags = tags
+        self.parent = parent
+
+    def __enter__(self):
+        stack = getattr(_state.local, 'stack', None)
+        if stack is None:
+            stack = _state.local.stack = []
+
+        parent = stack[-1] if stack else self.parent
+        if parent is not None:
+            self.tags = {**parent.tags, **self.tags}
+            self.path = f'{parent.path}/{self.name}'
+            self.parent_id = parent.id
+        else:
+            self.path = self.name
+            self.parent_id = None
+
+        self.id = f'{_state.pid}-{next(_state.ids)}'
+        self.rss_start = self.peak_rss = _rss()
+        with _state.lock:
+            _state.open_spans.add(self)
+        stack.append(self)
+
+        self.start = time.time()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        rss_end = _rss()
+
+        _state.local.stack.pop()
+        with _state.lock:
+            _state.open_spans.discard(self)
+        if not _state.enabled:
+            return
+
+        record = {'id': self.id, 'parent': self.parent_id, 'name': self.name, 'path': self.path,
+                  'depth': self.path.count('/'), 'pid': _state.pid, 'thread': threading.current_thread().name,
+                  'start': self.start, 'wall': wall, 'cpu': cpu, 'rss_start': self.rss_start,
+                  'rss_end': rss_end, 'peak_rss': max(self.peak_rss, rss_end),
+                  'error': exc_type.__name__ if exc_type is not None else None, 'tags': self.tags}
+        with _state.lock:
+            _state.records.append(record)
+            if _state.fp is not None:
+                _state.fp.write(json.dumps(record, default=str) + '\n')
+
+class _Parent:
+    ''' Where a span was when work was handed to another process or thread '''
+    def __init__(self, span):
+        self.id, self.path, self.tags = span.id, span.path, span.tags
+
+def span(name, **tags):
+    ''' Time a stage, tagged with e.g. method, run and fold. A no-op unless enabled. '''
+    if not _state.enabled:
+        return _NULL_SPAN
+    return Span(name, tags)
+
+class _Traced:
+    ''' A function run in a span, in whichever process or thread it's called from. Picklable
+        (if fn is), so spawned workers start recording to the same file when called. '''
+    def __init__(self, fn, name, tags, parent, path, sample_interval):
+        self.fn = fn
+        self.name = name
+        self.tags = tags
+        self.parent = parent
+        self.path = path
+        self.sample_interval = sample_interval
+        self.pid = os.getpid()
+
+    def __call__(self, *args, **kwargs):
+        if not _state.enabled:
+            if os.getpid() == self.pid:
+                return self.fn(*args, **kwargs) # Profiling was disabled in this process since it was traced
+            enable(self.path, self.sample_interval)
+        with Span(self.name, dict(self.tags), self.parent):
+            return self.fn(*args, **kwargs)
+
+def traced(fn, name, **tags):
+    '''
+    Wrap fn to run in a span named name, nested under the current span - for handing work to
+    an executor, whose workers don't share this thread's spans. Returns fn as-is unless enabled.
+    '''
+    if not _state.enabled:
+        return fn
+
+    stack = getattr(_state.local, 'stack', None)
+    parent = _Parent(stack[-1]) if stack else None
+    return _Traced(fn, name, tags, parent, _state.path, _state.sample_interval)
+
+def timed(name=None, **tags):
+    ''' Decorator to run every call of a function in a span (named after the function, by default) '''
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _state.enabled:
+                return fn(*args, **kwargs)
+            with Span(name or fn.__name__, dict(tags)):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def load(path):
+    ''' Load the spans in a JSONL file, with one column per tag '''
+    with open(path) as fp:
+        spans = [json.loads(line) for line in fp if line.strip()]
+    return _to_frame(spans)
+
+def _to_frame(spans):
+    df = pd.DataFrame(spans)
+    if df.empty:
+        return df
+    tags = pd.DataFrame(list(df.pop('tags')), index=df.index).convert_dtypes() # Keep run/fold as ints, despite gaps
+    return df.join(tags[[col for col in tags.columns if col not in df.columns]])
+
+def summary(spans=None, by='path'):
+    '''
+    Summarize spans by stage: how many times each ran, total/mean/max wall time, total CPU time,
+    the highest peak RSS (in MB), and each stage's share of the total wall time of the top-level spans.
+
+    Args:
+        spans: DataFrame of spans (see load), or a path to a JSONL file. Defaults to the spans
+            recorded in this process.
+
+        by: Column(s) to summarize by - 'path' (the default, i.e. each stage within its parents),
+            'name' (each stage, wherever it ran), or e.g. ['path', 'method']
+    '''
+    if spans is None:
+        spans = _to_frame(records())
+    elif not isinstance(spans, pd.DataFrame):
+        spans = load(spans)
+    if spans.empty:
+        return pd.DataFrame()
+
+    total_wall = spans.loc[spans['parent'].isna() | ~spans['parent'].isin(spans['id']), 'wall'].sum()
+    res = spans.groupby(by, sort=False).agg(
+        count=('wall', 'size'), wall_total=('wall', 'sum'), wall_mean=('wall', 'mean'),
+        wall_max=('wall', 'max'), cpu_total=('cpu', 'sum'), peak_rss_mb=('peak_rss', 'max')
+    )
+    res['peak_rss_mb'] = res['peak_rss_mb'] / 2**20
+    res['wall_share'] = res['wall_total'] / total_wall if total_wall else float('nan')
+    return res.sort_values('wall_total', ascending=False)
+
+def report(spans=None, by='path'):
+    ''' Print a summary of spans (see summary) '''
+    res = summary(spans, by)
+    print('Profiled %i stages.' % len(res))
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200, 'display.float_format', '{:.3f}'.format):
+        print(res)
+    return res
+
+# Set BCPN_PROFILE to a JSONL path to record from the start, without changing any code
+if os.environ.get('BCPN_PROFILE'):
+    enable(os.environ['BCPN_PROFILE'])
@@ -0,0 +1,75 @@
+''' Import time guard: importing bcpn_pipeline must not import the ML libraries, and must cost
+little more than importing pandas (which it needs anyway).
+
+    python benchmarks/bench_import.py
+
+Each import is timed in a fresh interpreter, the fastest of --repeat runs. Exits with status 1 if any
+module imports a heavy library, or goes over the time or memory budget. '''
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+MODULES = ['bcpn_pipeline', 'bcpn_pipeline.data', 'bcpn_pipeline.features', 'bcpn_pipeline.models']
+
+# Libraries that should only be imported once a model, tuner or explainer is used
+HEAVY = ['sklearn', 'scipy', 'xgboost', 'shap', 'imblearn', 'statsmodels', 'ray', 'tune_sklearn', 'optuna', 'joblib']
+
+# Allowed cost of importing a module, over importing pandas
+BUDGET_S = 0.25
+BUDGET_MB = 30
+
+_PROBE = '''
+import json, resource, sys, time
+start = time.perf_counter()
+import {module}
+wall = time.perf_counter() - start
+print(json.dumps({{'wall': wall, 'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  'heavy': sorted(m for m in {heavy} if m in sys.modules)}}))
+'''
+
+def measure(module, repeat=5):
+    ''' Fastest import of module over repeat fresh interpreters, with its peak RSS and the heavy libraries it imported '''
+    runs = []
+    for i in range(repeat):
+        out = subprocess.run([sys.executable, '-c', _PROBE.format(module=module, heavy=HEAVY)],
+                             cwd=ROOT, capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(out.strip().splitlines()[-1]))
+    return min(runs, key=lambda run: run['wall'])
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modules', nargs='+', default=MODULES)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget-s', type=float, default=BUDGET_S)
+    parser.add_argument('--budget-mb', type=float, default=BUDGET_MB)
+    args = parser.parse_args(args)
+
+    reference = measure('pandas', args.repeat)
+    print('pandas: %.3fs, %.0f MB' % (reference['wall'], reference['rss_mb']))
+
+    failed = False
+    for module in args.modules:
+        res = measure(module, args.repeat)
+        over_s = res['wall'] - reference['wall']
+        over_mb = res['rss_mb'] - reference['rss_mb']
+        problems = []
+        if res['heavy']:
+            problems.append('imports %s' % ', '.join(res['heavy']))
+        if over_s > args.budget_s:
+            problems.append('%.3fs over budget' % (over_s - args.budget_s))
+        if over_mb > args.budget_mb:
+            problems.append('%.0f MB over budget' % (over_mb - args.budget_mb))
+
+        print('%s: %.3fs (+%.3fs), %.0f MB (+%.0f MB)%s' % (module, res['wall'], over_s, res['rss_mb'], over_mb,
+                                                       ' - ' + '; '.join(problems) if problems else ''))
+        failed = failed or bool(problems)
+
+    print('Import budget exceeded.' if failed else 'Within the import budget.')
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,374 @@
+''' Scaling benchmarks of the pipeline's stages, on synthetic MEMS cohorts (see data.SyntheticCohort).
+
+Times each stage - Dataset.clean, Dataset.from_csv (from its cache), Dataset.to_events, get_temporal_feats, calc_standard_temporal_metrics (and
+calc_horizon_metrics, for every horizon at once), Featureset.prep_for_modeling and predict - at
+each cohort size, and reports its wall time, throughput and peak memory (the most RSS grew by while it ran).
+
+    # Run every stage at the default sizes, and compare against the stored baselines
+    python benchmarks/bench_pipeline.py --check
+
+    # Record new baselines (e.g., after a deliberate change, or on a new machine)
+    python benchmarks/bench_pipeline.py --save-baseline
+
+    # Just the feature stages, at 100k participants
+    python benchmarks/bench_pipeline.py --sizes 100000 --stages temporal_feats temporal_metrics
+
+    # Just check that the online feature store matches the batch featureset
+    python benchmarks/bench_pipeline.py --parity
+
+Stages that can't run at a size on a small machine are skipped above their default limit
+(see STAGE_LIMITS) unless --no-limits is given. --check exits with status 1 if any stage got
+slower, or used more memory, than its baseline by more than the tolerance, or if the online
+feature store's vectors differ from the batch featureset's (see check_parity). '''
+import argparse
+import contextlib
+import csv
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from bcpn_pipeline import consts, data, features, models, profiling
+
+BASELINES_PATH = Path(__file__).resolve().parent.joinpath('baselines.json')
+
+SIZES = [100, 1000, 10000, 100000]
+STAGES = ['clean', 'load', 'reshape', 'temporal_feats', 'temporal_metrics', 'horizon_metrics', 'prep_for_modeling', 'predict']
+
+# Largest cohort each stage runs on by default - the wide export of 100k participants alone
+# takes several GB, and predict trains a model per fold
+STAGE_LIMITS = {'clean': 10000, 'load': 10000, 'reshape': 10000, 'predict': 10000}
+
+HORIZON = 'study_week'
+N_LAGS = 2
+
+# Cohort the online feature store is checked against the batch featureset on
+PARITY_PARTICIPANTS = 200
+
+def clean_args(columns):
+    ''' Arguments of Dataset.clean for a wide export with columns, as in analysis.ipynb '''
+    return dict(to_rename={**consts.RENAMINGS['demographics'], **consts.RENAMINGS['medical']},
+                to_drop=[col for col in columns if '_Name' in col] + ['MemsNum', 'Monitor', 'pre_dx_date'],
+                to_map=consts.CODEBOOK,
+                to_binarize=['race_other'],
+                onehots_to_reverse=['race_'])
+
+def dtypes_dict(columns):
+    return {
+        'numeric': [col for col in columns if 'date' not in col.lower()],
+        'datetime': ['DateEnroll'],
+        'categorical': list(set(list(consts.CODEBOOK.keys()) + ['race']))
+    }
+
+def clean(wide):
+    ''' Clean the wide export and set dtypes, as analysis.ipynb does '''
+    dataset = data.Dataset(wide, id_col='PtID')
+    dataset.clean(**clean_args(dataset.df.columns))
+    dataset.set_dtypes(dtypes_dict(dataset.df.columns))
+    return dataset
+
+def load(path):
+    ''' Read the cleaned dataset of the wide export at path from the cache, as analysis.ipynb does '''
+    with open(path, newline='') as fp:
+        columns = next(csv.reader(fp))
+    args = clean_args(columns)
+    renamed = [args['to_rename'].get(col, col) for col in columns]
+    return data.Dataset.from_csv(path, id_col='PtID', clean_args=args, dtypes_dict=dtypes_dict(renamed),
+                                 cache_path=Path(path).parent.joinpath('cache'))
+
+def reshape(dataset):
+    return dataset.to_events(start_date_col='DateEnroll')
+
+def temporal_feats(events):
+    ''' Add the temporal features and drop the washout month, as analysis.ipynb does '''
+    events['used_today'] = (events['num_times_used_today'] > 0).astype(int)
+    events = features.get_temporal_feats(df=events, start_date_col='DateEnroll',
+                                         id_col='PtID', time_of_day_props=consts.TIME_OF_DAY_PROPS)
+    return events[events['study_month'] > 0].reset_index(drop=True)
+
+def temporal_metrics(horizons_df):
+    return features.calc_standard_temporal_metrics(horizons_df, ['PtID', HORIZON], 'datetime')
+
+def horizon_metrics(horizons_df):
+    return features.calc_horizon_metrics(horizons_df, 'PtID', 'datetime', horizons=list(consts.HORIZON_DAYS),
+                                         sums=['num_times_used_today'], daily_max_sums=['withinrange'])
+
+def build_featureset(horizons_df, metrics, horizon=HORIZON):
+    ''' The study week (or month) featureset of analysis.ipynb (with the target set), from the temporal
+        features and their standard temporal metrics '''
+    groupby_cols = ['PtID', horizon]
+    n_days = features.HORIZON_DENOMS[horizon]
+    grouped = horizons_df.groupby(groupby_cols)
+
+    df = grouped.agg(n_events=('num_times_used_today', 'sum')).reset_index()
+    df = df.merge(metrics, on=groupby_cols, how='outer')
+    df['num_daily_events_mean'] = df['n_events'] / n_days
+
+    modes = horizons_df.dropna(subset=['time_of_day']).groupby(groupby_cols, observed=True)['time_of_day'] \
+                       .agg(lambda x: x.mode()[0]).rename('event_time_of_day_mode').reset_index()
+    df = df.merge(modes, on=groupby_cols, how='left')
+    df['event_time_of_day_mode'] = df['event_time_of_day_mode'].astype('category')
+
+    adherence = horizons_df.groupby(groupby_cols + ['study_day'])['withinrange'].max() \
+                           .groupby(groupby_cols).sum() / n_days
+    df = df.merge(adherence.rename('adherence_rate').reset_index(), on=groupby_cols, how='outer')
+    df = df.drop_duplicates(subset=groupby_cols)
+
+    target_col = 'adherent'
+    df[target_col] = (df.pop('adherence_rate') > consts.ADHERENCE_THRESHOLD).astype(int)
+    return features.Featureset(df=df, name=horizon, id_col='PtID', horizon=horizon,
+                               nominal_cols=[target_col], target_col=target_col)
+
+def prep_for_modeling(fs):
+    return fs.prep_for_modeling(n_lags=N_LAGS)
+
+def predict(fs):
+    with tempfile.TemporaryDirectory() as output_path:
+        models.predict(fs, output_path=Path(output_path), n_runs=1, max_depth=3,
+                       models={'RF': None}, executor='serial')
+
+class Bench:
+    ''' Runs each stage on a cohort, feeding each its inputs from the stage before it (untimed) '''
+    def __init__(self, n_participants, n_days, seed, repeat, verbose=False):
+        self.cohort = data.SyntheticCohort(n_participants, n_days=n_days, seed=seed)
+        self.n_participants = n_participants
+        self.repeat = repeat
+        self.verbose = verbose
+        self._inputs = {}
+
+    def cleaned(self):
+        if 'cleaned' not in self._inputs:
+            self._inputs['cleaned'] = clean(self.cohort.to_wide())
+        return self._inputs['cleaned']
+
+    def cached_csv(self):
+        ''' The wide export as a CSV, with its cleaned dataset cached - in a temporary directory for the
+            life of the Bench '''
+        if 'csv' not in self._inputs:
+            self._tmp = tempfile.TemporaryDirectory()
+            path = Path(self._tmp.name).joinpath('wide.csv')
+            wide = self.cohort.to_wide()
+            wide.to_csv(path, index=False)
+            load(path)
+            self._inputs['csv'] = (path, wide.shape[0] * wide.shape[1])
+        return self._inputs['csv']
+
+    def events(self):
+        if 'events' not in self._inputs:
+            self._inputs['events'] = self.cohort.to_events()
+        return self._inputs['events']
+
+    def horizons(self):
+        if 'horizons' not in self._inputs:
+            self._inputs['horizons'] = temporal_feats(self.events().copy())
+        return self._inputs['horizons']
+
+    def featureset(self):
+        if 'featureset' not in self._inputs:
+            horizons = self.horizons()
+            self._inputs['featureset'] = build_featureset(horizons, temporal_metrics(horizons))
+        return self._inputs['featureset']
+
+    def prepped(self):
+        if 'prepped' not in self._inputs:
+            self._inputs['prepped'] = prep_for_modeling(_copy_featureset(self.featureset()))
+        return self._inputs['prepped']
+
+    def setup(self, stage):
+        ''' A fresh copy of a stage's input (stages modify their inputs), and how many rows it has '''
+        if stage == 'clean':
+            wide = self.cohort.to_wide()
+            return wide, wide.shape[0] * wide.shape[1] # Cells, rather than rows
+        if stage == 'load':
+            return self.cached_csv()
+        if stage == 'reshape':
+            cleaned = self.cleaned()
+            return data.Dataset(cleaned.df.copy(), id_col=cleaned.id_col), cleaned.df.shape[0] * cleaned.df.shape[1]
+        if stage == 'temporal_feats':
+            return self.events().copy(), len(self.events())
+        if stage in ['temporal_metrics', 'horizon_metrics']:
+            return self.horizons(), len(self.horizons())
+        if stage == 'prep_for_modeling':
+            return _copy_featureset(self.featureset()), len(self.featureset().df)
+        if stage == 'predict':
+            models.predict # Import the modeling libraries up front, rather than in the first timed run
+            return self.prepped(), len(self.prepped().df)
+
+    def run(self, stage):
+        ''' Best (fastest) of repeat runs of a stage '''
+        fn = globals()[stage]
+        best = None
+        for i in range(self.repeat):
+            # The stages print their progress - keep it out of the results, unless asked for
+            with contextlib.ExitStack() as stack:
+                if not self.verbose:
+                    stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, 'w'))))
+                result = self._run_once(stage, fn)
+            if best is None or result['wall'] < best['wall']:
+                best = result
+
+        best['participants_per_s'] = self.n_participants / best['wall']
+        best['rows_per_s'] = best['n_rows'] / best['wall']
+        return best
+
+    def _run_once(self, stage, fn):
+        stage_input, n_rows = self.setup(stage)
+        profiling.clear()
+        with profiling.session(sample_interval=0.005):
+            with profiling.span('bench', stage=stage, n_participants=self.n_participants) as span:
+                fn(stage_input)
+        record = next(r for r in profiling.records() if r['id'] == span.id)
+        del stage_input
+
+        return {'stage': stage, 'n_participants': self.n_participants, 'n_rows': n_rows,
+                'wall': record['wall'], 'cpu': record['cpu'],
+                'peak_mb': (record['peak_rss'] - record['rss_start']) / 2**20}
+
+def check_parity(n_participants=PARITY_PARTICIPANTS, n_days=120, seed=0, verbose=False):
+    '''
+    Replay a synthetic cohort's events through features.OnlineFeatures, and compare every vector to the
+    batch featureset's (see features.check_online_parity), for each horizon it keeps.
+
+    Returns:
+        DataFrame of the values that differ, with their horizon - empty if every vector matches
+    '''
+    horizons_df = temporal_feats(data.SyntheticCohort(n_participants, n_days=n_days, seed=seed).to_events())
+
+    diffs = []
+    for horizon in features.HORIZON_DENOMS:
+        with contextlib.ExitStack() as stack:
+            if not verbose:
+                stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, 'w'))))
+            metrics = features.calc_standard_temporal_metrics(horizons_df, ['PtID', horizon], 'datetime')
+            diff = features.check_online_parity(horizons_df, build_featureset(horizons_df, metrics, horizon), N_LAGS)
+        print('  online features, %s: %s' % (horizon, 'match' if diff.empty else '%i values differ' % len(diff)))
+        diffs.append(diff.assign(horizon=horizon))
+    return pd.concat(diffs, ignore_index=True)
+
+def _copy_featureset(fs):
+    return features.Featureset(df=fs.df.copy(), name=fs.name, id_col=fs.id_col, horizon=fs.horizon,
+                               nominal_cols=list(fs.nominal_cols), target_col=fs.target_col)
+
+def machine():
+    return {'platform': platform.platform(), 'python': platform.python_version(), 'processor': platform.processor(),
+            'cpus': os.cpu_count(), 'pandas': pd.__version__, 'numpy': np.__version__}
+
+def load_baselines(path=BASELINES_PATH):
+    if not Path(path).exists():
+        return {'machine': None, 'results': []}
+    with open(path) as fp:
+        return json.load(fp)
+
+def save_baselines(results, n_days, seed, path=BASELINES_PATH):
+    ''' Store results as the baselines, replacing any of the same stage and size '''
+    baselines = load_baselines(path)
+    new = {(r['stage'], r['n_participants']) for r in results}
+    kept = [r for r in baselines['results'] if (r['stage'], r['n_participants']) not in new]
+    baselines = {'machine': machine(), 'n_days': n_days, 'seed': seed,
+                 'results': sorted(kept + results, key=lambda r: (STAGES.index(r['stage']), r['n_participants']))}
+    with open(path, 'w') as fp:
+        json.dump(baselines, fp, indent=2)
+    print('Saved %i baselines to %s' % (len(baselines['results']), path))
+
+def check(results, tolerance, n_days, seed, path=BASELINES_PATH):
+    '''
+    Compare results against the stored baselines.
+
+    Returns:
+        DataFrame of each result's wall time and peak memory relative to its baseline, and whether
+        it regressed (either got worse by more than tolerance, e.g. 0.25 for 25%)
+    '''
+    baselines = load_baselines(path)
+    if baselines['machine'] != machine():
+        print('Warning: baselines were recorded on a different machine (%s).' % baselines['machine'])
+    if (baselines.get('n_days'), baselines.get('seed')) != (n_days, seed):
+        print('Warning: baselines were recorded with n_days=%s, seed=%s.' % (baselines.get('n_days'), baselines.get('seed')))
+
+    base = pd.DataFrame(baselines['results'])
+    if base.empty:
+        print('No baselines to check against.')
+        return pd.DataFrame()
+
+    res = pd.DataFrame(results).merge(base[['stage', 'n_participants', 'wall', 'peak_mb']],
+                                      on=['stage', 'n_participants'], suffixes=('', '_baseline'))
+    res['wall_ratio'] = res['wall'] / res['wall_baseline']
+
+    # Small allocations are mostly noise - only compare peaks above a few MB
+    res['peak_ratio'] = res['peak_mb'].clip(lower=8) / res['peak_mb_baseline'].clip(lower=8)
+    res['regressed'] = (res['wall_ratio'] > 1 + tolerance) | (res['peak_ratio'] > 1 + tolerance)
+    return res[['stage', 'n_participants', 'wall', 'wall_baseline', 'wall_ratio',
+                'peak_mb', 'peak_mb_baseline', 'peak_ratio', 'regressed']]
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='Numbers of participants')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--days', type=int, default=120, help='Study days per participant')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each stage (the fastest is kept)')
+    parser.add_argument('--no-limits', action='store_true', help='Run every stage at every size (see STAGE_LIMITS)')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baselines')
+    parser.add_argument('--check', action='store_true', help='Compare the results against the baselines, and check parity')
+    parser.add_argument('--parity', action='store_true', help='Only check that the online feature store matches the batch featureset')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown/memory growth for --check')
+    parser.add_argument('--baselines', type=Path, default=BASELINES_PATH)
+    parser.add_argument('--output', type=Path, help='CSV to write the results to')
+    parser.add_argument('--verbose', action='store_true', help="Show the stages' own output")
+    args = parser.parse_args(args)
+
+    warnings.filterwarnings('ignore')
+
+    if args.check or args.parity:
+        print('Checking online feature parity (%i participants).' % PARITY_PARTICIPANTS)
+        diff = check_parity(n_days=args.days, seed=args.seed, verbose=args.verbose)
+        if not diff.empty:
+            print(diff.head(20))
+            print('Online features differ from the batch featureset.')
+            return 1
+        if args.parity:
+            return 0
+
+    results = []
+    for n in sorted(args.sizes):
+        stages = [s for s in args.stages if args.no_limits or n <= STAGE_LIMITS.get(s, n)]
+        if not stages:
+            continue
+        print('Benchmarking %i participants.' % n)
+        bench = Bench(n, args.days, args.seed, 1 if n >= 10000 else args.repeat, args.verbose)
+        for stage in stages:
+            start = time.perf_counter()
+            results.append(bench.run(stage))
+            print('  %s: %.3fs (%.1fs with setup)' % (stage, results[-1]['wall'], time.perf_counter() - start))
+        del bench
+
+    res = pd.DataFrame(results)
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200, 'display.float_format', '{:.3f}'.format):
+        print(res)
+    if args.output:
+        res.to_csv(args.output, index=False)
+
+    if args.save_baseline:
+        save_baselines(results, args.days, args.seed, args.baselines)
+
+    if args.check:
+        comparison = check(results, args.tolerance, args.days, args.seed, args.baselines)
+        if not comparison.empty:
+            with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200, 'display.float_format', '{:.3f}'.format):
+                print(comparison)
+            if comparison['regressed'].any():
+                print('Regressions found.')
+                return 1
+        print('No regressions found.')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())